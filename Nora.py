@@ -13,7 +13,6 @@ from __future__ import division, print_function, absolute_import
 import os
 import sys
 import time
-from datetime import datetime
 
 import schedule
 
@@ -21,6 +20,9 @@ from ligmos.workers import workerSetup, connSetup
 from ligmos.utils import amq, common, classes, confparsers
 
 from mrfreeze import actions, listener, compatibility
+from mrfreeze import serialcomm, aiopoll, jobpool, dbwriter, spool
+from mrfreeze import pipeline, adaptive, breaker, latency, calibration
+from mrfreeze import upload
 
 
 def main():
@@ -36,8 +38,43 @@ def main():
     eargs = None
     logenable = True
 
-    # Interval between successive runs of the polling loop (seconds)
-    bigsleep = 1
+    # Where anything that couldn't be sent to the databases or brokers
+    #   is kept until they're back again
+    spooldir = './spool/'
+
+    # Longest that the main loop will sleep (seconds); it's woken up
+    #   before that whenever a scheduled job is due or a command comes in
+    maxnap = 5.
+
+    # How the devices are polled, which can be changed with the
+    #   MRFREEZE_RUNTIME environment variable. 'schedule' runs each device's
+    #   queries one at a time in this thread; 'asyncio' polls every device
+    #   endpoint concurrently (see mrfreeze.aiopoll)
+    runtime = os.environ.get('MRFREEZE_RUNTIME', 'schedule').lower()
+    if runtime not in ['schedule', 'asyncio']:
+        print("Unknown runtime %s! Using 'schedule' instead." % (runtime))
+        runtime = 'schedule'
+
+    # Number of worker threads that the scheduled device jobs run in when
+    #   using the 'schedule' runtime; jobs on the same device host/port
+    #   still run one at a time. 0 runs them in the main thread instead.
+    nworkers = 4
+
+    # The device replies wait in a queue of at most pubqueue of them to be
+    #   published. If it fills up (say the database is crawling), pubpolicy
+    #   is what happens to new ones: 'block' holds up the device jobs,
+    #   'dropoldest' tosses the oldest one waiting, and 'spool' puts the
+    #   new ones on disk until there's room again
+    pubqueue = 1000
+    pubpolicy = 'spool'
+
+    # Each framed reply only gets as long as it usually takes (plus some),
+    #   as learned from the devices' response times, but never less than
+    #   deadlinefloor or more than deadlineceiling seconds. What's been
+    #   learned is kept in latencyfile between restarts
+    deadlinefloor = 0.1
+    deadlineceiling = 5.
+    latencyfile = os.path.join(spooldir, 'latency.json')
 
     # config: dictionary of parsed config file
     # comm: common block from config file
@@ -65,26 +102,36 @@ def main():
                                          ekeys=['devtype', 'extratag'],
                                          delim="+")
 
-    # We need to store our NIHTS compatibility stuff in the above NIHTS
-    #   section, to guarantee that it's shared between all devices for that
+    # We need to store our compatibility stuff in the above instrument
+    #   sections, to guarantee that it's shared between all devices for that
     #   instrument.  So it needs to be in this level!
     # Also hack in the required password
-    print("Looking for NIHTS compatibility section...")
+    print("Looking for instrument compatibility sections...")
     try:
         compatConfig = confparsers.rawParser("../../conf/compat.conf")
-        np = compatConfig['nihts']
-        # A cheap hack inside of a cheap hack!
-        if np['enabled'].lower() == "false":
-            np = None
-            print("Warning! Compat info found, but was disabled!")
-        else:
-            compatClass = compatibility.upfileNIHTS(np)
-            allInsts["nihts"].update({"compatibility": compatClass})
-            print("NIHTS compatibility layer enabled.")
     except Exception as err:
         print("None found! Skipping.")
         print(str(err))
-        np = None
+        compatConfig = None
+
+    if compatConfig is not None:
+        for inst in compatConfig.sections():
+            try:
+                compatClass = compatibility.makeCompat(inst,
+                                                       compatConfig[inst])
+            except Exception as err:
+                print("Unable to set up the %s compatibility layer!" % (inst))
+                print(str(err))
+                continue
+
+            if compatClass is None:
+                print("Warning! %s compat info found, but was disabled!" %
+                      (inst))
+            elif inst not in allInsts:
+                print("Warning! No %s devices for the compat info!" % (inst))
+            else:
+                allInsts[inst].update({"compatibility": compatClass})
+                print("%s compatibility layer enabled." % (inst))
 
     print("Config:")
     print(allInsts)
@@ -92,6 +139,14 @@ def main():
     # Check to see if there are any connections/objects to establish
     idbs = connSetup.connIDB(comm)
 
+    # All of the database writes go through one background writer that
+    #   batches them up, rather than each being its own connect and commit
+    idbspool = spool.diskSpool(os.path.join(spooldir, 'influxdb'))
+    idbwriter = dbwriter.batchWriter(flushSize=500, flushInterval=5.,
+                                     spool=idbspool)
+    idbs = idbwriter.wrapAll(idbs)
+    idbwriter.start()
+
     # Specify our custom listener that will really do all the work
     #   Someone more clever than I can clean this up to be more general.
     db = idbs['database-primary']
@@ -110,30 +165,45 @@ def main():
     conn = amqs['broker-primary'][0]
     queue = comm['queue-mrfreeze']
 
-    # Assemble our *initial* schedule of actions. This will be adjusted
-    #   by any inputs from the broker once we're in the main loop
-    sched = schedule.Scheduler()
-    sched = actions.scheduleInstruments(sched, allInsts,
-                                        amqs, idbs,
-                                        debug=True)
-
-    # Before we start the main loop, query all the defined actions
-    #   in turn. This will help avoid triggering alerts/warnings/etc.
-    # We need to make sure the connection to the broker is up first,
-    #   though, because we need to get the LOIS reply topics connected.
-    amqs = amq.checkConnections(amqs, subscribe=True)
-    sched.run_all(delay_seconds=1.5)
-
-    # Interval for printing the diagnostic/debug/schedule information (in s)
-    printInerval = 5.
-    lastUpdate = time.monotonic()
+    # Telemetry that can't be published right now gets spooled, per broker
+    brokers = {}
+    for bname in amqs:
+        bkspool = spool.diskSpool(os.path.join(spooldir, bname))
+        brokers.update({bname: spool.spooledBroker(amqs[bname][0], bkspool)})
+        brokers[bname].start()
+
+    # Parsing and publishing the device replies happens in its own thread,
+    #   so it can't hold up talking to the devices
+    stage = pipeline.publishStage(maxsize=pubqueue, policy=pubpolicy,
+                                  spool=spool.diskSpool(
+                                      os.path.join(spooldir, 'replies')))
+    stage.start()
+
+    latency.tracker = latency.latencyTracker(floor=deadlinefloor,
+                                             ceiling=deadlineceiling,
+                                             path=latencyfile)
+
+    sched = None
+    pool = None
+    engine = None
+    manager = None
+
+    def housekeeping():
+        """
+        Check on our connections, and run anything that came in on the
+        command queue. Shared between the two runtimes.
+        """
+        nonlocal amqs, conn, allInsts
 
-    # Semi-infinite loop
-    while runner.halt is False:
         # Check on our connections
         amqs = amq.checkConnections(amqs, subscribe=True)
         # Make sure we update our hardcoded reference
         conn = amqs['broker-primary'][0]
+        for bname in brokers:
+            brokers[bname].rebind(amqs[bname][0])
+
+        # Hang on to the learned response times, every so often
+        latency.tracker.maybeSave()
 
         # Check for any updates to those actions, or any commanded
         #   actions in general
@@ -143,16 +213,86 @@ def main():
             print("Running %d items from the queue" % (len(queueActions)))
 
             # Process and deal with the things in the queue
-            allInsts = actions.queueProcessor(sched, queueActions, allInsts,
-                                              conn, queue)
+            allInsts = actions.queueProcessor(manager, queueActions, allInsts,
+                                              conn, queue, pool=pool,
+                                              engine=engine)
+
+    # Anything coming in over the broker, or a request to halt, will wake
+    #   up the main loop right away
+    actions.wakeOnSignals(amqlistener.wakeup)
+
+    # We need to make sure the connection to the broker is up first,
+    #   though, because we need to get the LOIS reply topics connected.
+    amqs = amq.checkConnections(amqs, subscribe=True)
+
+    if runtime == 'asyncio':
+        # This polls everything right away, and then keeps going until
+        #   runner.halt is set; that means the loop below is skipped
+        engine = aiopoll.pollEngine(allInsts, amqs, idbs, brokers=brokers,
+                                    stage=stage, debug=True)
+        # It takes the schedule changes that come in over the broker, too
+        manager = engine
+        engine.run(runner, housekeeping=housekeeping, hkinterval=maxnap,
+                   wakeup=amqlistener.wakeup)
+        print("Device sessions: %s" % (engine.report()))
+    else:
+        if nworkers > 0:
+            pool = jobpool.jobPool(nworkers=nworkers)
+
+        # Assemble our *initial* schedule of actions. This will be adjusted
+        #   by any inputs from the broker once we're in the main loop
+        sched = schedule.Scheduler()
+        sched = actions.scheduleInstruments(sched, allInsts,
+                                            amqs, idbs, pool=pool,
+                                            brokers=brokers, stage=stage,
+                                            debug=True)
+
+        # Before we start the main loop, query all the defined actions
+        #   once. This will help avoid triggering alerts/warnings/etc.
+        actions.runSweep(sched)
+
+        # Everything that changes the schedule from here on goes thru this
+        manager = actions.scheduleManager(sched, allInsts, amqs, idbs,
+                                          pool=pool, brokers=brokers,
+                                          stage=stage,
+                                          wakeup=amqlistener.wakeup,
+                                          debug=True)
+
+    # Interval for printing the diagnostic/debug/schedule information (in s)
+    printInerval = 5.
+    lastUpdate = time.monotonic()
+
+    # Semi-infinite loop
+    while runner.halt is False:
+        # Anything that comes in from here on will wake us right back up
+        amqlistener.wakeup.clear()
+
+        housekeeping()
+
+        # Any intervals that the adaptive rates changed since last time
+        manager.applyPending()
 
         # Check for any actions, and do them if it's their time
+        sched.run_pending()
+
         if (time.monotonic() - lastUpdate) > printInerval:
             print("Next scheduled items:")
-            sched.run_pending()
-            for job in sched.jobs:
-                remaining = (job.next_run - datetime.now()).total_seconds()
-                print("    %s in %f seconds" % (job.tags, remaining))
+            nextRuns = manager.nextRuns()
+            for tag in nextRuns:
+                print("    %s in %f seconds" % (tag, nextRuns[tag]))
+            print("Serial sessions: %s" % (serialcomm.sessionPool.report()))
+            if pool is not None:
+                print("Job pool: %s" % (pool.report()))
+            print("Publish stage: %s" % (stage.report()))
+            print("Database writer: %s" % (idbwriter.report()))
+            print("Adaptive rates: %s" % (adaptive.rates.report()))
+            print("Breakers: %s" % (breaker.breakers.report()))
+            print("Response times: %s" % (latency.tracker.report()))
+            print("Calibration: %s" % (calibration.report()))
+            print("Upfile pushes: %s" % (upload.report()))
+            for bname in brokers:
+                print("Broker %s spool: %s" %
+                      (bname, brokers[bname].spool.report()))
             lastUpdate = time.monotonic()
 
         # Diagnostic output
@@ -160,26 +300,40 @@ def main():
         # print("%d items still in the queue" % (nleft))
         # print("Done for now!")
 
-        # Consider taking a big nap
+        # Sleep until the next job is due, unless something comes in first
         if runner.halt is False:
-            # print("Starting a big sleep")
-            # Sleep for bigsleep, but in small chunks to check abort
-            for _ in range(bigsleep):
-                # Make sure we run any tasks here to keep things snappy
-                #   and moving along
-                sched.run_pending()
-
-                # Take a bit of a nap
-                time.sleep(0.25)
-                if runner.halt is True:
-                    break
+            nap = actions.timeToNextJob(sched, maxnap=maxnap)
+            amqlistener.wakeup.wait(nap)
 
     # The above loop is exited when someone sends SIGTERM
     print("PID %d is now out of here!" % (pid))
 
+    # Let any jobs that are running finish up
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+    # Publish whatever replies are still waiting
+    stage.stop()
+
+    # Push the last upfile(s) and close the sessions to wherever they go
+    upload.stopAll()
+
+    # Stop replaying anything spooled; it'll be picked up next time
+    for bname in brokers:
+        brokers[bname].stop()
+
     # Disconnect from all ActiveMQ brokers
     amq.disconnectAll(amqs)
 
+    # Close down any device sessions that were kept open
+    serialcomm.sessionPool.closeAll()
+
+    # Keep what we've learned about the devices for next time
+    latency.tracker.save()
+
+    # Write out anything that's still waiting to go to the databases
+    idbwriter.stop()
+
     # The PID file will have already been either deleted/overwritten by
     #   another function/process by this point, so just give back the
     #   console and return STDOUT and STDERR to their system defaults
@@ -1,9 +1,20 @@
 from . import actions
+from . import adaptive
+from . import aiopoll
+from . import breaker
+from . import calibration
+from . import dbwriter
 from . import devices
+from . import drivers
+from . import jobpool
 from . import lakeshore
+from . import latency
 from . import listener
 from . import mks_kjl
 from . import parsers
+from . import pipeline
 from . import publishers
 from . import serialcomm
+from . import spool
 from . import sunpower
+from . import upload
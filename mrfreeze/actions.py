@@ -15,17 +15,33 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+import copy
 import time
+import signal
 import functools
+import datetime as dt
+import threading
+from contextlib import nullcontext
 
 import serial
 import schedule
 
-from ligmos.utils import ssh
-
+from . import adaptive
+from . import breaker
 from . import devices
+from . import drivers
+from . import spool as spl
 from . import publishers as pubs
 from . import serialcomm as scomm
+from . import upload
+
+# The instrument compatibility objects are shared between all the devices
+#   on an instrument, which can now be published from different threads
+compatLock = threading.Lock()
+
+# (device tag, address) -> the stand-ins for the devices on a shared bus
+#   (see busMember)
+busMembers = {}
 
 
 def catch_exceptions(cancel_on_failure=False):
@@ -47,88 +63,239 @@ def catch_exceptions(cancel_on_failure=False):
 
 
 @catch_exceptions(cancel_on_failure=False)
-def cmd_serial(dvice, dbObj, bkObj, compat=None, debug=False):
+def cmd_serial(dvice, dbObj, bkObj, compat=None, stage=None, debug=False):
     """
     Define and route messages to/from serial attached devices
+
+    If stage (a pipeline.publishStage) is given, the replies are queued up
+    there to be published rather than being published right here.
     """
-    # Some quick defines:
-    # Supported Sunpower Cryocooler devices
-    sunpowerset = ['sunpowergen1', 'sunpowergen2']
+    # Go and get commands that are valid for the device, and what a
+    #   complete reply to each of them looks like so we don't have to
+    #   wait out the whole timeout for every single one. Things that
+    #   rarely change are only asked for every so often.
+    tag = deviceTag(dvice)
+    plan = devices.devicePlan(dvice)
+    msgs, framing = queryMessages(dvice, tag, plan)
+
+    # Now send the commands, unless the port's been dead lately
+    reply = guardedComm(dvice, msgs, framing, dbObj, bkObj, debug=debug)
+
+    # If it's really several devices on a bus, each gets its own replies
+    for member, mreply in splitReplies(dvice, reply):
+        mtag = deviceTag(member)
+
+        # Fill in the ones we didn't ask for this time
+        mreply = devices.lastKnown.merge(mtag, plan, mreply)
+
+        # Speed up or slow down the polling, if it's set up to do that
+        adaptive.rates.observe(mtag, deviceEndpoint(member), member, plan,
+                               mreply)
+
+        if stage is not None:
+            stage.put(member, mreply, dbObj, bkObj, compat=compat,
+                      debug=debug)
+        else:
+            routeReply(member, mreply, dbObj, bkObj, compat=compat,
+                       debug=debug)
 
-    # Supported Lake Shore devices
-    lsset = ['lakeshore218', 'lakeshore325']
 
-    # Supported Newport devices
-    newportset = ['newport_ithx', 'newport_isd-tc']
+def guardedComm(dvice, msgs, framing, dbObj, bkObj, debug=False):
+    """
+    deviceComm(), but behind the circuit breaker for the device's endpoint
+    (see breaker.py). Returns None if the breaker is open or the device
+    couldn't be reached, and publishes any change to the breaker's state.
+    """
+    endpoint = deviceEndpoint(dvice)
+    brk = breaker.breakers.get(endpoint)
 
-    # Go and get commands that are valid for the device
-    msgs = devices.defaultQueryCommands(device=dvice.devtype)
+    state, change = brk.check()
+    breakerChanged(dvice, endpoint, brk, change, dbObj, bkObj, debug=debug)
+    if state == 'open' or len(msgs) == 0:
+        return None
 
-    # Now send the commands
+    reply = None
     try:
-        # timeout is both the read and write timeout interval; hardcoded
-        #   here but it could be exposed someday/somehow if really needed
-        # Also - if port is given as -1, assume that the devhost property
-        #   is really a local serial port, and route it accordingly
-        if int(dvice.devport) != -1:
-            reply = scomm.serComm(dvice.devhost, dvice.devport,
-                                  msgs, timeout=1.00, debug=debug)
-        else:
-            # Bundle up the serial parameters; if it's empty, it'll
-            #   try 4800,8,N,1 so use that as a shortcut
-            sParams = {}
-            reply = scomm.serLocalComm(dvice.devhost, msgs, sParams,
-                                       timeout=1.00, debug=debug)
+        if state == 'halfopen':
+            # Just one quick command to see if anyone's home
+            probe, pframing, msgs, framing = breaker.probeSplit(msgs,
+                                                                framing)
+            reply = deviceComm(dvice, probe, framing=pframing,
+                               timeout=breaker.probeTimeout,
+                               cap=breaker.probeTimeout, debug=debug)
+            if breaker.replied(reply) is False:
+                msgs = {}
+
+        if len(msgs) > 0:
+            rest = deviceComm(dvice, msgs, framing=framing, debug=debug)
+            if reply is None:
+                reply = rest
+            else:
+                reply.update(rest)
     except serial.SerialException as err:
         print("Badness 10000")
         print(str(err))
         reply = None
+    except Exception:
+        # Still counts, or a probe would never be let through again
+        breakerChanged(dvice, endpoint, brk, brk.record(False),
+                       dbObj, bkObj, debug=debug)
+        raise
+
+    ok = breaker.replied(reply)
+    change = brk.record(ok)
+    breakerChanged(dvice, endpoint, brk, change, dbObj, bkObj, debug=debug)
+    if ok is False:
+        reply = None
+
+    return reply
+
+
+def breakerChanged(dvice, endpoint, brk, change, dbObj, bkObj, debug=False):
+    """
+    Announce a change (if any) in the state of the breaker brk for
+    endpoint, along with the device that noticed it
+    """
+    if change is None:
+        return
+
+    print("Breaker for %s:%s is now %s (was %s)" % (endpoint[0], endpoint[1],
+                                                   change[1], change[0]))
+    try:
+        pubs.publish_Breaker(dvice, endpoint, change, brk.report(),
+                             db=dbObj, broker=bkObj, debug=debug)
+    except Exception as err:
+        print("Unable to publish the breaker state!")
+        print(str(err))
+
+
+def deviceComm(dvice, msgs, framing=None, timeout=1.00, cap=None,
+               debug=False):
+    """
+    Send the commands in msgs to the device over its (pooled) session, and
+    return the replies; see serialcomm.serComm().
+    """
+    # timeout is both the read and write timeout interval; it's only
+    #   ever shorter for the breaker's probes (see guardedComm).
+    #   With the framing, each reply gets a deadline learned from how
+    #   long it usually takes instead (see latency.py), which can be
+    #   longer unless cap says otherwise.
+    # Also - if port is given as -1, assume that the devhost property
+    #   is really a local serial port, and route it accordingly
+    if int(dvice.devport) != -1:
+        reply = scomm.serComm(dvice.devhost, dvice.devport,
+                              msgs, timeout=timeout, debug=debug,
+                              framing=framing, device=deviceTag(dvice),
+                              cap=cap)
+    else:
+        # Bundle up the serial parameters; if it's empty, it'll
+        #   try 4800,8,N,1 so use that as a shortcut
+        sParams = {}
+        driver = drivers.getDriver(dvice.devtype)
+        if driver is not None:
+            sParams = driver.sParams
+        reply = scomm.serLocalComm(dvice.devhost, msgs, sParams,
+                                   timeout=timeout, debug=debug,
+                                   framing=framing, device=deviceTag(dvice),
+                                   cap=cap)
+
+    return reply
+
+
+@catch_exceptions(cancel_on_failure=False)
+def cmd_remote(dvice, cmds, request, conn, replytopic, treceived,
+               engine=None, debug=False):
+    """
+    Send the device commands from a remote API request (as made by
+    devices.translateRemoteAPI) to the device, and publish what came back
+    to replytopic along with the request's cmd_id and how long it took.
+
+    request is the action from the command queue. treceived is the
+    time.monotonic() when it was taken off of the queue, and engine
+    is the aiopoll.pollEngine to send it through, if that's the runtime.
+    """
+    framing = devices.replyFraming(dvice.devtype, cmds)
+
+    t0 = time.monotonic()
+    try:
+        if engine is not None:
+            reply = engine.command(dvice, cmds, framing=framing)
+        else:
+            reply = deviceComm(dvice, cmds, framing=framing, debug=debug)
+        status = "OK"
+    except Exception as err:
+        print("Badness 10000")
+        print(str(err))
+        reply = None
+        status = "Failed"
+    texec = time.monotonic() - t0
+
+    # Whatever it was might've changed something that's usually only asked
+    #   for every so often, so make sure it's asked for on the next poll
+    devices.lastKnown.invalidate(deviceTag(dvice))
+
+    fields = {}
+    if reply is not None:
+        try:
+            fields, _ = devices.devicePlan(dvice).parse(reply)
+        except Exception as err:
+            print("Unable to parse response to command %s!" %
+                  (request['request_command']))
+            print(str(err))
+            status = "Unparsed"
+
+    latency = time.monotonic() - treceived
+    print("Command %s for %s took %.3f s (%.3f s at the device)" %
+          (request['request_command'], deviceTag(dvice), latency, texec))
+
+    pak = pubs.constructCommandReply(request, status, fields, latency, texec,
+                                     debug=debug)
+    if conn is not None and pak is not None:
+        conn.publish(replytopic, pak)
+
+
+def routeReply(dvice, reply, dbObj, bkObj, compat=None, debug=False):
+    """
+    Parse and publish the replies from a device, as returned by
+    serialcomm.serComm(), to wherever the device says they should go.
+
+    Split out from cmd_serial so that it can be shared by the different
+    ways of actually talking to the devices (see aiopoll).
+    """
+    # Only need to hold the lock if there's a shared compat object
+    if compat is not None:
+        lock = compatLock
+    else:
+        lock = nullcontext()
 
     try:
         if reply is not None:
-            if dvice.devtype.lower() == 'vactransducer_mks972b':
-                compat = pubs.publish_MKS972b(dvice, reply,
-                                              db=dbObj, broker=bkObj,
-                                              compat=compat, debug=debug)
-            elif dvice.devtype.lower() in sunpowerset:
-                compat = pubs.publish_Sunpower(dvice, reply,
-                                               db=dbObj, broker=bkObj,
-                                               compat=compat, debug=debug)
-            elif dvice.devtype.lower() in lsset:
-                compat = pubs.publish_LSThing(dvice, reply,
-                                              db=dbObj, broker=bkObj,
-                                              compat=compat, debug=debug)
-            elif dvice.devtype.lower() in newportset:
-                compat = pubs.publish_Newport(dvice, reply,
-                                              db=dbObj, broker=bkObj,
-                                              compat=compat, debug=debug)
-            if compat is not None:
-                # THIS IS A TOTAL HACK FOR NIHTS AND LOIS
-                upf = compat.makeNIHTSUpfile()
-                print(upf)
-                # Now push the upfile out to the place it needs to be
-                with open(compat.params['upfnme'], "w") as f:
-                    f.write(upf)
-
-                # Potential failure point here if NIHTS (the server) is
-                #   offline, I think?  Needs checking, likely a bug here.
-                sshNIHTS = ssh.SSHWrapper(host=compat.params['host'],
-                                          username=compat.params['user'],
-                                          password=compat.params['pw'])
-
-                sshNIHTS.openSFTP()
-                lloc = "./%s" % (compat.params['upfnme'])
-                rloc = "%s/%s" % (compat.params['upfloc'],
-                                  compat.params['upfnme'])
-                sshNIHTS.putFile(lloc, rloc)
-                sshNIHTS.closeSFTP()
-                sshNIHTS.closeConnection()
+            driver = drivers.getDriver(dvice.devtype)
+            with lock:
+                if driver is not None:
+                    compat = driver.publish(dvice, reply,
+                                            db=dbObj, broker=bkObj,
+                                            compat=compat, debug=debug)
+                if compat is not None:
+                    pushUpfile(compat)
     except Exception as err:
         print("Unable to parse instrument response!")
         print(dvice.__dict__, reply)
         print(str(err))
 
 
+def pushUpfile(compat):
+    """
+    THIS IS A TOTAL HACK FOR NIHTS AND LOIS
+
+    Called with compatLock held. The upfile is made (at most once per
+    window, with all the sections that were updated in the meantime) and
+    pushed in the background over a session that's kept open (see
+    upload.py), so this doesn't wait on NIHTS (the server).
+    """
+    upload.getCoalescer(compat, compatLock).poke()
+
+
 @catch_exceptions(cancel_on_failure=False)
 def cmd_loisgettemp(dvice, bkObj):
     """
@@ -158,95 +325,380 @@ def cmd_loisinitchk(dvice, bkObj):
     bkObj.publish(dvice.devbrokercmd, cmd)
 
 
-def scheduleInstruments(sched, allInsts, amqs, idbs, debug=False):
+def deviceConnections(dvice, amqs, idbs, brokers=None):
     """
+    Return the database and broker connection objects that the device
+    is configured to use, or None for either if they're not around.
+
+    brokers is an optional dict of spool.spooledBroker objects by broker
+    name, which are used in place of the bare connection where given.
     """
-    # Scheduling of individual devices happens fast, so all the actions
-    #   will be piled up in scheduled time.  Offset them by a small amount to
-    #   account for the actual time needed to send/process the reply and
-    #   then move on to the next scheduled action!
-    temporalOffset = 5
+    # Get our specific database connection object
+    try:
+        dbObj = idbs[dvice.database]
+    except KeyError:
+        dbObj = None
+
+    # Now try to get our broker connection object
+    try:
+        # [1] is the listener, and we don't need that here
+        bkObj = amqs[dvice.broker][0]
+    except KeyError:
+        bkObj = None
+
+    if brokers is not None and dvice.broker in brokers:
+        bkObj = brokers[dvice.broker]
+
+    return dbObj, bkObj
+
+
+def unspooled(bkObj):
+    """
+    The bare broker connection, for things like commands to LOIS which
+    are pointless to send some time later on.
+    """
+    if isinstance(bkObj, spl.spooledBroker):
+        bkObj = bkObj.broker
+
+    return bkObj
+
+
+def instrumentCompat(allInsts, inst):
+    """
+    This makes sure we have a reference to the base-level instrument
+    compatibility file in each specific device file.
+    This could (and should) be cleaned up to be less convoluted!
+    """
+    try:
+        compat = allInsts[inst]['compatibility']
+    except KeyError:
+        # I *think* keyerror is the right one to catch?
+        compat = None
+
+    return compat
+
+
+def poolWrap(pool, func, dvice, schedTag):
+    """
+    If there's a pool, return func wrapped so that calling it submits it to
+    the pool keyed on the device's endpoint; otherwise just return func.
+    """
+    if pool is None:
+        return func
+    else:
+        return pool.wrap(func, functools.partial(deviceEndpoint, dvice),
+                         tag=schedTag)
+
+
+def deviceTag(dvice):
+    """
+    instrument+devtype(+extratag), which is what the scheduled jobs for
+    the device are tagged with.
+    """
+    tag = "%s+%s" % (dvice.instrument, dvice.devtype)
+    if dvice.extratag is not None:
+        tag += "+%s" % (dvice.extratag)
+
+    return tag
+
+
+def busAddresses(dvice):
+    """
+    The addresses of the devices on the serial bus that dvice is standing
+    in for, as given by its (optional) devaddress setting, or None if it's
+    just the one device (or its driver can't share a bus).
+    """
+    addresses = getattr(dvice, "devaddress", None)
+    if addresses is None or str(addresses).lower() in ["", "none"]:
+        return None
 
+    driver = drivers.getDriver(dvice.devtype)
+    if driver is None or driver.busCapable() is False:
+        print("%s can't share a bus! Ignoring its devaddress." %
+              (dvice.devtype))
+        return None
+
+    try:
+        return [int(a) for a in str(addresses).split(",")]
+    except ValueError:
+        print("Bad devaddress for %s: %s" % (deviceTag(dvice), addresses))
+        return None
+
+
+def busMember(dvice, address):
+    """
+    Stand-in for the device at address on the bus that dvice is polling;
+    it's the same in every way except its extratag gets the address, so
+    it's published and cached as a device of its own.
+    """
+    key = (deviceTag(dvice), address)
+    try:
+        return busMembers[key]
+    except KeyError:
+        pass
+
+    member = copy.copy(dvice)
+    member.devaddress = None
+    if dvice.extratag is None:
+        member.extratag = "%03d" % (address)
+    else:
+        member.extratag = "%s-%03d" % (dvice.extratag, address)
+    member.busaddress = address
+
+    return busMembers.setdefault(key, member)
+
+
+def queryMessages(dvice, tag, plan):
+    """
+    The default queries (and their framing) to send to dvice this time;
+    that's all of the queries for each address if it's a bus, otherwise
+    whatever's due (see devices.lastKnownCache.select)
+    """
+    addresses = busAddresses(dvice)
+    if addresses is None:
+        return devices.lastKnown.select(tag, plan)
+
+    msgs = drivers.getDriver(dvice.devtype).busQueries(addresses)
+    framing = {}
+    for key in msgs:
+        qkey = key.split("/", 1)[1]
+        if qkey in plan.framing:
+            framing.update({key: plan.framing[qkey]})
+
+    return msgs, framing
+
+
+def splitReplies(dvice, reply):
+    """
+    List of (device, replies) for the replies from dvice; that's just
+    dvice and reply, unless it's a bus, in which case they're sorted out
+    by the address that each device answered with.
+    """
+    addresses = busAddresses(dvice)
+    if addresses is None:
+        return [(dvice, reply)]
+
+    byAddress = {}
+    if reply is not None:
+        byAddress = drivers.getDriver(dvice.devtype).demux(reply)
+
+    split = []
+    for addr in addresses:
+        split.append((busMember(dvice, addr), byAddress.pop(addr, None)))
+
+    for addr in byAddress:
+        print("Reply from unexpected address %03d on %s! Ignoring it." %
+              (addr, deviceTag(dvice)))
+
+    return split
+
+
+def deviceEndpoint(dvice):
+    """
+    The (host, port) that the device is talked to over, which is also what
+    jobs get serialized on when they're run in a jobpool.jobPool.
+    Broker-only devices don't have one so they're keyed on themselves.
+    """
+    if dvice.devtype.lower() in ['arc-loisgettemp', 'arc-loisinitcheck']:
+        key = ("broker", dvice.instrument, dvice.devtype)
+    else:
+        key = (dvice.devhost, int(dvice.devport))
+
+    return key
+
+
+def scheduleInstruments(sched, allInsts, amqs, idbs, pool=None,
+                        brokers=None, stage=None, debug=False):
+    """
+    Schedule all the enabled devices in allInsts.
+
+    If pool (a jobpool.jobPool) is given, the scheduler only submits the
+    jobs to it, and they actually run in its worker threads; otherwise
+    they run right in sched.run_pending() like they always have.
+
+    brokers is passed along to deviceConnections(), and stage to
+    cmd_serial().
+    """
     # Loop thru the different instrument sets
     for inst in allInsts:
-        try:
-            # This makes sure we have a reference to the base-level instrument
-            #   compatibility file in each specific device file.
-            # This could (and should) be cleaned up to be less convoluted!
-            compat = allInsts[inst]['compatibility']
-        except KeyError:
-            # I *think* keyerror is the right one to catch?
-            compat = None
+        compat = instrumentCompat(allInsts, inst)
 
         for dtag in allInsts[inst]:
             dvice = allInsts[inst][dtag]
 
             # Check to make sure this device's query is actually set as enabled
             if dvice.enabled is True and dvice.devtype != "upfile":
-                if debug is True:
-                    print("Scheduling %s+%s+%s" % (dvice.instrument,
-                                                   dvice.devtype,
-                                                   dvice.extratag))
-
-                # Set up some easy-access things for the scheduler
-                #   schedTags *must* be hashable, so it can't be a list.
-                #   Make it specific so it can be sensibly cancelled
-                schedTag = "%s+%s" % (dvice.instrument, dvice.devtype)
-                if dvice.extratag is not None:
-                    schedTag += "+%s" % (dvice.extratag)
-
-                interval = int(dvice.queryinterval)
-
-                # Get our specific database connection object
-                try:
-                    dbObj = idbs[dvice.database]
-                except KeyError:
-                    dbObj = None
-
-                # Now try to get our broker connection object
-                try:
-                    # [1] is the listener, and we don't need that here
-                    bkObj = amqs[dvice.broker][0]
-                except KeyError:
-                    bkObj = None
-
-                # SPECIAL handling for this one, since it's not a serial
-                #   device but a broker command topic
-                if dvice.devtype.lower() == 'arc-loisgettemp':
-                    print("Scheduling 'gettemp' for %s every %d sec" %
-                          (dvice.instrument, interval))
-                    sched.every(interval).seconds.do(cmd_loisgettemp,
-                                                     dvice,
-                                                     bkObj).tag(schedTag)
-                elif dvice.devtype.lower() == 'arc-loisinitcheck':
-                    print("Scheduling 'lois_status any' for %s every %d sec" %
-                          (dvice.instrument, interval))
-                    sched.every(interval).seconds.do(cmd_loisinitchk,
-                                                     dvice,
-                                                     bkObj).tag(schedTag)
-                else:
-                    print("Scheduling '%s' for %s every %d sec" %
-                          (dvice.devtype, dvice.instrument, interval))
-                    sched.every(interval).seconds.do(cmd_serial,
-                                                     dvice, dbObj, bkObj,
-                                                     compat=compat,
-                                                     debug=debug).tag(schedTag)
-
-                # If we're in here, we scheduled an action. Pause so they
-                #   don't stack up too close. Do it in *here* rather than
-                #   the main dvice loop to ignore disabled devices!
-                time.sleep(temporalOffset)
+                scheduleDevice(sched, dvice, compat, amqs, idbs, pool=pool,
+                               brokers=brokers, stage=stage, debug=debug)
             else:
                 print("Device %s is disabled! Skipping it." % (dvice.devtype))
 
+    # Scheduling of individual devices happens fast, so all the actions
+    #   would be piled up in scheduled time. Spread them out instead.
+    spreadPhases(sched)
+
     return sched
 
 
-def queueProcessor(sched, queueActions, allInsts, conn, queue):
+def scheduleDevice(sched, dvice, compat, amqs, idbs, pool=None,
+                   brokers=None, stage=None, debug=False):
+    """
+    Schedule the queries of a single device, whether it's enabled or not,
+    and return the schedule.Job; see scheduleInstruments().
+    """
+    if debug is True:
+        print("Scheduling %s+%s+%s" % (dvice.instrument,
+                                       dvice.devtype,
+                                       dvice.extratag))
+
+    # Set up some easy-access things for the scheduler
+    #   schedTags *must* be hashable, so it can't be a list.
+    #   Make it specific so it can be sensibly cancelled
+    schedTag = deviceTag(dvice)
+
+    interval = int(dvice.queryinterval)
+
+    # Get our specific database and broker connection objects
+    dbObj, bkObj = deviceConnections(dvice, amqs, idbs, brokers=brokers)
+
+    # SPECIAL handling for this one, since it's not a serial
+    #   device but a broker command topic
+    if dvice.devtype.lower() == 'arc-loisgettemp':
+        print("Scheduling 'gettemp' for %s every %d sec" %
+              (dvice.instrument, interval))
+        job = poolWrap(pool, cmd_loisgettemp, dvice, schedTag)
+        sjob = sched.every(interval).seconds.do(job, dvice,
+                                                unspooled(bkObj))
+    elif dvice.devtype.lower() == 'arc-loisinitcheck':
+        print("Scheduling 'lois_status any' for %s every %d sec" %
+              (dvice.instrument, interval))
+        job = poolWrap(pool, cmd_loisinitchk, dvice, schedTag)
+        sjob = sched.every(interval).seconds.do(job, dvice,
+                                                unspooled(bkObj))
+    else:
+        print("Scheduling '%s' for %s every %d sec" %
+              (dvice.devtype, dvice.instrument, interval))
+        job = poolWrap(pool, cmd_serial, dvice, schedTag)
+        sjob = sched.every(interval).seconds.do(job, dvice, dbObj, bkObj,
+                                                compat=compat, stage=stage,
+                                                debug=debug)
+        if stage is not None:
+            stage.register(dvice, dbObj, bkObj, compat=compat, debug=debug)
+
+    return sjob.tag(schedTag)
+
+
+def spreadPhases(sched):
+    """
+    Spread the next run of the jobs that share an interval evenly across
+    that interval, rather than having them all come due at once.
+
+    The scheduler reschedules each job an interval after it last ran, so
+    the spacing set here carries over to all the runs that follow.
+    """
+    groups = {}
+    for job in sched.jobs:
+        groups.setdefault(job.interval, []).append(job)
+
+    now = dt.datetime.now()
+    for interval in groups:
+        jobs = groups[interval]
+        for i, job in enumerate(jobs):
+            offset = interval*(i + 1)/len(jobs)
+            job.next_run = now + dt.timedelta(seconds=offset)
+
+
+def runSweep(sched):
+    """
+    Run every scheduled job once, right now, without changing when they're
+    next scheduled to run; used to query everything at startup.
+
+    If the jobs were scheduled with a jobpool.jobPool this just submits
+    them, so the sweep runs concurrently across ports and this returns
+    right away.
+    """
+    for job in sched.jobs:
+        job.job_func()
+
+
+def timeToNextJob(sched, maxnap=5.):
+    """
+    Seconds until the next scheduled job is due, but no more than maxnap
+    (and maxnap if there's no schedule or nothing on it).
     """
+    nap = maxnap
+    if sched is not None:
+        idle = sched.idle_seconds
+        if idle is not None:
+            nap = min(max(idle, 0.), maxnap)
+
+    return nap
+
+
+def wakeOnSignals(event, signums=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Chain onto the existing handlers for the given signals so that they
+    also set 'event'. Otherwise a main loop sleeping on event.wait() won't
+    notice that it's been told to halt until the wait times out.
+    """
+    def chainer(previous):
+        def handler(signum, frame):
+            if callable(previous):
+                previous(signum, frame)
+            event.set()
+        return handler
+
+    for signum in signums:
+        signal.signal(signum, chainer(signal.getsignal(signum)))
+
+
+def findDevice(allInsts, inst, devtype, tag=None):
+    """
+    Return the configured device on instrument inst with the given devtype
+    and extratag, or None if there isn't one. Case doesn't matter.
+    """
+    if inst is None or devtype is None:
+        return None
+
+    for iname in allInsts:
+        if iname.lower() != inst.lower():
+            continue
+
+        for dtag in allInsts[iname]:
+            dvice = allInsts[iname][dtag]
+            # Skip things like the compatibility objects
+            if not hasattr(dvice, 'devtype'):
+                continue
+
+            if dvice.devtype.lower() == devtype.lower():
+                if tag is None and dvice.extratag is None:
+                    return dvice
+                elif tag is not None and dvice.extratag is not None and \
+                        tag.lower() == dvice.extratag.lower():
+                    return dvice
+
+    return None
+
+
+def queueProcessor(manager, queueActions, allInsts, conn, queue, pool=None,
+                   engine=None):
+    """
+    Carry out the commands that came in over the broker.
+
+    Changes to whether and how often a device is queried, or where it is,
+    take effect in the schedule right away through manager
+    (a scheduleManager or aiopoll.pollEngine; see scheduleManipulation()).
+
+    Anything for the devices themselves (see devices.translateRemoteAPI)
+    goes out over the device's usual session; if there's a pool
+    (a jobpool.jobPool) it's expedited there so it goes ahead of any polls
+    waiting on the same port, or if there's an engine (an
+    aiopoll.pollEngine) it goes through that instead.
     """
     # Do some stuff!
     for action in queueActions:
+        treceived = time.monotonic()
+
         # Parse the incoming action by hand since it's a simple deal
         #   If the schema worked as it should, all of these will exist.
         ainst = action['request_instrument']
@@ -271,64 +723,274 @@ def queueProcessor(sched, queueActions, allInsts, conn, queue):
 
             # Check to see if this destination is one we actually
             #   know anything about
-            try:
-                selInst = allInsts[ainst][cdest]
-            except AttributeError:
+            selInst = findDevice(allInsts, ainst, adevc, tag=atag)
+            if selInst is None:
                 print("WARNING: Command %s ignored!" % (acmd))
                 print("Unknown instrument %s" % (cdest))
-                selInst = None
 
             print(selInst)
 
             # Now check the actual command
             if selInst is not None:
-                schedTag = "%s+%s" % (ainst, adevc)
-                if atag is not None:
-                    schedTag += "+%s" % (atag)
+                schedTag = deviceTag(selInst)
                 if acmd.lower() == "queryenable":
                     print("Enabling %s %s" % (ainst, cdest.lower()))
-                    selInst.enabled = True
-                    # Schedule this instrument
+                    scheduleManipulation(manager, selInst, action='enable')
 
                 elif acmd.lower() == "querydisable":
                     print("Disabling %s %s" % (ainst, cdest.lower()))
-                    selInst.enabled = False
-                    # Remove this instrument from the schedule if it's there
+                    scheduleManipulation(manager, selInst, action='disable')
+
+                elif acmd.lower() == "queryinterval":
+                    print("Setting query interval to %s" % (aarg))
+                    try:
+                        scheduleManipulation(manager, selInst,
+                                             action='interval', value=aarg)
+                    except (TypeError, ValueError):
+                        print("Bad query interval %s!" % (aarg))
 
                 elif acmd.lower() == "devicehost":
                     print("Setting device host to %s" % (aarg))
+                    oldEndpoint = deviceEndpoint(selInst)
                     selInst.devhost = aarg
-                    # Cancel this instrument from the schedule if it's there,
-                    #   then reschedule it
+                    # Close the old session and query it at the new place
+                    scheduleManipulation(manager, selInst,
+                                         action='reschedule',
+                                         value=oldEndpoint)
 
                 elif acmd.lower() == "deviceport":
                     print("Setting device port to %s" % (aarg))
+                    oldEndpoint = deviceEndpoint(selInst)
                     selInst.devport = aarg
-                    # Cancel this instrument from the schedule if it's there,
-                    #   then reschedule it
+                    # Close the old session and query it at the new place
+                    scheduleManipulation(manager, selInst,
+                                         action='reschedule',
+                                         value=oldEndpoint)
 
                 else:
                     # Check to see if the command is in the remoteAPI
                     #   that we defined for the devices
                     # https://github.com/LowellObservatory/MrFreeze/issues/8
-                    pass
-
-                # Now store this instrument back in the main set,
-                #   so we can use any updates that just happened
-                allInsts[ainst][cdest] = selInst
+                    cmds = devices.translateRemoteAPI(selInst, acmd,
+                                                      value=aarg)
+                    if cmds != {}:
+                        print("Sending %s to %s" % (cmds, schedTag))
+                        args = (selInst, cmds, action, conn,
+                                queue.replytopic, treceived)
+                        if pool is not None and engine is None:
+                            pool.expedite(deviceEndpoint(selInst), None,
+                                          cmd_remote, *args)
+                        else:
+                            cmd_remote(*args, engine=engine)
+                    else:
+                        pak = pubs.constructCommandReply(action, "Unknown",
+                                                         {}, 0., 0.)
+                        conn.publish(queue.replytopic, pak)
 
     return allInsts
 
 
-def scheduleManipulation(sched, tag, action=None):
+class scheduleManager():
+    """
+    Changes to the schedule of the devices while it's running, via an
+    index of the scheduled jobs by their tag (see deviceTag()) so nothing
+    has to go hunting through sched.jobs.
+
+    A disabled device keeps its job, but it's pushed off to the end of
+    time rather than removed from the scheduler's list; enabling it again
+    (or scheduling it for the first time, if it was disabled from the
+    start) has it queried right away. None of it touches when any of the
+    other jobs are due.
+
+    The changes that adaptive.rates makes to the intervals come in from
+    the job pool's threads, so they're only queued up by adapt() and made
+    by applyPending() in the main thread, in between sched.run_pending().
+    wakeup (a threading.Event), if given, is set when one is queued so the
+    main loop gets to it right away.
+
+    The rest of the arguments are the same as scheduleInstruments(), and
+    are kept for scheduling the devices that weren't to begin with.
     """
+    # Next run for a disabled job
+    never = dt.datetime.max
+
+    def __init__(self, sched, allInsts, amqs, idbs, pool=None, brokers=None,
+                 stage=None, wakeup=None, debug=False):
+        self.sched = sched
+        self.allInsts = allInsts
+        self.amqs = amqs
+        self.idbs = idbs
+        self.pool = pool
+        self.brokers = brokers
+        self.stage = stage
+        self.wakeup = wakeup
+        self.debug = debug
+
+        self.lock = threading.Lock()
+
+        # device tag -> (device, interval) from adapt(), not yet applied
+        self.pending = {}
+
+        # schedTag -> schedule.Job, built once from what's already there
+        self.jobs = {}
+        for job in sched.jobs:
+            for tag in job.tags:
+                self.jobs.update({tag: job})
+
+        # Adaptive devices change their own intervals as they go
+        adaptive.rates.apply = self.adapt
+
+    def _job(self, dvice):
+        """
+        """
+        return self.jobs.get(deviceTag(dvice), None)
+
+    def enable(self, dvice):
+        """
+        """
+        with self.lock:
+            dvice.enabled = True
+            job = self._job(dvice)
+            if job is None:
+                compat = instrumentCompat(self.allInsts, dvice.instrument)
+                job = scheduleDevice(self.sched, dvice, compat,
+                                     self.amqs, self.idbs, pool=self.pool,
+                                     brokers=self.brokers, stage=self.stage,
+                                     debug=self.debug)
+                self.jobs.update({deviceTag(dvice): job})
+                job.next_run = dt.datetime.now()
+            elif job.next_run == self.never:
+                job.next_run = dt.datetime.now()
+
+    def disable(self, dvice):
+        """
+        """
+        with self.lock:
+            dvice.enabled = False
+            job = self._job(dvice)
+            if job is not None:
+                job.next_run = self.never
+
+    def reschedule(self, dvice, oldEndpoint=None):
+        """
+        Query the device again right away (if it's enabled), say after it's
+        been moved to a different host or port; oldEndpoint is where it
+        used to be, so any session that's still open to it is closed.
+        """
+        if oldEndpoint is not None and oldEndpoint != deviceEndpoint(dvice):
+            scomm.sessionPool.drop(oldEndpoint)
+            breaker.breakers.reset(oldEndpoint)
+
+        # Nothing remembered from the old place is any good now
+        devices.lastKnown.invalidate(deviceTag(dvice))
+
+        with self.lock:
+            job = self._job(dvice)
+            if job is not None and job.next_run != self.never:
+                job.next_run = dt.datetime.now()
+
+    def setInterval(self, dvice, interval):
+        """
+        Change how often the device is queried, keeping its phase; the next
+        query is the new interval after the last one (or right away if
+        that's already passed).
+        """
+        interval = int(interval)
+        with self.lock:
+            dvice.queryinterval = interval
+            self.pending.pop(deviceTag(dvice), None)
+            self._retime(self._job(dvice), interval)
+
+        # It was asked for, so don't let the adaptive rates undo it
+        adaptive.rates.reset(deviceTag(dvice), dvice)
+
+    def adapt(self, dvice, interval):
+        """
+        Same as setInterval(), but for a (temporary) effective interval as
+        given by adaptive.rates; the configured one stays as it is.
+
+        It can be called from any thread, and is only queued up here;
+        applyPending() makes the change.
+        """
+        with self.lock:
+            self.pending.update({deviceTag(dvice): (dvice, interval)})
+
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def applyPending(self):
+        """
+        Make the changes queued up by adapt(); only call this from the
+        thread that runs sched.run_pending()
+        """
+        with self.lock:
+            for tag in self.pending:
+                dvice, interval = self.pending[tag]
+                self._retime(self._job(dvice), interval)
+            self.pending = {}
+
+    def _retime(self, job, interval):
+        """
+        """
+        if job is not None:
+            job.interval = interval
+            job.period = dt.timedelta(seconds=interval)
+            if job.next_run != self.never:
+                last = job.last_run
+                if last is None:
+                    last = dt.datetime.now()
+                job.next_run = max(last + job.period, dt.datetime.now())
+
+    def enabled(self, tag):
+        """
+        """
+        job = self.jobs.get(tag, None)
+
+        return job is not None and job.next_run != self.never
+
+    def nextRuns(self):
+        """
+        Seconds until each enabled job is next due, by tag
+        """
+        now = dt.datetime.now()
+        with self.lock:
+            return {tag: (self.jobs[tag].next_run - now).total_seconds()
+                    for tag in self.jobs if self.enabled(tag)}
+
+
+def scheduleManipulation(manager, dvice, action=None, value=None):
     """
+    Make a change to the schedule of dvice through manager
+    (a scheduleManager, or the aiopoll.pollEngine that keeps the schedule
+    of the asyncio runtime): 'enable', 'disable', 'reschedule', or
+    'interval' (with the new interval in seconds as value).
+
+    Without a manager only the device itself is changed.
+    """
+    if manager is None:
+        if action is not None and action.lower() == 'enable':
+            dvice.enabled = True
+        elif action is not None and action.lower() == 'disable':
+            dvice.enabled = False
+        elif action is not None and action.lower() == 'reschedule':
+            if value is not None and value != deviceEndpoint(dvice):
+                scomm.sessionPool.drop(value)
+                breaker.breakers.reset(value)
+            devices.lastKnown.invalidate(deviceTag(dvice))
+        else:
+            print("No schedule to change!")
+        return
+
     if action is None:
         print("No change to the schedule was requested!")
     else:
         if action.lower() == 'enable':
-            pass
+            manager.enable(dvice)
         elif action.lower() == 'disable':
-            pass
+            manager.disable(dvice)
         elif action.lower() == 'reschedule':
-            pass
+            manager.reschedule(dvice, oldEndpoint=value)
+        elif action.lower() == 'interval':
+            manager.setInterval(dvice, value)
+        else:
+            print("Unknown schedule change %s!" % (action))
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Adaptive polling intervals, driven by how fast things are changing.
+
+A device opts in with a few extra (optional) settings in its config
+section:
+
+    adaptfields=ColdTipTemp         (fields to watch, comma separated)
+    adaptrate=0.5                   (change per minute that counts as fast)
+    minqueryinterval=5
+    maxqueryinterval=120
+
+While any of the watched fields is changing faster than adaptrate the
+device's effective interval is halved, down to minqueryinterval; once
+they've all settled down to less than half of that it's stretched back
+out a bit at a time, up to maxqueryinterval. queryinterval is where it
+starts. Devices without adaptfields just keep their queryinterval.
+
+Setting queryinterval over the broker starts the device over from there,
+so the operator gets what they asked for rather than whatever it had
+adapted to; minqueryinterval and maxqueryinterval are stretched to fit
+the new interval if they have to be.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import threading
+
+# Thresholds relative to adaptrate; the gap between them keeps the
+#   interval from flapping back and forth when it's right on the edge
+tightenAt = 1.
+relaxBelow = 0.5
+
+# Steps to take when tightening and relaxing the interval
+tightenBy = 0.5
+relaxBy = 1.25
+
+
+def deviceSettings(dvice):
+    """
+    The adaptive settings for dvice as (fields, rate, minInterval,
+    maxInterval), or None if it doesn't have any (or they're bad).
+    """
+    fields = getattr(dvice, "adaptfields", None)
+    if fields is None or str(fields).lower() in ["", "none"]:
+        return None
+
+    fields = [f.strip() for f in str(fields).split(",") if f.strip() != ""]
+
+    try:
+        interval = float(dvice.queryinterval)
+        rate = float(getattr(dvice, "adaptrate", 1.))
+        minInterval = float(getattr(dvice, "minqueryinterval", interval))
+        maxInterval = float(getattr(dvice, "maxqueryinterval", interval))
+    except (TypeError, ValueError) as err:
+        print("Bad adaptive settings for %s! %s" % (dvice.devtype, str(err)))
+        return None
+
+    if rate <= 0. or minInterval <= 0. or minInterval > maxInterval:
+        print("Bad adaptive settings for %s! Ignoring them." %
+              (dvice.devtype))
+        return None
+
+    return fields, rate, minInterval, maxInterval
+
+
+class adaptiveState():
+    """
+    Effective interval of one device, and what it was last seen doing
+    """
+    def __init__(self, fields, rate, minInterval, maxInterval, interval):
+        self.fields = fields
+        self.rate = rate
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.interval = min(max(interval, minInterval), maxInterval)
+
+        self.last = {}
+        self.lastTime = None
+        self.lastRate = 0.
+
+    def update(self, values, now):
+        """
+        Take in the latest values of the watched fields (at monotonic time
+        now) and return the new effective interval.
+        """
+        if self.lastTime is not None and now > self.lastTime:
+            elapsed = (now - self.lastTime)/60.
+            changes = [abs(values[f] - self.last[f])/elapsed
+                       for f in values if f in self.last]
+            if len(changes) > 0:
+                self.lastRate = max(changes)
+
+                if self.lastRate >= tightenAt*self.rate:
+                    self.interval = max(self.interval*tightenBy,
+                                        self.minInterval)
+                elif self.lastRate < relaxBelow*self.rate:
+                    self.interval = min(self.interval*relaxBy,
+                                        self.maxInterval)
+
+        self.last.update(values)
+        self.lastTime = now
+
+        return self.interval
+
+
+class adaptiveRates():
+    """
+    Effective polling intervals of all the adaptive devices, by device tag
+    (see actions.deviceTag).
+
+    If apply is set, it's called as apply(dvice, interval) whenever a
+    device's effective interval changes, from whichever thread polled the
+    device; scheduleManager sets it to its adapt(), which queues the
+    change up for the main thread to make.
+    """
+    def __init__(self):
+        # tag -> adaptiveState, or None for devices that aren't adaptive
+        self.states = {}
+        # tag -> (endpoint, number of queries per poll), for the report
+        self.loads = {}
+        self.apply = None
+        self.lock = threading.Lock()
+
+    def _state(self, tag, dvice):
+        """
+        """
+        try:
+            return self.states[tag]
+        except KeyError:
+            pass
+
+        state = None
+        settings = deviceSettings(dvice)
+        if settings is not None:
+            state = adaptiveState(*settings,
+                                  interval=float(dvice.queryinterval))
+            print("Adapting the interval of %s between %.1f and %.1f sec" %
+                  (tag, state.minInterval, state.maxInterval))
+
+        with self.lock:
+            self.states.update({tag: state})
+
+        return state
+
+    def reset(self, tag, dvice):
+        """
+        Start the device with the given tag over from its (just changed)
+        queryinterval, forgetting what it had adapted to.
+        """
+        with self.lock:
+            self.states.pop(tag, None)
+            self.loads.pop(tag, None)
+
+        state = self._state(tag, dvice)
+        if state is None:
+            return
+
+        # What the operator asked for wins over the configured limits
+        interval = float(dvice.queryinterval)
+        with self.lock:
+            if interval < state.minInterval or interval > state.maxInterval:
+                state.minInterval = min(state.minInterval, interval)
+                state.maxInterval = max(state.maxInterval, interval)
+                print("Adapting the interval of %s between %.1f and %.1f"
+                      " sec now" % (tag, state.minInterval,
+                                    state.maxInterval))
+            state.interval = interval
+
+    def observe(self, tag, endpoint, dvice, plan, reply):
+        """
+        Look at the latest replies from dvice (with the given tag, and its
+        devices.queryPlan) and adjust its interval if it's adaptive.
+
+        Returns the new effective interval if it changed, otherwise None.
+        """
+        state = self._state(tag, dvice)
+        if state is None or reply is None:
+            return None
+
+        try:
+            fields, _ = plan.parse(reply)
+        except Exception as err:
+            # Publishing will complain about it too, so just skip this one
+            print("Unable to parse the reply from %s to adapt it!" % (tag))
+            print(str(err))
+            return None
+
+        values = {}
+        for fld in state.fields:
+            if isinstance(fields.get(fld, None), (int, float)):
+                values.update({fld: fields[fld]})
+
+        with self.lock:
+            # It was reset (see reset()) while we were busy parsing
+            if self.states.get(tag, None) is not state:
+                return None
+
+            before = state.interval
+            interval = state.update(values, time.monotonic())
+            self.loads.update({tag: (endpoint, len(plan.fastCommands))})
+
+        if interval == before:
+            return None
+
+        print("Effective interval of %s is now %.1f sec" % (tag, interval))
+        if self.apply is not None:
+            self.apply(dvice, interval)
+
+        return interval
+
+    def interval(self, tag, default):
+        """
+        Effective interval for the device with the given tag, or default
+        if it's not adaptive (or hasn't been seen yet)
+        """
+        state = self.states.get(tag, None)
+        if state is None:
+            return default
+
+        return state.interval
+
+    def report(self):
+        """
+        Effective interval (seconds), latest rate of change (per minute) and
+        queries per minute of each adaptive device, and the total queries
+        per minute that they're putting on each endpoint
+        """
+        rep = {}
+        endpoints = {}
+        with self.lock:
+            for tag in self.states:
+                state = self.states[tag]
+                if state is None:
+                    continue
+
+                endpoint, nqueries = self.loads.get(tag, (None, 0))
+                qpm = 60.*nqueries/state.interval
+                rep.update({tag: {"interval": state.interval,
+                                  "rate": state.lastRate,
+                                  "querypermin": qpm}})
+
+                if endpoint is not None:
+                    ename = "%s:%s" % (endpoint[0], endpoint[1])
+                    endpoints[ename] = endpoints.get(ename, 0.) + qpm
+
+        rep.update({"endpoints": endpoints})
+
+        return rep
+
+
+# Shared by everything that polls the devices
+rates = adaptiveRates()
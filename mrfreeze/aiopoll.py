@@ -0,0 +1,743 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Asyncio based polling of all the configured devices at once.
+
+An alternative runtime to the schedule based one in actions. Each device
+endpoint (devhost, devport) gets its own coroutine with its own persistent
+non-blocking socket, so a slow or dead device only ever holds up the other
+devices that share its port. The replies are still parsed and published
+by the same code (actions.routeReply) as the scheduled runtime.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import asyncio
+import functools
+import traceback
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+from . import actions
+from . import adaptive
+from . import breaker
+from . import devices
+from . import drivers
+from . import latency
+from . import serialcomm as scomm
+
+
+async def readFramed(reader, term, count=1, timeout=1., idle=0.05):
+    """
+    The asyncio version of serialcomm.read_framed; read until 'term' has
+    shown up 'count' times or timeout seconds have passed.
+
+    If term is None there's no way to know when the reply is done, so it
+    just reads until the timeout like serialcomm.read_all does. If count
+    is 0 there's no reply coming at all.
+
+    Returns the bytes read and whether the reply was actually complete.
+    """
+    if count == 0:
+        return b'', True
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    if term is not None:
+        term = scomm.encoder(term)
+
+    read_buffer = b''
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+
+        quieting = term is not None and count is None and term in read_buffer
+        if quieting is True:
+            wait = min(idle, remaining)
+        else:
+            wait = remaining
+
+        try:
+            byte_chunk = await asyncio.wait_for(reader.read(1024), wait)
+        except asyncio.TimeoutError:
+            if quieting is True:
+                return read_buffer, True
+            continue
+
+        if byte_chunk == b'':
+            raise ConnectionError("Connection closed by the remote end")
+
+        read_buffer += byte_chunk
+        if term is not None and count is not None:
+            if read_buffer.count(term) >= count:
+                return read_buffer, True
+
+    if term is None:
+        # Waiting out the timeout is all we could have done anyways
+        return read_buffer, True
+    else:
+        return read_buffer, False
+
+
+async def drainReader(reader, wait=0.001):
+    """
+    The asyncio version of serial's reset_input_buffer(); toss anything
+    that's already sitting in reader, and return how many bytes that was.
+
+    wait is only there so a chunk that's already buffered gets read;
+    it doesn't wait around for anything new to show up.
+    """
+    tossed = 0
+    while True:
+        try:
+            byte_chunk = await asyncio.wait_for(reader.read(1024), wait)
+        except asyncio.TimeoutError:
+            break
+
+        if byte_chunk == b'':
+            break
+        tossed += len(byte_chunk)
+
+    return tossed
+
+
+class aioEndpoint():
+    """
+    A persistent, non-blocking connection to a single socket:// endpoint.
+
+    Like serialcomm.serialPool, the connection is kept open between polls
+    and only reopened when it's found closed, or after a reply didn't
+    fully arrive (since then we can't trust what's sitting in the stream).
+    """
+    def __init__(self, host, port, timeout=1.):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+
+        self.reader = None
+        self.writer = None
+
+        self.stats = {"opened": 0,
+                      "reused": 0,
+                      "reconnects": 0,
+                      "failures": 0}
+
+    def isOpen(self):
+        """
+        """
+        if self.writer is None or self.reader is None:
+            return False
+        if self.writer.is_closing() or self.reader.at_eof():
+            return False
+
+        return True
+
+    async def connect(self):
+        """
+        """
+        if self.isOpen() is True:
+            self.stats['reused'] += 1
+            return
+
+        if self.writer is not None:
+            self.stats['reconnects'] += 1
+            await self.close()
+
+        connector = asyncio.open_connection(self.host, self.port)
+        self.reader, self.writer = await asyncio.wait_for(connector,
+                                                          self.timeout)
+        self.stats['opened'] += 1
+
+    async def close(self):
+        """
+        """
+        if self.writer is not None:
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+            except Exception as err:
+                print("Error while closing session: %s" % (str(err)))
+
+        self.reader = None
+        self.writer = None
+
+    async def transact(self, cmds, framing=None, debug=False, device=None,
+                       cap=None):
+        """
+        Same idea and same return value as serialcomm.transact(), including
+        the learned deadlines (no longer than cap) if device is given
+        """
+        allreplies = {}
+        if framing is None:
+            framing = {}
+
+        await self.connect()
+
+        try:
+            for each in cmds:
+                msg = scomm.encoder(cmds[each])
+                # Toss anything that trickled in late from a previous
+                #   command so it doesn't get mistaken for the reply to
+                #   this one, just like serialcomm.transact()
+                tossed = await drainReader(self.reader)
+                if debug is True and tossed > 0:
+                    print("Tossed %d stale bytes" % (tossed))
+                self.writer.write(msg)
+                await self.writer.drain()
+                # Get the time right after we sent the message
+                t = dt.datetime.utcnow()
+                t0 = time.monotonic()
+
+                term, count = framing.get(each, (None, None))
+                learn = device is not None and term is not None and \
+                    count != 0
+                timeout = self.timeout
+                if learn is True:
+                    timeout = latency.tracker.deadline(device, each, timeout,
+                                                       cap=cap)
+                byteReply, complete = await readFramed(self.reader, term,
+                                                       count=count,
+                                                       timeout=timeout)
+                if learn is True:
+                    if complete is True:
+                        latency.tracker.record(device, each,
+                                               time.monotonic() - t0)
+                    else:
+                        latency.tracker.missed(device, each)
+                if debug is True:
+                    print("%d bytes recieved in response" % (len(byteReply)))
+                    print(byteReply)
+
+                allreplies.update({each: [byteReply, t]})
+
+                if complete is False:
+                    # Whatever's left of this reply would end up stuck in
+                    #   front of the next one, so start over next time
+                    await self.close()
+                    break
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            self.stats['failures'] += 1
+            await self.close()
+            raise
+
+        return allreplies
+
+
+class pollEngine():
+    """
+    Poll all of the enabled devices concurrently, one coroutine per
+    device endpoint, with the parsing and publishing done off of the
+    event loop in a single worker thread.
+
+    If stage (a pipeline.publishStage) is given, the replies are handed
+    off to it instead, and it takes care of the publishing.
+
+    Keeping the publishing in one thread means it happens one-at-a-time,
+    which keeps the event loop free and keeps the shared instrument
+    compatibility objects and broker/database connections out of trouble.
+
+    It takes the same changes to the schedule as actions.scheduleManager
+    (enable, disable, reschedule and setInterval) from any other thread,
+    so the commands that come in over the broker work the same in both
+    runtimes.
+    """
+    def __init__(self, allInsts, amqs, idbs, brokers=None, stage=None,
+                 timeout=1., debug=False):
+        self.debug = debug
+        self.timeout = timeout
+        self.stage = stage
+
+        # Kept for setting up the devices that are enabled later on
+        self.allInsts = allInsts
+        self.amqs = amqs
+        self.idbs = idbs
+        self.brokers = brokers
+
+        # Devices grouped by the (devhost, devport) they talk over
+        self.endpoints = {}
+        # Things that go out over the broker rather than serial
+        self.brokerJobs = []
+        # device tag -> job, for the changes that come in over the broker
+        self.jobs = {}
+
+        self.conns = {}
+        # (devhost, devport) -> asyncio.Lock, so that commands coming in
+        #   from outside take turns with the polls on the same port
+        self.locks = {}
+        # (devhost, devport) -> asyncio.Event, to wake up its poller when
+        #   something's changed, and its polling task
+        self.wakeups = {}
+        self.tasks = {}
+        self.brokerTasks = []
+        self.loop = None
+
+        for inst in allInsts:
+            for dtag in allInsts[inst]:
+                dvice = allInsts[inst][dtag]
+
+                if dvice.enabled is True and dvice.devtype != "upfile":
+                    self._addJob(self._makeJob(dvice))
+                else:
+                    print("Device %s is disabled! Skipping it." %
+                          (dvice.devtype))
+
+        # Single thread for the publishing (see above), and a few for any
+        #   local serial ports since pyserial will only block on those
+        self.publisher = ThreadPoolExecutor(max_workers=1)
+        self.blocking = ThreadPoolExecutor(max_workers=4)
+        # Housekeeping gets its own thread, since a command that comes in
+        #   waits there on its reply (see command()) and mustn't hold up
+        #   the publishing while it does
+        self.housekeeper = ThreadPoolExecutor(max_workers=1)
+
+    def _makeJob(self, dvice):
+        """
+        """
+        compat = actions.instrumentCompat(self.allInsts, dvice.instrument)
+        dbObj, bkObj = actions.deviceConnections(dvice, self.amqs, self.idbs,
+                                                 brokers=self.brokers)
+        job = {"dvice": dvice,
+               "db": dbObj,
+               "broker": bkObj,
+               "compat": compat,
+               "interval": int(dvice.queryinterval),
+               # Event loop times that it's next due (None is right
+               #   away), and that it last came due
+               "due": None,
+               "last": None}
+
+        return job
+
+    def _isBroker(self, job):
+        """
+        """
+        return job['dvice'].devtype.lower() in ['arc-loisgettemp',
+                                                'arc-loisinitcheck']
+
+    def _addJob(self, job):
+        """
+        Add job to its endpoint (or the broker jobs), and start polling it
+        if the engine is already running
+        """
+        dvice = job['dvice']
+        self.jobs.update({actions.deviceTag(dvice): job})
+
+        if self._isBroker(job):
+            self.brokerJobs.append(job)
+            if self.loop is not None:
+                self.brokerTasks.append(
+                    asyncio.ensure_future(self._pollBroker(job)))
+            return
+
+        key = actions.deviceEndpoint(dvice)
+        self.endpoints.setdefault(key, []).append(job)
+        if self.stage is not None:
+            self.stage.register(dvice, job['db'], job['broker'],
+                                compat=job['compat'], debug=self.debug)
+        if self.loop is not None:
+            self._startEndpoint(key)
+            self._wake(key)
+
+    def _startEndpoint(self, key):
+        """
+        """
+        if key not in self.tasks:
+            print("Polling %d device(s) on %s:%s" %
+                  (len(self.endpoints[key]), key[0], key[1]))
+            self.wakeups[key] = asyncio.Event()
+            self.tasks[key] = asyncio.ensure_future(self._pollEndpoint(key))
+
+    def _wake(self, key):
+        """
+        """
+        if key in self.wakeups:
+            self.wakeups[key].set()
+
+    def _onLoop(self, func, *args):
+        """
+        Run func(*args) in the event loop's thread, from any other one
+        """
+        if self.loop is None:
+            raise RuntimeError("The polling engine isn't running!")
+
+        self.loop.call_soon_threadsafe(functools.partial(func, *args))
+
+    def enable(self, dvice):
+        """
+        Poll dvice again (or for the first time, if it was disabled from
+        the start) right away; called from outside the event loop like
+        the rest of the scheduleManager lookalikes below.
+        """
+        dvice.enabled = True
+        self._onLoop(self._enable, dvice)
+
+    def _enable(self, dvice):
+        """
+        """
+        job = self.jobs.get(actions.deviceTag(dvice), None)
+        if job is None:
+            self._addJob(self._makeJob(dvice))
+        elif self._isBroker(job) is False:
+            job['due'] = None
+            self._wake(actions.deviceEndpoint(dvice))
+
+    def disable(self, dvice):
+        """
+        """
+        dvice.enabled = False
+
+    def reschedule(self, dvice, oldEndpoint=None):
+        """
+        Poll dvice again right away at wherever it is now; oldEndpoint is
+        where it used to be, and its session is closed if nothing else is
+        using it.
+        """
+        if oldEndpoint is not None and oldEndpoint != \
+           actions.deviceEndpoint(dvice):
+            scomm.sessionPool.drop(oldEndpoint)
+            breaker.breakers.reset(oldEndpoint)
+
+        # Nothing remembered from the old place is any good now
+        devices.lastKnown.invalidate(actions.deviceTag(dvice))
+
+        self._onLoop(self._reschedule, dvice)
+
+    def _reschedule(self, dvice):
+        """
+        """
+        job = self.jobs.get(actions.deviceTag(dvice), None)
+        if job is None or self._isBroker(job) is True:
+            return
+
+        key = actions.deviceEndpoint(dvice)
+        for old in list(self.endpoints.keys()):
+            if old != key and job in self.endpoints[old]:
+                self.endpoints[old].remove(job)
+                if len(self.endpoints[old]) == 0 and old in self.conns:
+                    asyncio.ensure_future(self.conns.pop(old).close())
+                self._wake(old)
+
+        if job not in self.endpoints.setdefault(key, []):
+            self.endpoints[key].append(job)
+        job['due'] = None
+        self._startEndpoint(key)
+        self._wake(key)
+
+    def setInterval(self, dvice, interval):
+        """
+        Change how often dvice is polled, keeping its phase; the next poll
+        is the new interval after the last one (or right away if that's
+        already passed).
+        """
+        interval = int(interval)
+        dvice.queryinterval = interval
+        self._onLoop(self._setInterval, dvice, interval)
+
+    def _setInterval(self, dvice, interval):
+        """
+        """
+        job = self.jobs.get(actions.deviceTag(dvice), None)
+        if job is None:
+            return
+
+        job['interval'] = interval
+        # It was asked for, so don't let the adaptive rates undo it
+        adaptive.rates.reset(actions.deviceTag(dvice), dvice)
+        if job['last'] is not None and self._isBroker(job) is False:
+            job['due'] = job['last'] + interval
+            self._wake(actions.deviceEndpoint(dvice))
+
+    async def _publish(self, func, *args, **kwargs):
+        """
+        """
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+
+        return await loop.run_in_executor(self.publisher, call)
+
+    def _endpoint(self, key):
+        """
+        Return the lock for the endpoint, setting it (and its connection)
+        up if this is the first we've heard of it
+        """
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        if key[1] != -1 and key not in self.conns:
+            self.conns[key] = aioEndpoint(key[0], key[1],
+                                          timeout=self.timeout)
+
+        return self.locks[key]
+
+    async def _transact(self, key, dvice, msgs, framing, cap=None):
+        """
+        Send msgs to the device on the endpoint and get back the replies,
+        once nothing else is talking to it; cap is the longest any one
+        reply can take (see latency.latencyTracker.deadline)
+        """
+        loop = asyncio.get_running_loop()
+
+        async with self._endpoint(key):
+            if key[1] != -1:
+                tag = actions.deviceTag(dvice)
+                reply = await self.conns[key].transact(msgs, framing=framing,
+                                                       debug=self.debug,
+                                                       device=tag, cap=cap)
+            else:
+                sParams = {}
+                driver = drivers.getDriver(dvice.devtype)
+                if driver is not None:
+                    sParams = driver.sParams
+                call = functools.partial(scomm.serLocalComm, dvice.devhost,
+                                         msgs, sParams, timeout=self.timeout,
+                                         debug=self.debug, framing=framing,
+                                         device=actions.deviceTag(dvice),
+                                         cap=cap)
+                reply = await loop.run_in_executor(self.blocking, call)
+
+        return reply
+
+    async def _query(self, key, job):
+        """
+        Send the default queries to the device and get back the replies,
+        unless the endpoint's breaker is open (see breaker.py).
+
+        Returns a list of (device, replies) since there can be several
+        devices on a bus (see actions.splitReplies).
+        """
+        dvice = job['dvice']
+        tag = actions.deviceTag(dvice)
+        plan = devices.devicePlan(dvice)
+        msgs, framing = actions.queryMessages(dvice, tag, plan)
+
+        brk = breaker.breakers.get(key)
+        state, change = brk.check()
+        await self._breakerChanged(key, job, brk, change)
+
+        reply = None
+        if state != 'open' and len(msgs) > 0:
+            try:
+                if state == 'halfopen':
+                    # Just one command to see if anyone's home
+                    probe, pframing, msgs, framing = breaker.probeSplit(
+                        msgs, framing)
+                    reply = await self._transact(key, dvice, probe, pframing,
+                                                 cap=breaker.probeTimeout)
+                    if breaker.replied(reply) is False:
+                        msgs = {}
+
+                if len(msgs) > 0:
+                    rest = await self._transact(key, dvice, msgs, framing)
+                    if reply is None:
+                        reply = rest
+                    else:
+                        reply.update(rest)
+            except Exception as err:
+                print("Badness 10000")
+                print(str(err))
+                reply = None
+
+            ok = breaker.replied(reply)
+            await self._breakerChanged(key, job, brk, brk.record(ok))
+            if ok is False:
+                reply = None
+
+        replies = []
+        for member, mreply in actions.splitReplies(dvice, reply):
+            mtag = actions.deviceTag(member)
+            mreply = devices.lastKnown.merge(mtag, plan, mreply)
+
+            # Speed up or slow down the polling, if it's set up to do that
+            adaptive.rates.observe(mtag, key, member, plan, mreply)
+
+            replies.append((member, mreply))
+
+        return replies
+
+    async def _breakerChanged(self, key, job, brk, change):
+        """
+        """
+        if change is not None:
+            await self._publish(actions.breakerChanged, job['dvice'], key,
+                                brk, change, job['db'], job['broker'],
+                                debug=self.debug)
+
+    def command(self, dvice, cmds, framing=None):
+        """
+        Send cmds to the device and return the replies, from some thread
+        other than the one running the event loop. It goes ahead of any
+        polls of devices on the same port that haven't started yet.
+        """
+        if self.loop is None:
+            raise RuntimeError("The polling engine isn't running!")
+
+        key = actions.deviceEndpoint(dvice)
+        call = self._transact(key, dvice, cmds, framing)
+        future = asyncio.run_coroutine_threadsafe(call, self.loop)
+
+        # A generous upper bound, so a wedged port can't hang the caller;
+        #   each reply can take as long as the longest learned deadline
+        longest = max(self.timeout, latency.tracker.ceiling)
+        return future.result(timeout=longest*(len(cmds) + 1) + 5.)
+
+    async def _pollEndpoint(self, key):
+        """
+        Poll each of the devices on this endpoint whenever they're due,
+        one after the other since they share the port. Devices can come
+        and go from the endpoint while it's going (see reschedule()).
+        """
+        loop = asyncio.get_running_loop()
+
+        self._endpoint(key)
+        wakeup = self.wakeups[key]
+
+        # Everything is due right away (see _makeJob), which takes care of
+        #   the initial query of all the devices on startup
+        while True:
+            for job in list(self.endpoints.get(key, [])):
+                now = loop.time()
+                due = job['due']
+                if due is None:
+                    due = now
+                elif due > now:
+                    continue
+
+                # Keep the phase, unless we've fallen way behind.
+                #   Adaptive devices set their own (effective) interval
+                tag = actions.deviceTag(job['dvice'])
+                interval = adaptive.rates.interval(tag, job['interval'])
+                job['due'] = max(due + interval, now)
+                job['last'] = job['due'] - interval
+
+                # Disabled over the broker since it was started
+                if job['dvice'].enabled is not True:
+                    continue
+
+                try:
+                    await self._pollJob(key, job)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # Just like actions.catch_exceptions, so one bad poll
+                    #   doesn't end the polling of the whole endpoint
+                    print(traceback.format_exc())
+
+            wakeup.clear()
+            dues = [job['due'] if job['due'] is not None else 0.
+                    for job in self.endpoints.get(key, [])]
+            nap = None
+            if len(dues) > 0:
+                nap = max(0., min(dues) - loop.time())
+            try:
+                await asyncio.wait_for(wakeup.wait(), nap)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _pollJob(self, key, job):
+        """
+        """
+        loop = asyncio.get_running_loop()
+
+        replies = await self._query(key, job)
+        for dvice, reply in replies:
+            if self.stage is not None:
+                # put() can block, depending on its policy
+                call = functools.partial(self.stage.put,
+                                         dvice, reply,
+                                         job['db'], job['broker'],
+                                         compat=job['compat'],
+                                         debug=self.debug)
+                await loop.run_in_executor(self.blocking, call)
+            else:
+                await self._publish(actions.routeReply,
+                                    dvice, reply,
+                                    job['db'], job['broker'],
+                                    compat=job['compat'],
+                                    debug=self.debug)
+
+    async def _pollBroker(self, job):
+        """
+        """
+        dvice = job['dvice']
+        if dvice.devtype.lower() == 'arc-loisgettemp':
+            action = actions.cmd_loisgettemp
+        else:
+            action = actions.cmd_loisinitchk
+
+        while True:
+            if dvice.enabled is True:
+                await self._publish(action, dvice,
+                                    actions.unspooled(job['broker']))
+            await asyncio.sleep(job['interval'])
+
+    async def _main(self, runner, housekeeping, hkinterval, wakeup):
+        """
+        """
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+
+        for key in list(self.endpoints.keys()):
+            self._startEndpoint(key)
+
+        for job in self.brokerJobs:
+            self.brokerTasks.append(
+                asyncio.ensure_future(self._pollBroker(job)))
+
+        while runner.halt is False:
+            if wakeup is not None:
+                wakeup.clear()
+            if housekeeping is not None:
+                await loop.run_in_executor(self.housekeeper, housekeeping)
+
+            if wakeup is not None:
+                await loop.run_in_executor(None, wakeup.wait, hkinterval)
+            else:
+                await asyncio.sleep(hkinterval)
+
+        tasks = list(self.tasks.values()) + self.brokerTasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for key in self.conns:
+            await self.conns[key].close()
+
+        self.loop = None
+
+    def run(self, runner, housekeeping=None, hkinterval=0.25, wakeup=None):
+        """
+        Run until runner.halt goes True.
+
+        housekeeping is an optional callable that's run every hkinterval
+        seconds in its own thread, for things like checking the
+        broker connections and draining the command queue.
+
+        If wakeup (a threading.Event) is given, housekeeping is also run
+        as soon as it's set, such as when a command comes in.
+        """
+        try:
+            asyncio.run(self._main(runner, housekeeping, hkinterval,
+                                   wakeup))
+        finally:
+            self.housekeeper.shutdown(wait=True)
+            self.publisher.shutdown(wait=True)
+            self.blocking.shutdown(wait=True)
+
+    def report(self):
+        """
+        Return the session counters for each of the endpoints
+        """
+        rep = {}
+        for key in self.conns:
+            rep.update({"%s:%s" % key: dict(self.conns[key].stats)})
+
+        return rep
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Circuit breakers for the device endpoints.
+
+Once an endpoint (a MOXA port, or local serial port) has failed enough
+polls in a row its breaker opens, and nothing is sent to it until the
+backoff runs out; that doubles each time it opens again without having
+recovered, up to a limit, with some jitter so the dead ports don't all
+come back around at once. The first poll after that is a half-open probe
+of just one command with a short timeout. If it answers, the breaker
+closes and the rest of the poll goes ahead; if not, it opens right back up.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import random
+import threading
+
+# Consecutive failed polls before a breaker opens
+threshold = 3
+
+# Backoff (seconds) after opening the first time, and the most it can be
+baseDelay = 5.
+maxDelay = 600.
+
+# Fraction of the backoff that it's randomly stretched or shrunk by
+jitter = 0.2
+
+# Timeout (seconds) for the half-open probe
+probeTimeout = 0.5
+
+
+def replied(reply):
+    """
+    True if any of the replies (as returned by serialcomm.serComm()) have
+    anything in them at all; if the device didn't say a single thing it's
+    as good as gone.
+    """
+    if reply is None:
+        return False
+
+    for key in reply:
+        if len(reply[key][0]) > 0:
+            return True
+
+    return False
+
+
+def probeSplit(msgs, framing):
+    """
+    Split msgs and their framing up into the one that's sent as the probe
+    and the rest of them
+    """
+    if framing is None:
+        framing = {}
+
+    first = next(iter(msgs))
+    probe = {first: msgs[first]}
+    probeFraming = {k: framing[k] for k in probe if k in framing}
+    rest = {k: msgs[k] for k in msgs if k != first}
+    restFraming = {k: framing[k] for k in rest if k in framing}
+
+    return probe, probeFraming, rest, restFraming
+
+
+class circuitBreaker():
+    """
+    Breaker for a single endpoint; state is 'closed', 'open', or
+    'halfopen'. Only one probe is let through at a time.
+    """
+    def __init__(self, threshold=threshold, baseDelay=baseDelay,
+                 maxDelay=maxDelay, jitter=jitter):
+        self.threshold = threshold
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+
+        self.state = 'closed'
+        self.failures = 0
+        # Times it's opened without closing again in between
+        self.trips = 0
+        self.retryAt = 0.
+        self.probing = False
+        self.lastChange = time.monotonic()
+
+        self.lock = threading.Lock()
+
+    def _backoff(self):
+        """
+        """
+        delay = min(self.baseDelay*2**(self.trips - 1), self.maxDelay)
+
+        return delay*(1. + random.uniform(-self.jitter, self.jitter))
+
+    def _change(self, new):
+        """
+        """
+        old = self.state
+        self.state = new
+        self.lastChange = time.monotonic()
+
+        return (old, new)
+
+    def check(self):
+        """
+        What the next poll should do: 'closed' to go ahead as usual,
+        'halfopen' to send a probe, or 'open' to skip it. Returns that
+        and the state transition (or None) that it caused.
+        """
+        with self.lock:
+            change = None
+            if self.state == 'open' and time.monotonic() >= self.retryAt:
+                change = self._change('halfopen')
+
+            if self.state == 'halfopen':
+                if self.probing is True:
+                    return 'open', change
+                self.probing = True
+
+            return self.state, change
+
+    def record(self, ok):
+        """
+        Record how the latest poll (or probe) went, and return the state
+        transition it caused or None if it didn't.
+        """
+        with self.lock:
+            self.probing = False
+            change = None
+
+            if ok is True:
+                self.failures = 0
+                self.trips = 0
+                if self.state != 'closed':
+                    change = self._change('closed')
+            else:
+                self.failures += 1
+                if self.state == 'halfopen' or \
+                   (self.state == 'closed' and
+                        self.failures >= self.threshold):
+                    self.trips += 1
+                    self.retryAt = time.monotonic() + self._backoff()
+                    change = self._change('open')
+
+            return change
+
+    def report(self):
+        """
+        """
+        with self.lock:
+            rep = {"state": self.state,
+                   "failures": self.failures,
+                   "trips": self.trips,
+                   "since": time.monotonic() - self.lastChange}
+            if self.state == 'open':
+                rep.update({"retryin": max(self.retryAt - time.monotonic(),
+                                           0.)})
+
+        return rep
+
+
+class breakerBoard():
+    """
+    The circuitBreaker for each endpoint, made as they're first needed
+    """
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint):
+        """
+        """
+        try:
+            return self.breakers[endpoint]
+        except KeyError:
+            with self.lock:
+                return self.breakers.setdefault(endpoint, circuitBreaker())
+
+    def reset(self, endpoint):
+        """
+        Forget about the breaker for endpoint, say if the device has been
+        moved somewhere else
+        """
+        with self.lock:
+            self.breakers.pop(endpoint, None)
+
+    def report(self):
+        """
+        """
+        with self.lock:
+            endpoints = list(self.breakers.keys())
+
+        rep = {}
+        for endpoint in endpoints:
+            rep.update({"%s:%s" % (endpoint[0], endpoint[1]):
+                        self.breakers[endpoint].report()})
+
+        return rep
+
+
+# Shared by everything that polls the devices
+breakers = breakerBoard()
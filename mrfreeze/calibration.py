@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Sensor calibration curves, for converting raw readings to kelvin here.
+
+A device gets its curves from an (optional) setting in its config section
+that maps its sensor numbers to Lake Shore .340 curve files:
+
+    calcurves=1:./curves/X12345.340, 2:./curves/X12346.340
+
+With those, only the raw sensor units have to be asked for on every poll
+(see devices.calibratedPlan); the device's own kelvin readings are just
+asked every so often to check the conversion against, and how far apart
+the two are is reported.
+
+NumPy does the interpolation if it's installed; otherwise it's done one
+value at a time in pure Python.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import math
+import bisect
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# .340 "Data Format" values
+formatVolts = 2
+formatOhms = 3
+formatLogOhms = 4
+
+# (instrument, devtype, extratag) -> curveSet, for the report
+curveSets = {}
+curveLock = threading.Lock()
+
+
+def read340(filename):
+    """
+    Read a Lake Shore .340 curve file, and return the header (as a dict)
+    along with the lists of sensor units and temperatures of the
+    breakpoints.
+    """
+    header = {}
+    units = []
+    temps = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line == "":
+                continue
+
+            if ":" in line:
+                key, val = line.split(":", 1)
+                header.update({key.strip(): val.strip()})
+                continue
+
+            cols = line.split()
+            try:
+                # Breakpoint number, units, temperature
+                units.append(float(cols[1]))
+                temps.append(float(cols[2]))
+            except (IndexError, ValueError):
+                # The column headings, or something else that's not data
+                continue
+
+    return header, units, temps
+
+
+class sensorCurve():
+    """
+    One calibration curve, as read from a .340 file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        header, units, temps = read340(filename)
+        if len(units) < 2:
+            raise ValueError("Not enough breakpoints in %s!" % (filename))
+
+        self.serial = header.get("Serial Number", filename)
+
+        # Only the number at the start, e.g. "4      (Log Ohms/Kelvin)"
+        dformat = header.get("Data Format", str(formatOhms)).split()[0]
+        self.logUnits = int(dformat) == formatLogOhms
+
+        # Interpolation needs the units going up
+        points = sorted(zip(units, temps))
+        self.units = [p[0] for p in points]
+        self.temps = [p[1] for p in points]
+        if np is not None:
+            self.npunits = np.array(self.units)
+            self.nptemps = np.array(self.temps)
+
+    def toKelvin(self, readings):
+        """
+        Convert the list of raw readings to kelvin; anything that's off the
+        ends of the curve (or isn't positive, for log units) is NaN.
+        """
+        if self.logUnits is True:
+            readings = [math.log10(r) if r > 0 else float("nan")
+                        for r in readings]
+
+        if np is not None:
+            kelvin = np.interp(np.array(readings), self.npunits,
+                               self.nptemps, left=np.nan, right=np.nan)
+            return kelvin.tolist()
+
+        kelvin = []
+        for r in readings:
+            i = bisect.bisect_left(self.units, r)
+            if r != r or r < self.units[0] or r > self.units[-1]:
+                kelvin.append(float("nan"))
+            elif self.units[i] == r:
+                kelvin.append(self.temps[i])
+            else:
+                u0, u1 = self.units[i-1], self.units[i]
+                t0, t1 = self.temps[i-1], self.temps[i]
+                kelvin.append(t0 + (t1 - t0)*(r - u0)/(u1 - u0))
+
+        return kelvin
+
+
+class curveSet():
+    """
+    The curves for each of a device's sensors, by sensor number, and how
+    well they've agreed with the device's own kelvin readings
+    """
+    def __init__(self, curves):
+        self.curves = curves
+        self.lock = threading.Lock()
+
+        # sensor number -> {"checks", "last", "max"} of the differences
+        #   (ours minus the device's, in kelvin)
+        self.checks = {}
+
+    def sensors(self):
+        """
+        """
+        return list(self.curves.keys())
+
+    def convert(self, raw):
+        """
+        Convert a dict of sensor number: raw reading to sensor number:
+        kelvin. The sensors that share a curve are done all at once.
+        Anything that couldn't be converted is left out.
+        """
+        byCurve = {}
+        for n in raw:
+            if n in self.curves:
+                byCurve.setdefault(id(self.curves[n]), []).append(n)
+
+        kelvin = {}
+        for sensors in byCurve.values():
+            curve = self.curves[sensors[0]]
+            temps = curve.toKelvin([raw[n] for n in sensors])
+            for n, k in zip(sensors, temps):
+                if k == k:
+                    kelvin.update({n: k})
+                else:
+                    print("Sensor %d reading %s is off of curve %s!" %
+                          (n, raw[n], curve.serial))
+
+        return kelvin
+
+    def validated(self, n, delta):
+        """
+        Record the difference between our kelvin and the device's for
+        sensor n
+        """
+        with self.lock:
+            check = self.checks.setdefault(n, {"checks": 0, "last": 0.,
+                                               "max": 0.})
+            check['checks'] += 1
+            check['last'] = delta
+            if abs(delta) > abs(check['max']):
+                check['max'] = delta
+
+    def report(self):
+        """
+        """
+        with self.lock:
+            rep = {}
+            for n in self.curves:
+                rep.update({n: {"curve": self.curves[n].serial}})
+                rep[n].update(self.checks.get(n, {}))
+
+        return rep
+
+
+def deviceCurves(dvice):
+    """
+    The curveSet for dvice from its calcurves setting, or None if it
+    doesn't have one (or the curves couldn't be read).
+    """
+    setting = getattr(dvice, "calcurves", None)
+    if setting is None or str(setting).lower() in ["", "none"]:
+        return None
+
+    curves = {}
+    # Sensors can share a curve file, in which case they share the curve
+    byFile = {}
+    try:
+        for each in str(setting).split(","):
+            n, filename = each.split(":", 1)
+            filename = filename.strip()
+            if filename not in byFile:
+                byFile.update({filename: sensorCurve(filename)})
+            curves.update({int(n): byFile[filename]})
+    except (OSError, ValueError) as err:
+        print("Unable to load the calibration curves for %s!" %
+              (dvice.devtype))
+        print(str(err))
+        return None
+
+    cset = curveSet(curves)
+    with curveLock:
+        curveSets.update({(dvice.instrument, dvice.devtype,
+                           dvice.extratag): cset})
+
+    return cset
+
+
+def report():
+    """
+    The curve used for each sensor of each calibrated device, and how its
+    conversions compare to the device's own
+    """
+    with curveLock:
+        sets = dict(curveSets)
+
+    rep = {}
+    for key in sets:
+        rep.update({"+".join([str(k) for k in key if k is not None]):
+                    sets[key].report()})
+
+    return rep
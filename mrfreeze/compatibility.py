@@ -8,70 +8,240 @@
 #
 #  @author: rhamilton
 
-"""One line description of module.
-
-Further description.
+"""Compatibility layers for the legacy LOIS "upfiles".
+
+Each upfile is described by a template of sections, which can come from a
+file named by the template setting of the instrument's section in
+compat.conf (see config/upfile.conf-TEMPLATE); NIHTS has one built in
+(nihtsTemplate) that's used if it doesn't name one. Each section of the
+template gives:
+
+    devices     devtype[+extratag] patterns (fnmatch, comma separated) of
+                the devices whose fields go into it
+    format      number format of its values
+    fields      field:KEY[:format] translations, comma separated, in the
+                order they're written out
+
+The templates are compiled once, into a single format string per section,
+so making an upfile is just one % per section that's changed since the
+last one and then a join.
 """
 
 from __future__ import division, print_function, absolute_import
 
+import fnmatch
+import configparser as conf
 from datetime import datetime as dt
 from collections import OrderedDict
 
+# Format of the section timestamps; the needed {} are in here!
+tsFormat = "{%Y%m%d %H:%M:%S}"
+
+# Initial starting values so it's not at least None at the get-go
+defaultValue = -9999.
+defaultDate = dt.strptime("20190107T02:10:00.00", "%Y%m%dT%H:%M:%S.%f")
+
+
+class upfileSection():
+    """
+    One section of an upfile template, compiled. fields is an OrderedDict
+    of field name: (output key, number format or None to use numFormat).
+    """
+    def __init__(self, name, devices, fields, numFormat="%+0.2f"):
+        self.name = name
+        self.devices = [d.lower() for d in devices]
+
+        # Several fields can go into the same output key, in which case
+        #   it's written out where the first of them is in the template
+        self.keys = []
+        formats = {}
+        for field in fields:
+            key, vfmt = fields[field]
+            if key not in self.keys:
+                self.keys.append(key)
+            if vfmt is not None or key not in formats:
+                formats.update({key: vfmt})
+        self.index = {f: self.keys.index(fields[f][0]) for f in fields}
+
+        vals = []
+        for key in self.keys:
+            vfmt = formats[key]
+            if vfmt is None:
+                vfmt = numFormat
+            vals.append("{ %s %s }" % (key.replace("%", "%%"), vfmt))
+
+        # The timestamp is the first thing that's filled in; see render()
+        self.fmt = "{ { %s } %%s { %s } } " % (name.replace("%", "%%"),
+                                                " ".join(vals))
+
+    def matches(self, devkey):
+        """
+        True if the device with devkey (devtype[+extratag], lower case)
+        goes into this section
+        """
+        for pattern in self.devices:
+            if fnmatch.fnmatchcase(devkey, pattern):
+                return True
+
+        return False
+
+    def render(self, ts, values):
+        """
+        The upfile fragment for this section (see upfileCompat.makeUpfile),
+        including the space that separates it from the next one
+        """
+        return self.fmt % ((ts.strftime(tsFormat),) + tuple(values))
+
+
+class upfileTemplate():
+    """
+    The sections of an upfile (upfileSection), in the order they're
+    written out
+    """
+    def __init__(self, sections):
+        self.sections = OrderedDict()
+        for sect in sections:
+            self.sections.update({sect.name: sect})
+
+    def sectionFor(self, dvice):
+        """
+        Name of the (first) section that dvice goes into, or None
+        """
+        devkey = dvice.devtype.lower()
+        if getattr(dvice, "extratag", None) is not None:
+            devkey += "+%s" % (str(dvice.extratag).lower())
+
+        for name in self.sections:
+            if self.sections[name].matches(devkey):
+                return name
+
+        return None
+
+
+def parseFields(setting):
+    """
+    The OrderedDict of field name: (output key, format) for the fields
+    setting of a template section
+    """
+    fields = OrderedDict()
+    for each in setting.split(","):
+        each = each.strip()
+        if each == "":
+            continue
+
+        parts = [p.strip() for p in each.split(":", 2)]
+        if len(parts) < 2:
+            raise ValueError("Bad upfile field %s!" % (each))
+        elif len(parts) == 2:
+            parts.append(None)
+        fields.update({parts[0]: (parts[1], parts[2])})
+
+    return fields
+
 
-class upfileNIHTS():
+def parseTemplate(filename):
     """
-    The compatibility layer between Mr. Freeze and the legacy LOIS/moxad setup
-    that is needed because of the "upfile" arrangement that Peter made
-    for NIHTS; see https://jumar.lowell.edu/confluence/x/PQBCAg
+    Read and compile the upfile template in filename; its sections are
+    written out in the order that they're in the file.
     """
-    def __init__(self, params, debug=False):
+    tconf = conf.ConfigParser(interpolation=None)
+    # Case matters for the field names!
+    tconf.optionxform = str
+    with open(filename, "r") as f:
+        tconf.read_file(f)
+
+    sections = []
+    for name in tconf.sections():
+        sect = tconf[name]
+        devices = [d.strip() for d in sect.get('devices', '').split(",")
+                   if d.strip() != ""]
+        sections.append(upfileSection(name, devices,
+                                      parseFields(sect.get('fields', '')),
+                                      numFormat=sect.get('format', '%+0.2f')))
+
+    return upfileTemplate(sections)
+
+
+def translations(defs):
+    """
+    Turn one of the field definitions below into the fields of an
+    upfileSection
+    """
+    return OrderedDict([(f, (defs[f], None)) for f in defs])
+
+
+def nihtsTemplate():
+    """
+    The upfile that Peter set up for NIHTS;
+    see https://jumar.lowell.edu/confluence/x/PQBCAg
+    """
+    sections = [upfileSection("NIHTS1_cooler", ["sunpower*+detectorcooler"],
+                              translations(sunpowercooler()),
+                              numFormat="%0.2f"),
+                upfileSection("NIHTS2_cooler", ["sunpower*+benchcooler"],
+                              translations(sunpowercooler()),
+                              numFormat="%0.2f"),
+                upfileSection("NIHTS_Lakeshore218", ["lakeshore218*"],
+                              translations(ls218())),
+                upfileSection("NIHTS_Lakeshore325", ["lakeshore325*"],
+                              translations(ls325()),
+                              numFormat="%+0.3f"),
+                upfileSection("NIHTS_vacgauge", ["vactransducer_mks972b*"],
+                              translations(vacgauge()),
+                              numFormat="%.4e")]
+
+    return upfileTemplate(sections)
+
+
+class upfileCompat():
+    """
+    The compatibility layer between Mr. Freeze and the legacy LOIS/moxad
+    setup for one instrument, whose upfile is laid out by template (an
+    upfileTemplate). Any number of them can be going at once.
+    """
+    def __init__(self, instrument, params, template, debug=False):
         self.debug = debug
 
         # This is for compatibility with actions.scheduleDevices()
-        self.instrument = "NIHTS"
+        self.instrument = instrument
         self.devtype = 'upfile'
         self.enabled = True
         self.params = params
+        self.template = template
+
+        # Sections that have been updated since the upfile was last made;
+        #   see upload.upfileCoalescer
+        self.dirty = set()
+
+        # Rendered upfile fragment of each section, and the sections that
+        #   need to be rendered again; see makeUpfile
+        self.fragments = {}
+        self.stale = set()
+
+        # Latest timestamp and values of each section, in template order
+        self.stamps = {}
+        self.values = {}
+        for sect in self.template.sections:
+            nkeys = len(self.template.sections[sect].keys)
+            self.stamps.update({sect: defaultDate})
+            self.values.update({sect: [defaultValue]*nkeys})
+
+    def sectionFor(self, dvice):
+        """
+        Name of the section that dvice's fields go into, or None if none
+        of them do
+        """
+        return self.template.sectionFor(dvice)
 
-        # Initial starting values so it's not at least None at the get-go
-        defaultValue = -9999.
-        defaultDate = dt.strptime("20190107T02:10:00.00",
-                                  "%Y%m%dT%H:%M:%S.%f")
-
-        # OrderedDict() to keep the order consistent just in case LOIS
-        #   is hardcoded to the order of things; I didn't check if that's
-        #   actually the case or if I'm too paranoid
-        self.xkeys = OrderedDict({"NIHTS1_cooler": sunpowercooler(),
-                                  "NIHTS2_cooler": sunpowercooler(),
-                                  "NIHTS_Lakeshore218": ls218(),
-                                  "NIHTS_Lakeshore325": ls325(),
-                                  "NIHTS_vacgauge": vacgauge()})
-
-        # Loop through the sections defined above
-        for key in self.xkeys:
-            # Set up the values for this section
-            sectVals = OrderedDict()
-            sectVals.update({"sectTimestamp": defaultDate})
-            if debug is True:
-                print(key)
-
-            # Now fill in all the rest
-            for subkey in self.xkeys[key]:
-                outputKey = self.xkeys[key][subkey]
-                if debug is True:
-                    print("\t", subkey, outputKey)
-                sectVals.update({outputKey: defaultValue})
-
-            # Set the base key
-            setattr(self, key, sectVals)
-
-    def updateSection(self, sect, fields):
+    def updateSection(self, sect, fields, ts=None):
         """
         'sect' must be a string that matches exactly one of the sections
-        set up in __init__ otherwise it'll fail.
+        of the template otherwise it'll fail.
+
+        ts is the datetime of fields; if it's not given, it's parsed out of
+        fields['TimestampUTC'] instead.
         """
-        if hasattr(self, sect) is False:
+        if sect not in self.template.sections:
             if self.debug is True:
                 print("INVALID SECTION! %s not found" % (sect))
         else:
@@ -80,28 +250,35 @@ class upfileNIHTS():
 
             print(fields)
 
-            print("Updating NIHTS upfile section %s" % (sect))
-            datakeys = self.xkeys[sect]
+            print("Updating %s upfile section %s" % (self.instrument, sect))
+            index = self.template.sections[sect].index
+            updated = self.values[sect]
 
-            # Need this because we need to programatically access
-            #   the section which was given as an argument
-            updated = getattr(self, sect)
             # Update the section timestamp
-            updated['sectTimestamp'] = dt.strptime(fields['TimestampUTC'],
-                                                   "%Y-%m-%dT%H:%M:%S.%f")
+            if ts is None:
+                ts = dt.strptime(fields['TimestampUTC'],
+                                 "%Y-%m-%dT%H:%M:%S.%f")
+            self.stamps[sect] = ts
 
             for field in fields:
                 try:
-                    translation = datakeys[field]
-                    updated[translation] = fields[field]
+                    updated[index[field]] = fields[field]
                 except KeyError:
                     print("Field %s not in upfile translation!" % (field))
-                    translation = None
 
-    def makeNIHTSUpfile(self):
+            self.dirty.add(sect)
+            self.stale.add(sect)
+
+    def renderSection(self, sect):
+        """
+        """
+        return self.template.sections[sect].render(self.stamps[sect],
+                                                   self.values[sect])
+
+    def makeUpfile(self):
         """
-        Create the NIHTS "upfile" that LOIS needs for the FITS headers.
-        It's a very specific format, shown below.
+        Create the "upfile" that LOIS needs for the FITS headers.
+        It's a very specific format, shown below for NIHTS.
 
         Here's the format we're trying to recreate:
         {
@@ -140,65 +317,59 @@ class upfileNIHTS():
         Worth noting that it *MUST* be all on one line; the newlines above
         are for clarity only.
         """
-        tsFormat = "{%Y%m%d %H:%M:%S}"
-        sectBegin = "{ "
-        sectEnd = " }"
-
-        # Ok, here we go
-        finalForm = ""
-        finalForm += sectBegin
-
-        skipableSections = ['debug', 'devtype',
-                            'enabled', 'instrument',
-                            'xkeys', 'params']
-
-        # We'll loop over the properties
-        for sect in self.__dict__:
-            # Skip any/all non-output properties
-            if sect not in skipableSections:
-                sectOutput = sectBegin + sect + sectEnd
-                thisSect = getattr(self, sect)
-                if sect == "NIHTS_Lakeshore325":
-                    numFormat = "%+0.3f"
-                elif sect in ["NIHTS1_cooler", "NIHTS2_cooler"]:
-                    numFormat = "%0.2f"
-                elif sect == "NIHTS_vacgauge":
-                    numFormat = "%.4e"
-                else:
-                    numFormat = "%+0.2f"
-
-                for i, subkey in enumerate(thisSect):
-                    if subkey == "sectTimestamp":
-                        tsVal = thisSect["sectTimestamp"]
-                        # Remember that the needed {} are in the tsFormat!
-                        #   (but not the initial space)
-                        sectOutput += " " + tsVal.strftime(tsFormat)
-
-                        # There's another section that begins after timestamp
-                        sectOutput += " " + sectBegin
-                    else:
-                        # Doing this on two lines just for line length control
-                        printedVal = numFormat % (thisSect[subkey])
-
-                        sectOutput += sectBegin + subkey + " "
-                        sectOutput += printedVal
-                        sectOutput += sectEnd
-
-                    if i != len(thisSect) - 1 and i != 0:
-                        sectOutput += " "
-
-                # Finishing up
-                sectOutput += sectEnd
-                finalForm += sectBegin + sectOutput + sectEnd + " "
-
-        # .strip() here because we already put in the space immediately above
-        finalForm += sectEnd.strip()
+        # Only the sections that were updated since last time need to be
+        #   made again; the rest are just what they were
+        for sect in self.template.sections:
+            if sect in self.stale or sect not in self.fragments:
+                self.fragments[sect] = self.renderSection(sect)
+        self.stale.clear()
+
+        finalForm = "{ " + "".join([self.fragments[sect]
+                                    for sect in self.template.sections]) + "}"
         if self.debug is True:
             print(finalForm)
 
         return finalForm
 
 
+class upfileNIHTS(upfileCompat):
+    """
+    The compatibility layer that is needed because of the "upfile"
+    arrangement that Peter made for NIHTS; its template is nihtsTemplate()
+    unless another one is given.
+    """
+    def __init__(self, params, template=None, debug=False):
+        if template is None:
+            template = nihtsTemplate()
+        super().__init__("NIHTS", params, template, debug=debug)
+
+    def makeNIHTSUpfile(self):
+        """
+        """
+        return self.makeUpfile()
+
+
+def makeCompat(inst, params, debug=False):
+    """
+    The compatibility layer for the instrument section inst of compat.conf
+    (whose settings are params), or None if it's disabled
+    """
+    if str(params.get('enabled', 'True')).lower() == "false":
+        return None
+
+    filename = params.get('template', None)
+    template = None
+    if filename is not None and filename.lower() not in ["", "none"]:
+        template = parseTemplate(filename)
+
+    if inst.lower() == "nihts":
+        return upfileNIHTS(params, template=template, debug=debug)
+    elif template is None:
+        raise ValueError("No upfile template given for %s!" % (inst))
+
+    return upfileCompat(inst.upper(), params, template, debug=debug)
+
+
 def vacgauge():
     """
     Unfortunately, case here matters.
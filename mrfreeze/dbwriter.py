@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Batched, buffered writes to the InfluxDB databases.
+
+Rather than every publisher doing a full connect/commit/close for each
+handful of fields, they hand their points to a shared batchWriter which
+writes them out in batches from a background thread, by size or interval,
+over a connection that's kept open.
+
+If the batchWriter is given a spool.diskSpool, batches that can't be
+written are spooled to disk and replayed once the database is back.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import threading
+import datetime as dt
+from collections import deque
+
+from . import spool as spl
+
+
+class bufferedDB():
+    """
+    Stands in for one of the ligmos database objects (as made by
+    connSetup.connIDB) so it can be handed to anything that expects one.
+    singleCommit() just adds the points to the writer's buffer; everything
+    else is passed through to the actual database object.
+    """
+    def __init__(self, writer, name, db):
+        self.writer = writer
+        self.name = name
+        self.db = db
+
+    def singleCommit(self, packet, table=None, close=True):
+        """
+        'close' is ignored, since the whole point is to not do that.
+        """
+        self.writer.add(self.name, table, packet)
+
+    def __getattr__(self, attr):
+        return getattr(self.db, attr)
+
+
+class batchWriter():
+    """
+    Accumulate points from all of the publishers, and write them out in a
+    background thread once flushSize of them are waiting for any one
+    database table or every flushInterval seconds, whichever comes first.
+
+    At most maxPoints are kept waiting per table; past that the oldest
+    are dropped (and counted) so a dead database can't eat all our memory.
+
+    With a spool, a batch that fails to write is spooled instead of being
+    put back in the buffer, and replayed at no more than replayRate points
+    per second in a separate thread so it doesn't hold up the live ones.
+    """
+    def __init__(self, flushSize=500, flushInterval=5., maxPoints=50000,
+                 spool=None, replayRate=1000.):
+        self.flushSize = flushSize
+        self.flushInterval = flushInterval
+        self.maxPoints = maxPoints
+
+        self.spool = spool
+        self.replayer = None
+        if spool is not None:
+            # Each spooled record is one batch, so scale the rate to match
+            self.replayer = spl.spoolReplayer(spool, self._replay, batch=1,
+                                              rate=replayRate/flushSize)
+
+        # (database name, table) -> deque of points waiting to be written
+        self.buffers = {}
+        # database name -> actual ligmos database object
+        self.dbs = {}
+
+        self.lock = threading.Lock()
+        self.flushNow = threading.Event()
+        self.halt = False
+        self.thread = None
+
+        self.stats = {"points": 0,
+                      "written": 0,
+                      "dropped": 0,
+                      "flushes": 0,
+                      "failures": 0,
+                      "lastbatch": 0,
+                      "maxbatch": 0,
+                      "lastflush": 0.,
+                      "maxflush": 0.}
+
+    def wrap(self, name, db):
+        """
+        Return a bufferedDB for the given database object
+        """
+        self.dbs.update({name: db})
+
+        return bufferedDB(self, name, db)
+
+    def wrapAll(self, idbs):
+        """
+        Same as wrap(), for a whole dict of them like connSetup.connIDB
+        gives back. Anything that's None stays None.
+        """
+        wrapped = {}
+        for name in idbs:
+            if idbs[name] is None:
+                wrapped.update({name: None})
+            else:
+                wrapped.update({name: self.wrap(name, idbs[name])})
+
+        return wrapped
+
+    def add(self, name, table, packet):
+        """
+        Add the point(s) in packet to the buffer for the given database
+        and table.
+        """
+        if packet is None:
+            return
+
+        if isinstance(packet, dict):
+            packet = [packet]
+
+        # These are going to be written a bit later than they would've
+        #   been, so make sure they're stamped with *now* rather than
+        #   whenever the database gets around to it
+        stamp = dt.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        for point in packet:
+            if point.get('time', None) is None:
+                point['time'] = stamp
+
+        key = (name, table)
+        with self.lock:
+            buf = self.buffers.setdefault(key, deque())
+            buf.extend(packet)
+            self.stats['points'] += len(packet)
+
+            overflow = len(buf) - self.maxPoints
+            for _ in range(overflow):
+                buf.popleft()
+            if overflow > 0:
+                self.stats['dropped'] += overflow
+
+            if len(buf) >= self.flushSize:
+                self.flushNow.set()
+
+    def flush(self):
+        """
+        Write out everything that's waiting.
+        """
+        with self.lock:
+            taken = {}
+            for key in self.buffers:
+                if len(self.buffers[key]) > 0:
+                    taken.update({key: list(self.buffers[key])})
+                    self.buffers[key].clear()
+
+        for key in taken:
+            name, table = key
+            points = taken[key]
+
+            t0 = time.monotonic()
+            try:
+                self.dbs[name].singleCommit(points, table=table, close=False)
+            except Exception as err:
+                print("Database write of %d points to %s failed!" %
+                      (len(points), name))
+                print(str(err))
+                self._failed(key, points)
+                continue
+
+            elapsed = time.monotonic() - t0
+            with self.lock:
+                self.stats['flushes'] += 1
+                self.stats['written'] += len(points)
+                self.stats['lastbatch'] = len(points)
+                self.stats['maxbatch'] = max(self.stats['maxbatch'],
+                                             len(points))
+                self.stats['lastflush'] = elapsed
+                self.stats['maxflush'] = max(self.stats['maxflush'],
+                                             elapsed)
+
+    def _failed(self, key, points):
+        """
+        Spool the points if we can. Otherwise put them back at the front
+        of the line for the next try, which means if anything has to be
+        dropped it's the oldest.
+        """
+        if self.spool is not None:
+            name, table = key
+            self.spool.append({"db": name, "table": table, "points": points})
+            with self.lock:
+                self.stats['failures'] += 1
+            return
+
+        with self.lock:
+            self.stats['failures'] += 1
+            buf = self.buffers.setdefault(key, deque())
+            buf.extendleft(reversed(points))
+
+            overflow = len(buf) - self.maxPoints
+            for _ in range(overflow):
+                buf.popleft()
+            if overflow > 0:
+                self.stats['dropped'] += overflow
+
+    def _replay(self, records):
+        """
+        Sender for the spoolReplayer
+        """
+        for rec in records:
+            self.dbs[rec['db']].singleCommit(rec['points'],
+                                             table=rec['table'],
+                                             close=False)
+
+    def _run(self):
+        """
+        """
+        while self.halt is False:
+            self.flushNow.wait(self.flushInterval)
+            self.flushNow.clear()
+            self.flush()
+
+    def start(self):
+        """
+        """
+        self.halt = False
+        self.thread = threading.Thread(target=self._run,
+                                       name="dbwriter", daemon=True)
+        self.thread.start()
+
+        if self.replayer is not None:
+            self.replayer.start()
+
+    def stop(self):
+        """
+        Stop the background thread, write out anything left, and close
+        the database connections.
+        """
+        self.halt = True
+        self.flushNow.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+        if self.replayer is not None:
+            self.replayer.stop()
+
+        for name in self.dbs:
+            closer = getattr(self.dbs[name], 'closeDB', None)
+            if callable(closer):
+                try:
+                    closer()
+                except Exception as err:
+                    print("Couldn't close database %s: %s" % (name, str(err)))
+
+    def report(self):
+        """
+        Counters, latest/longest flush time (seconds) and batch size,
+        and the number of points still waiting
+        """
+        with self.lock:
+            rep = dict(self.stats)
+            rep.update({"waiting": sum([len(b) for b in
+                                        self.buffers.values()])})
+
+        if self.spool is not None:
+            rep.update({"spool": self.spool.report()})
+
+        return rep
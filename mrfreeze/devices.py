@@ -15,10 +15,38 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
-from . import mks_kjl
-from . import newport
-from . import sunpower
-from . import lakeshore
+import time
+import threading
+from types import MappingProxyType
+from collections import namedtuple
+
+from . import drivers
+from . import calibration
+
+
+# One query of a device: the key its reply is filed under, the encoded
+#   command, the (encoded) terminator and number of them that mark the
+#   end of the reply, the function that parses the reply, and how often
+#   it needs asking ("fast" every poll, "slow" see lastKnownCache)
+planEntry = namedtuple("planEntry", ["key", "cmd", "term", "count", "parser",
+                                     "cadence"])
+
+# Device type -> queryPlan, built the first time each type is polled
+queryPlans = {}
+# (instrument, devtype, extratag) -> queryPlan, for devicePlan()
+devicePlans = {}
+planLock = threading.Lock()
+
+
+def getDriver(device):
+    """
+    The drivers.deviceDriver for the device type, or None (and a scream)
+    """
+    driver = drivers.getDriver(device)
+    if driver is None:
+        print("INVALID DEVICE: %s" % (device))
+
+    return driver
 
 
 def allCommands(device=None):
@@ -30,6 +58,8 @@ def allCommands(device=None):
     Sunpower CryoTel-style coolers
     Lake Shore 325, 218
 
+    and whatever else has a driver registered (see drivers).
+
     cset should be a dictionary mapping a semi-readable key to the
     actual serial command for the particular device.
     Parsing the result occurs elsewhere.
@@ -39,23 +69,11 @@ def allCommands(device=None):
     of commands that pull double-duty, such as 'SET TTARGET' for the Sunpower
     Cryotel units as well as the Lake Shore devices.
     """
-    # Because I'm paranoid
-    device = device.lower()
-
-    if device == "vactransducer_mks972b":
-        cset, term = mks_kjl.allCommands(device)
+    cset, term = None, None
 
-    elif device in ["sunpowergen1", "sunpowergen2"]:
-        cset, term = sunpower.allCommands(device)
-
-    elif device in ["lakeshore218", "lakeshore325"]:
-        cset, term = lakeshore.allCommands(device)
-
-    elif device in ['newport_ithx', 'newport_isd-tc']:
-        cset, term = newport.allCommands(device)
-
-    else:
-        print("INVALID DEVICE: %s" % (device))
+    driver = getDriver(device)
+    if driver is not None:
+        cset, term = driver.allCommands()
 
     return cset, term
 
@@ -73,22 +91,350 @@ def defaultQueryCommands(device=None):
     to the actual serial command needed to get it.  Parsing the result
     occurs elsewhere.
     """
+    cset = None
 
-    if device == "vactransducer_mks972b":
-        cset = mks_kjl.defaultQueries(device)
-    elif device in ['sunpowergen1', 'sunpowergen2']:
-        cset = sunpower.defaultQueries(device)
-    elif device in ['lakeshore218', 'lakeshore325']:
-        cset = lakeshore.defaultQueries(device)
-    elif device in ['newport_ithx', 'newport_isd-tc']:
-        cset = newport.defaultQueries(device)
-    else:
-        print("INVALID DEVICE: %s" % (device))
-        cset = None
+    driver = getDriver(device)
+    if driver is not None:
+        cset = driver.defaultQueries()
 
     return cset
 
 
+def replyFraming(device, cmds):
+    """
+    Given a device type and a dict of commands (as from defaultQueryCommands)
+    return a dict mapping the same keys to the (terminator, count) pair
+    that marks a complete reply to that command; see
+    serialcomm.read_framed() for how it's used.
+    """
+    framing = {}
+    if cmds is None:
+        return framing
+
+    driver = getDriver(device)
+    if driver is not None:
+        for each in cmds:
+            framing.update({each: driver.replyFraming(cmds[each])})
+
+    return framing
+
+
+def queryCadence(device, cmds):
+    """
+    Given a device type and a dict of commands (as from defaultQueryCommands)
+    return a dict mapping the same keys to how often they need to be asked:
+    "fast" for things that are always changing, "slow" for things like
+    configuration that only change when they're commanded to.
+    """
+    cadence = {}
+    if cmds is None:
+        return cadence
+
+    driver = getDriver(device)
+    if driver is not None:
+        for each in cmds:
+            cadence.update({each: driver.queryCadence(each)})
+
+    return cadence
+
+
+def replyParser(device):
+    """
+    Return the function that parses the replies for the device type; it
+    takes the query key and the reply bytes and returns a dict of fields.
+    """
+    parser = None
+
+    driver = getDriver(device)
+    if driver is not None:
+        parser = driver.replyParser()
+
+    return parser
+
+
+class queryPlan():
+    """
+    Everything needed to do the default queries of a device type and parse
+    the replies, worked out once and shared by all the devices of that type.
+
+    entries is a tuple of planEntry, in the order the queries go out;
+    commands and framing are read-only versions of the dicts from
+    defaultQueryCommands() and replyFraming() (but with everything
+    already encoded) that can be passed right to serialcomm.serComm().
+    fastCommands and fastFraming are the same but with only the "fast"
+    queries, and slowKeys are the keys of the rest.
+    """
+    __slots__ = ("device", "entries", "commands", "framing", "parser",
+                 "parsers", "fastCommands", "fastFraming", "slowKeys")
+
+    def __init__(self, device):
+        cmds = defaultQueryCommands(device=device)
+        if cmds is None:
+            cmds = {}
+        framing = replyFraming(device, cmds)
+        cadence = queryCadence(device, cmds)
+        parser = replyParser(device)
+
+        entries = []
+        for key in cmds:
+            term, count = framing.get(key, (None, None))
+            if term is not None:
+                term = term.encode("utf-8")
+            entries.append(planEntry(key, cmds[key].encode("utf-8"),
+                                     term, count, parser,
+                                     cadence.get(key, "fast")))
+
+        self.device = device
+        # Used for anything in a reply that isn't one of the plan's queries
+        self.parser = parser
+        self._index(entries)
+
+    def _index(self, entries):
+        """
+        Set up everything that comes from the entries
+        """
+        self.entries = tuple(entries)
+        self.commands = MappingProxyType({e.key: e.cmd for e in entries})
+        self.framing = MappingProxyType({e.key: (e.term, e.count)
+                                         for e in entries})
+        self.parsers = MappingProxyType({e.key: e.parser for e in entries})
+
+        fast = [e for e in entries if e.cadence != "slow"]
+        self.fastCommands = MappingProxyType({e.key: e.cmd for e in fast})
+        self.fastFraming = MappingProxyType({e.key: (e.term, e.count)
+                                             for e in fast})
+        self.slowKeys = frozenset([e.key for e in entries
+                                   if e.cadence == "slow"])
+
+    def parse(self, replies):
+        """
+        Parse the replies (as returned by serialcomm.serComm()) to the
+        queries, and return the combined fields along with the timestamp
+        of the last reply that actually had something in it.
+
+        Replies that came from a lastKnownCache (flagged by a third
+        element that's True) are parsed like the rest, but their (older)
+        timestamps aren't used.
+        """
+        fields = {}
+        lastTS = None
+        for key in replies:
+            parser = self.parsers.get(key, self.parser)
+            ans = parser(key, replies[key][0])
+            if ans != {}:
+                fields.update(ans)
+                if len(replies[key]) < 3 or replies[key][2] is not True:
+                    lastTS = replies[key][1]
+
+        return fields, lastTS
+
+
+class calibratedPlan(queryPlan):
+    """
+    queryPlan for a device that converts its raw sensor readings to kelvin
+    itself, with its own calibration.curveSet. If every one of its sensors
+    has a curve, its kelvin query is only asked on the slow cadence, to
+    check the conversion against; otherwise it's still asked every time
+    for the sensors that don't. See calibrationKeys() in the vendor
+    modules for what keys is.
+    """
+    __slots__ = ("curves", "kelvinKey", "rawKey", "kelvinField", "rawField",
+                 "sensors")
+
+    def __init__(self, device, curves, keys):
+        super().__init__(device)
+        self.curves = curves
+        (self.kelvinKey, self.rawKey, self.kelvinField, self.rawField,
+         self.sensors) = keys
+
+        if set(self.sensors) <= set(curves.sensors()):
+            self._index([e._replace(cadence="slow")
+                         if e.key == self.kelvinKey else e
+                         for e in self.entries])
+
+    def parse(self, replies):
+        """
+        Same as queryPlan.parse(), but with the kelvin fields of the
+        calibrated sensors from their raw readings; when the device's own
+        kelvin readings are fresh, the difference is in <field>CalDelta
+        and recorded in the curveSet. When they're not, the sensors that
+        couldn't be converted are left out rather than going out with
+        old readings.
+        """
+        fields, lastTS = super().parse(replies)
+
+        raw = {}
+        for n in self.curves.sensors():
+            if (self.rawField % n) in fields:
+                raw.update({n: fields[self.rawField % n]})
+
+        fresh = self.kelvinKey in replies and \
+            (len(replies[self.kelvinKey]) < 3 or
+             replies[self.kelvinKey][2] is not True)
+
+        kelvin = self.curves.convert(raw)
+        for n in kelvin:
+            fld = self.kelvinField % n
+            if fresh is True and fld in fields:
+                delta = kelvin[n] - fields[fld]
+                fields.update({fld + "CalDelta": delta})
+                self.curves.validated(n, delta)
+            fields.update({fld: kelvin[n]})
+
+        if fresh is False:
+            for n in self.sensors:
+                if n not in kelvin:
+                    fields.pop(self.kelvinField % n, None)
+
+        return fields, lastTS
+
+
+class lastKnownCache():
+    """
+    Last known replies to the "slow" queries of each device, by device tag
+    (see actions.deviceTag), so they only have to be asked every
+    slowInterval seconds rather than on every poll.
+
+    A device's slow queries are asked again on its very next poll after
+    invalidate(), which is what should happen after they've been changed
+    by a command.
+    """
+    def __init__(self, slowInterval=300.):
+        self.slowInterval = slowInterval
+
+        self.lock = threading.Lock()
+        # tag -> {key: [reply bytes, timestamp]}
+        self.replies = {}
+        # tag -> time.monotonic() of the last time its slow ones were asked
+        self.refreshed = {}
+
+        self.stats = {"fastpolls": 0,
+                      "fullpolls": 0,
+                      "cachedreplies": 0}
+
+    def select(self, tag, plan):
+        """
+        Return the (commands, framing) that actually need to be sent to
+        the device with the given tag this time around.
+        """
+        if len(plan.slowKeys) == 0:
+            return plan.commands, plan.framing
+
+        with self.lock:
+            last = self.refreshed.get(tag, None)
+            if last is None or (time.monotonic() - last) >= self.slowInterval:
+                self.stats['fullpolls'] += 1
+                return plan.commands, plan.framing
+            else:
+                self.stats['fastpolls'] += 1
+                return plan.fastCommands, plan.fastFraming
+
+    def merge(self, tag, plan, replies):
+        """
+        Remember any slow replies in replies (as returned by
+        serialcomm.serComm()) and fill in the ones that weren't asked for
+        this time from what's remembered. Those are marked with a True as
+        their third element, so they're a [bytes, timestamp, True] list.
+        """
+        if replies is None or len(plan.slowKeys) == 0:
+            return replies
+
+        with self.lock:
+            known = self.replies.setdefault(tag, {})
+
+            fresh = [key for key in replies if key in plan.slowKeys]
+            for key in fresh:
+                known.update({key: [replies[key][0], replies[key][1]]})
+            if len(fresh) > 0:
+                self.refreshed.update({tag: time.monotonic()})
+
+            merged = {}
+            for entry in plan.entries:
+                if entry.key in replies:
+                    merged.update({entry.key: replies[entry.key]})
+                elif entry.key in known:
+                    merged.update({entry.key: known[entry.key] + [True]})
+                    self.stats['cachedreplies'] += 1
+
+            # Anything that wasn't part of the plan goes along too
+            for key in replies:
+                if key not in merged:
+                    merged.update({key: replies[key]})
+
+        return merged
+
+    def invalidate(self, tag, keys=None):
+        """
+        Make sure the slow queries for the device are asked on its next
+        poll, and forget the given keys (or all of them) in the meantime.
+        """
+        with self.lock:
+            self.refreshed.pop(tag, None)
+            if keys is None:
+                self.replies.pop(tag, None)
+            else:
+                for key in keys:
+                    self.replies.get(tag, {}).pop(key, None)
+
+    def report(self):
+        """
+        """
+        with self.lock:
+            return dict(self.stats)
+
+
+# Shared by both of the runtimes
+lastKnown = lastKnownCache()
+
+
+def getQueryPlan(device):
+    """
+    Return the (cached) queryPlan for the device type
+    """
+    device = device.lower()
+
+    plan = queryPlans.get(device, None)
+    if plan is None:
+        with planLock:
+            plan = queryPlans.get(device, None)
+            if plan is None:
+                plan = queryPlan(device)
+                queryPlans.update({device: plan})
+
+    return plan
+
+
+def devicePlan(dvice):
+    """
+    Return the (cached) queryPlan for the device itself; that's the one for
+    its type, unless it has its own calibration curves (see calibration.py)
+    """
+    key = (dvice.instrument, dvice.devtype, dvice.extratag)
+
+    plan = devicePlans.get(key, None)
+    if plan is None:
+        plan = getQueryPlan(dvice.devtype)
+
+        curves = calibration.deviceCurves(dvice)
+        if curves is not None:
+            driver = getDriver(dvice.devtype)
+            keys = None
+            if driver is not None:
+                keys = driver.calibrationKeys()
+            if keys is None:
+                print("%s can't be calibrated! Ignoring its curves." %
+                      (dvice.devtype))
+            else:
+                plan = calibratedPlan(dvice.devtype.lower(), curves, keys)
+                print("Converting sensors %s of %s with their curves" %
+                      (curves.sensors(), dvice.devtype))
+
+        with planLock:
+            plan = devicePlans.setdefault(key, plan)
+
+    return plan
+
+
 def translateRemoteAPI(dvice, cmd, value=None):
     """
     Given a device and a command string, and optionally a value, return the
@@ -102,9 +448,10 @@ def translateRemoteAPI(dvice, cmd, value=None):
     # More paranoia!
     try:
         cmd = cmd.lower()
-        dvtype = dvice.type.lower()
-        value = value.lower()
-    except ValueError:
+        dvtype = dvice.devtype.lower()
+        if value is not None:
+            value = value.lower()
+    except (AttributeError, ValueError):
         # This means something has gone very, very wrong.
         #   Take a shortcut to the exit
         dvtype = None
@@ -113,21 +460,22 @@ def translateRemoteAPI(dvice, cmd, value=None):
     fcmd = None
     cset = {}
 
-    if dvtype == 'vactransducer_mks972b':
-        fcmd = mks_kjl.brokerAPI(dvtype, cmd)
-
-    elif dvtype in ["sunpowergen1", "sunpowergen2"]:
-        fcmd = sunpower.brokerAPI(dvtype, cmd, value=None)
-
-    elif dvtype in ["lakeshore218", "lakeshore325"]:
-        fcmd = lakeshore.brokerAPI(dvtype, cmd, value=None)
-
-    elif dvtype in ['newport_ithx', 'newport_isd-tc']:
-        fcmd = newport.brokerAPI(dvtype, cmd, value=None)
+    if dvtype is not None:
+        driver = getDriver(dvtype)
+        if driver is not None:
+            try:
+                fcmd = driver.brokerAPI(cmd, value=value)
+            except (KeyError, UnboundLocalError):
+                # Not a command for this device, or a value that it
+                #   doesn't know what to do with
+                fcmd = None
 
     # Package it up for returning
     if fcmd is None:
         print("Unknown command %s!" % (cmd))
+    elif isinstance(fcmd, dict):
+        # Things like 'readall' are a whole set of commands
+        cset = fcmd
     else:
         cset = {cmd: fcmd}
 
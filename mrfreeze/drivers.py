@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Registry of the device drivers, by device type.
+
+A deviceDriver bundles up everything needed to talk to one type of
+device: its command set and terminator, serial parameters, reply framing
+and parser, remote API, and the function that publishes its replies.
+Everything else just looks the driver up by devtype.
+
+The drivers for the devices in this package are registered the first time
+one is looked up, along with any that other packages provide through the
+"mrfreeze.drivers" entry point group. Each of those entry points should
+give a deviceDriver, a list of them, or a function returning either.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import threading
+from importlib import metadata
+
+import serial
+
+entryPointGroup = "mrfreeze.drivers"
+
+# devtype (lower case) -> deviceDriver
+registry = {}
+registryLock = threading.Lock()
+loadLock = threading.Lock()
+loaded = False
+
+
+class deviceDriver():
+    """
+    One type of device, built on a vendor module like the ones in this
+    package; that is, one with these functions:
+
+        allCommands(device) -> (dict of commands, terminator)
+        defaultQueries(device) -> dict of query key: terminated command
+        replyFraming(device, cmd) -> (terminator, count) (see serialcomm)
+        replyParser(device) -> function(key, reply bytes) giving fields
+        queryCadence(device, key) -> "fast" or "slow" (optional)
+        brokerAPI(device, cmd, value=None) -> terminated command(s)
+        busQueries(device, addresses) -> default queries for each address
+        calibrationKeys(device) -> see devices.calibratedPlan (optional)
+        demux(device, replies) -> dict of address: replies (both optional)
+
+    publisher is the function that publishes the replies, with the same
+    arguments as publishers.publish_LSThing, and sParams are the serial
+    parameters (see serialcomm.serLocalComm) for a local serial port.
+    """
+    def __init__(self, devtype, module, publisher, sParams=None):
+        self.devtype = devtype.lower()
+        self.module = module
+        self.publisher = publisher
+        if sParams is None:
+            sParams = {}
+        self.sParams = sParams
+
+    def allCommands(self):
+        """
+        """
+        return self.module.allCommands(self.devtype)
+
+    def defaultQueries(self):
+        """
+        """
+        return self.module.defaultQueries(self.devtype)
+
+    def replyFraming(self, cmd):
+        """
+        """
+        return self.module.replyFraming(self.devtype, cmd)
+
+    def queryCadence(self, key):
+        """
+        "fast" or "slow" for the given default query key; vendor modules
+        don't have to say (with a queryCadence(device, key)) in which case
+        everything is "fast".
+        """
+        cadence = getattr(self.module, "queryCadence", None)
+        if cadence is None:
+            return "fast"
+
+        return cadence(self.devtype, key)
+
+    def replyParser(self):
+        """
+        """
+        return self.module.replyParser(self.devtype)
+
+    def calibrationKeys(self):
+        """
+        The (kelvin query key, raw query key, kelvin field format, raw
+        field format, sensor numbers) for converting the readings with
+        calibration curves,
+        or None if the vendor module doesn't have a calibrationKeys(device)
+        """
+        keys = getattr(self.module, "calibrationKeys", None)
+        if keys is None:
+            return None
+
+        return keys(self.devtype)
+
+    def busCapable(self):
+        """
+        True if more than one of this device can share a serial bus, which
+        needs busQueries(device, addresses) and demux(device, replies)
+        """
+        return hasattr(self.module, "busQueries") and \
+            hasattr(self.module, "demux")
+
+    def busQueries(self, addresses):
+        """
+        """
+        return self.module.busQueries(self.devtype, addresses)
+
+    def demux(self, replies):
+        """
+        """
+        return self.module.demux(self.devtype, replies)
+
+    def brokerAPI(self, cmd, value=None):
+        """
+        """
+        return self.module.brokerAPI(self.devtype, cmd, value=value)
+
+    def publish(self, dvice, replies, db=None, broker=None, compat=None,
+                debug=False):
+        """
+        """
+        return self.publisher(dvice, replies, db=db, broker=broker,
+                              compat=compat, debug=debug)
+
+
+def serialParams(baud, data, parity, stop):
+    """
+    """
+    return {"baud": baud, "data": data, "parity": parity, "stop": stop}
+
+
+def builtinDrivers():
+    """
+    The drivers for the devices that come with MrFreeze. Imported in here
+    since the publishers need the registry to be importable first.
+    """
+    from . import mks_kjl
+    from . import newport
+    from . import sunpower
+    from . import lakeshore
+    from . import publishers as pubs
+
+    mksSerial = serialParams(9600, serial.EIGHTBITS, serial.PARITY_NONE,
+                             serial.STOPBITS_ONE)
+    sunpowerSerial = serialParams(4800, serial.EIGHTBITS, serial.PARITY_NONE,
+                                  serial.STOPBITS_ONE)
+    lakeshoreSerial = serialParams(9600, serial.SEVENBITS, serial.PARITY_ODD,
+                                   serial.STOPBITS_ONE)
+
+    drvs = [deviceDriver("vactransducer_mks972b", mks_kjl,
+                         pubs.publish_MKS972b, sParams=mksSerial)]
+
+    for devtype in ["sunpowergen1", "sunpowergen2"]:
+        drvs.append(deviceDriver(devtype, sunpower, pubs.publish_Sunpower,
+                                 sParams=sunpowerSerial))
+
+    for devtype in ["lakeshore218", "lakeshore325"]:
+        drvs.append(deviceDriver(devtype, lakeshore, pubs.publish_LSThing,
+                                 sParams=lakeshoreSerial))
+
+    # These only ever talk over a socket, so there are no serial parameters
+    for devtype in ["newport_ithx", "newport_isd-tc"]:
+        drvs.append(deviceDriver(devtype, newport, pubs.publish_Newport))
+
+    return drvs
+
+
+def pluginDrivers(group=entryPointGroup):
+    """
+    Drivers provided by other installed packages through entry points
+    """
+    drvs = []
+
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group=group)
+    else:
+        eps = eps.get(group, [])
+
+    for ep in eps:
+        try:
+            thing = ep.load()
+            if callable(thing) and not isinstance(thing, deviceDriver):
+                thing = thing()
+            if isinstance(thing, deviceDriver):
+                thing = [thing]
+            drvs.extend(thing)
+            print("Loaded device driver plugin %s" % (ep.name))
+        except Exception as err:
+            print("Unable to load device driver plugin %s!" % (ep.name))
+            print(str(err))
+
+    return drvs
+
+
+def register(driver, replace=False):
+    """
+    Add driver to the registry under its devtype. An existing driver for
+    the same devtype is only replaced if replace is True.
+    """
+    with registryLock:
+        if driver.devtype in registry and replace is False:
+            print("Driver for %s already registered! Ignoring the new one." %
+                  (driver.devtype))
+        else:
+            registry.update({driver.devtype: driver})
+
+
+def loadDrivers():
+    """
+    Register the built in drivers and then any plugins, which are allowed
+    to replace the built in ones. Only happens once.
+    """
+    global loaded
+
+    with loadLock:
+        if loaded is True:
+            return
+
+        for driver in builtinDrivers():
+            register(driver)
+
+        for driver in pluginDrivers():
+            register(driver, replace=True)
+
+        loaded = True
+
+
+def getDriver(devtype):
+    """
+    Return the driver for the given device type, or None if there isn't one
+    """
+    if loaded is False:
+        loadDrivers()
+
+    return registry.get(devtype.lower(), None)
+
+
+def knownDevices():
+    """
+    """
+    if loaded is False:
+        loadDrivers()
+
+    return sorted(registry.keys())
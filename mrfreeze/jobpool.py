@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Bounded pool of worker threads for the scheduled device jobs.
+
+Jobs are submitted with a key, which for serial devices is their
+(devhost, devport) endpoint; jobs with the same key run one at a time and
+in the order they were submitted, since devices that share a MOXA port
+can't be talked to at the same time. Jobs with different keys run
+concurrently, up to the size of the pool.
+
+Jobs that someone is actually waiting on, like commands coming in over the
+broker, can be expedited; they go ahead of anything else waiting on their
+key and run in their own worker rather than queueing for one of the pool's.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class jobPool():
+    """
+    Run jobs in a bounded set of worker threads, serialized per key.
+
+    A job that's already waiting to run (by its tag) isn't queued a
+    second time; if a port is so slow that its jobs are still waiting by
+    the time they come up again, piling more of them up won't help.
+    """
+    def __init__(self, nworkers=4, nwaits=500):
+        self.nworkers = nworkers
+        self.executor = ThreadPoolExecutor(max_workers=nworkers,
+                                           thread_name_prefix="mrfreeze")
+        self.express = ThreadPoolExecutor(max_workers=1,
+                                          thread_name_prefix="express")
+
+        self.lock = threading.Lock()
+
+        # key -> deque of jobs waiting on that key
+        self.pending = {}
+        # keys that have a job handed to the executor
+        self.active = set()
+        # tags of all jobs submitted but not yet started
+        self.queued = set()
+
+        # Jobs handed to the executor that haven't started yet
+        self.waiting = 0
+
+        # Once shut down, anything still waiting on a key is dropped
+        self.closed = False
+
+        self.stats = {"submitted": 0,
+                      "completed": 0,
+                      "coalesced": 0,
+                      "expedited": 0,
+                      "maxdepth": 0}
+        # Recent job wait times, from submission to starting (seconds)
+        self.waits = deque(maxlen=nwaits)
+
+    def submit(self, key, tag, func, *args, **kwargs):
+        """
+        Queue up func(*args, **kwargs) to run once nothing else with the
+        same key is running. Returns False if it was coalesced into a job
+        with the same tag that's still waiting, True otherwise.
+        """
+        return self._submit(key, tag, func, args, kwargs, False)
+
+    def expedite(self, key, tag, func, *args, **kwargs):
+        """
+        Same as submit(), but func goes ahead of everything that's waiting
+        on the same key, and runs in the express worker. It still waits
+        for a job that's already running on the key to finish.
+        """
+        return self._submit(key, tag, func, args, kwargs, True)
+
+    def _submit(self, key, tag, func, args, kwargs, express):
+        """
+        """
+        job = (tag, func, args, kwargs, time.monotonic(), express)
+
+        with self.lock:
+            if self.closed is True:
+                return False
+
+            if tag is not None and tag in self.queued:
+                self.stats['coalesced'] += 1
+                return False
+
+            if tag is not None:
+                self.queued.add(tag)
+
+            if express is True:
+                # Behind any other expedited ones, but ahead of the rest
+                waiting = self.pending.setdefault(key, deque())
+                nexpress = 0
+                for each in waiting:
+                    if each[5] is not True:
+                        break
+                    nexpress += 1
+                waiting.insert(nexpress, job)
+                self.stats['expedited'] += 1
+            else:
+                self.pending.setdefault(key, deque()).append(job)
+            self.stats['submitted'] += 1
+
+            if key not in self.active:
+                self.active.add(key)
+                self._dispatch(key)
+
+            depth = self._depth()
+            if depth > self.stats['maxdepth']:
+                self.stats['maxdepth'] = depth
+
+        return True
+
+    def _dispatch(self, key):
+        """
+        Hand the next job for key to the executor. Lock must be held.
+        """
+        job = self.pending[key].popleft()
+        self.waiting += 1
+        if job[5] is True:
+            self.express.submit(self._run, key, job)
+        else:
+            self.executor.submit(self._run, key, job)
+
+    def _run(self, key, job):
+        """
+        """
+        tag, func, args, kwargs, tsubmit, _ = job
+
+        with self.lock:
+            self.waiting -= 1
+            self.queued.discard(tag)
+            self.waits.append(time.monotonic() - tsubmit)
+
+        try:
+            func(*args, **kwargs)
+        except Exception as err:
+            # The scheduled jobs catch their own, so this is just in case
+            print("Job %s failed! %s" % (tag, str(err)))
+        finally:
+            with self.lock:
+                self.stats['completed'] += 1
+                if len(self.pending[key]) > 0 and self.closed is False:
+                    self._dispatch(key)
+                else:
+                    self.active.discard(key)
+                    del self.pending[key]
+
+    def wrap(self, func, key, tag=None):
+        """
+        Return a function that, when called, submits func to the pool
+        instead of running it; handy for schedule's Job.do().
+
+        key can also be a callable taking no arguments, in which case it's
+        called each time to get the actual key (so a device that changes
+        its host or port ends up serialized with the right things).
+        """
+        @functools.wraps(func)
+        def submitter(*args, **kwargs):
+            if callable(key):
+                thiskey = key()
+            else:
+                thiskey = key
+            self.submit(thiskey, tag, func, *args, **kwargs)
+
+        return submitter
+
+    def _depth(self):
+        """
+        Number of jobs that are waiting, either on their key or for a
+        free worker. Lock must be held.
+        """
+        return sum([len(q) for q in self.pending.values()]) + self.waiting
+
+    def depth(self):
+        """
+        """
+        with self.lock:
+            return self._depth()
+
+    def report(self):
+        """
+        Queue depth, job wait times (seconds) and counters, for sizing
+        the pool.
+        """
+        with self.lock:
+            rep = dict(self.stats)
+            rep.update({"workers": self.nworkers,
+                        "depth": self._depth(),
+                        "busykeys": len(self.active)})
+            waits = sorted(self.waits)
+
+        if len(waits) > 0:
+            rep.update({"waitmean": sum(waits)/len(waits),
+                        "waitp95": waits[int(0.95*(len(waits) - 1))],
+                        "waitmax": waits[-1]})
+
+        return rep
+
+    def shutdown(self, wait=True):
+        """
+        Let whatever's running (or already handed to a worker) finish, but
+        don't start anything else that's still waiting on its key.
+        """
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=wait)
+        self.express.shutdown(wait=wait)
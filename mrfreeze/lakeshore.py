@@ -15,6 +15,9 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+import functools
+
+from . import parsers
 from .parsers import assignValueCmd
 
 
@@ -146,6 +149,66 @@ def defaultQueries(device):
     return cset
 
 
+def replyFraming(device, cmd):
+    """
+    Lake Shore units don't echo the command, and the replies (even the
+    multi-value ones like KRDG? on the 218) are one CRLF terminated line.
+    Commands that set something (SETP, RANGE) don't reply at all.
+    """
+    _, term = allCommands(device)
+
+    if "?" not in cmd:
+        return term, 0
+
+    return term, 1
+
+
+def queryCadence(device, key):
+    """
+    The setpoints and heater ranges/states only change when they're told
+    to, so there's no need to ask for them on every poll.
+    """
+    slow = []
+    if device == "lakeshore325":
+        slow = ["Setpoint1", "Setpoint2", "Heater1Range", "Heater2Range",
+                "Loop1State", "Loop2State"]
+
+    if key in slow:
+        return "slow"
+    else:
+        return "fast"
+
+
+def calibrationKeys(device):
+    """
+    For converting the sensor resistances to kelvin here instead (see
+    calibration.py): the query keys of the kelvin and resistance readings,
+    the formats of their field names for a given sensor number, and the
+    sensor numbers that are read.
+    """
+    keys = None
+    if device == 'lakeshore218':
+        keys = ("SensorTemps", "SensorTempsOhms", "Sensor%d", "Sensor%dOhm",
+                tuple(range(1, 9)))
+
+    return keys
+
+
+def replyParser(device):
+    """
+    Function taking (query key, reply bytes) and returning the parsed fields;
+    the key is needed since the replies don't say what they're answering.
+    """
+    if device == 'lakeshore218':
+        modelno = 218
+    elif device == 'lakeshore325':
+        modelno = 325
+    else:
+        modelno = None
+
+    return functools.partial(parsers.parseLakeShore, modelnum=modelno)
+
+
 def brokerAPI(dvice, cmd, value=None):
     """
     """
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Read deadlines learned from how long the devices take to answer.
+
+Every framed reply (see serialcomm.read_framed) that comes back complete
+has its response time recorded per (device, command). Once there are
+enough of them, the deadline for that command is a high percentile of
+those times plus a safety margin, kept between a floor and a ceiling;
+until then it's whatever timeout the caller asked for. A reply that
+doesn't make its deadline doubles the next one (up to the ceiling) until
+one does, so a deadline that's too tight fixes itself. Only a caller
+that gives a cap (like the breaker's half-open probe, see breaker.py)
+gets a deadline any shorter than what's been learned.
+
+What's been learned is saved as JSON so it survives restarts.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import math
+import time
+import threading
+from collections import deque
+
+
+def percentile(ordered, frac):
+    """
+    The frac (0 - 1) percentile of the already sorted list 'ordered'
+    """
+    if len(ordered) == 0:
+        return None
+
+    return ordered[int(round(frac*(len(ordered) - 1)))]
+
+
+class latencyTracker():
+    """
+    Response times by (device, command), and the read deadlines that come
+    from them; device is the device tag (see actions.deviceTag) and
+    command is the key of the command in the query dict.
+
+    The deadline is the 'pct' percentile of the last nsamples response
+    times, times margin, once there are at least minSamples of them.
+
+    If path is given, what's been learned is loaded from there now and
+    saved back there by save() and maybeSave().
+    """
+    def __init__(self, floor=0.1, ceiling=5., margin=1.5, pct=0.99,
+                 minSamples=20, nsamples=200, path=None, saveInterval=300.):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.margin = margin
+        self.pct = pct
+        self.minSamples = minSamples
+        self.nsamples = nsamples
+
+        self.path = path
+        self.saveInterval = saveInterval
+        self.lastSave = time.monotonic()
+        self.dirty = False
+
+        # (device, command) -> deque of response times (seconds)
+        self.samples = {}
+        # (device, command) -> number of missed deadlines in a row
+        self.misses = {}
+        # (device, command) -> learned deadline, None until there's enough
+        self.deadlines = {}
+
+        # Doubling any more than this many times can't go past the ceiling
+        self.maxDoublings = max(int(math.ceil(math.log2(ceiling/floor))), 0)
+
+        self.lock = threading.Lock()
+
+        if path is not None:
+            self.load()
+
+    def _clamp(self, value):
+        """
+        """
+        return min(max(value, self.floor), self.ceiling)
+
+    def _learn(self, key):
+        """
+        Update the learned deadline for key; lock must already be held
+        """
+        times = self.samples[key]
+        if len(times) < self.minSamples:
+            self.deadlines.update({key: None})
+        else:
+            top = percentile(sorted(times), self.pct)
+            self.deadlines.update({key: self._clamp(top*self.margin)})
+
+    def record(self, device, cmd, seconds):
+        """
+        """
+        key = (device, cmd)
+        with self.lock:
+            times = self.samples.setdefault(key,
+                                            deque(maxlen=self.nsamples))
+            times.append(seconds)
+            self.misses.pop(key, None)
+            self._learn(key)
+            self.dirty = True
+
+    def missed(self, device, cmd):
+        """
+        The reply to cmd didn't complete before its deadline
+        """
+        key = (device, cmd)
+        with self.lock:
+            misses = min(self.misses.get(key, 0) + 1, self.maxDoublings)
+            self.misses.update({key: misses})
+
+    def deadline(self, device, cmd, default, cap=None):
+        """
+        How long to wait for the reply to cmd; default is the timeout the
+        caller asked for, which is what's used until something's been
+        learned. If cap is given, it's the most it'll ever be.
+        """
+        key = (device, cmd)
+        learned = self.deadlines.get(key, None)
+        if learned is None:
+            learned = self._clamp(default)
+
+        misses = min(self.misses.get(key, 0), self.maxDoublings)
+        if misses > 0:
+            learned = self._clamp(learned*2**misses)
+
+        if cap is not None:
+            learned = min(learned, cap)
+
+        return learned
+
+    def load(self):
+        """
+        """
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            print("Unable to load response times from %s!" % (self.path))
+            print(str(err))
+            return
+
+        with self.lock:
+            for entry in saved.get("entries", []):
+                key = (entry['device'], entry['command'])
+                times = deque(entry['samples'], maxlen=self.nsamples)
+                self.samples.update({key: times})
+                self._learn(key)
+
+        print("Loaded response times for %d commands" % (len(self.samples)))
+
+    def save(self):
+        """
+        Write out what's been learned, replacing the old file in one go so
+        a crash halfway through can't leave a broken one behind
+        """
+        if self.path is None:
+            return
+
+        with self.lock:
+            entries = [{"device": key[0], "command": key[1],
+                        "samples": list(self.samples[key])}
+                       for key in self.samples]
+            self.dirty = False
+            self.lastSave = time.monotonic()
+
+        tmpname = "%s.tmp" % (self.path)
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname != "":
+                os.makedirs(dirname, exist_ok=True)
+            with open(tmpname, "w") as f:
+                json.dump({"entries": entries}, f)
+            os.replace(tmpname, self.path)
+        except OSError as err:
+            print("Unable to save response times to %s!" % (self.path))
+            print(str(err))
+
+    def maybeSave(self):
+        """
+        save(), if anything's changed and it's been at least saveInterval
+        seconds since the last time
+        """
+        if self.dirty is True and \
+           (time.monotonic() - self.lastSave) > self.saveInterval:
+            self.save()
+
+    def report(self):
+        """
+        Count, median, 95th and 99th percentile response times, and the
+        current deadline (all in seconds) for each device and command
+        """
+        rep = {}
+        with self.lock:
+            for key in self.samples:
+                times = sorted(self.samples[key])
+                rep.update({"%s/%s" % key:
+                            {"n": len(times),
+                             "p50": percentile(times, 0.5),
+                             "p95": percentile(times, 0.95),
+                             "p99": percentile(times, 0.99),
+                             "deadline": self.deadlines.get(key, None),
+                             "misses": self.misses.get(key, 0)}})
+
+        return rep
+
+
+# Shared by everything that talks to the devices
+tracker = latencyTracker()
@@ -15,6 +15,8 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+import threading
+
 from ligmos.utils import amqListeners as amqL
 from ligmos.utils import messageParsers as mP
 
@@ -22,6 +24,35 @@ from . import parsers
 from . import publishers
 
 
+class wakingMaintainer(amqL.queueMaintainer):
+    """
+    A queueMaintainer that also sets the 'wakeup' Event each time a
+    message adds something to its command queue, so the main loop can sleep
+    on that instead of waking up every so often just to check whether the
+    queue is empty.  Everything else that comes in (all the telemetry
+    topics) is left alone so it doesn't wake the main loop for nothing.
+    """
+    def __init__(self, *args, **kwargs):
+        super(wakingMaintainer, self).__init__(*args, **kwargs)
+        self.wakeup = threading.Event()
+
+    def queueLength(self):
+        """
+        """
+        try:
+            return len(self.brokerQueue)
+        except (AttributeError, TypeError):
+            return 0
+
+    def on_message(self, *args, **kwargs):
+        before = self.queueLength()
+        try:
+            return super(wakingMaintainer, self).on_message(*args, **kwargs)
+        finally:
+            if self.queueLength() > before:
+                self.wakeup.set()
+
+
 def newFreezie(cmdTopic, replyTopic, dbconn=None):
     """
     """
@@ -62,12 +93,12 @@ def newFreezie(cmdTopic, replyTopic, dbconn=None):
                 "LOUI.nasa42.loisCommandResult": checkLOIS}
 
     # Create our subclassed consumer with the above routes
-    consumer = amqL.queueMaintainer(cmdTopic, replyTopic,
-                                    dbconn=dbconn,
-                                    tSpecial=tSpecial,
-                                    tkXMLSpecial=tkXMLSpecial,
-                                    tXML=tXML, tFloat=tFloat,
-                                    tStr=tStr, tBool=tBool)
+    consumer = wakingMaintainer(cmdTopic, replyTopic,
+                                dbconn=dbconn,
+                                tSpecial=tSpecial,
+                                tkXMLSpecial=tkXMLSpecial,
+                                tXML=tXML, tFloat=tFloat,
+                                tStr=tStr, tBool=tBool)
 
     return consumer
 
@@ -15,8 +15,10 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+from . import parsers
 
-def allCommands(device):
+
+def allCommands(device, address=254):
     """
     This is the command set for the MKS 972b gauge itself.
 
@@ -27,16 +29,19 @@ def allCommands(device):
     8 data, 1 stop bit
     no parity
     ';FF' termination
+
+    address is the gauge's RS-485 address; the default of 254 is the
+    broadcast address, which is fine as long as it's the only one there.
     """
     cset = None
     term = None
 
     if device == "vactransducer_mks972b":
         term = ";FF"
-        mp = "@254PR1?"
-        cc = "@254PR2?"
-        d3 = "@254PR3?"
-        d4 = "@254PR4?"
+        mp = "@%03dPR1?" % (address)
+        cc = "@%03dPR2?" % (address)
+        d3 = "@%03dPR3?" % (address)
+        d4 = "@%03dPR4?" % (address)
 
         cset = {"micropirani": mp,
                 "coldcathode": cc,
@@ -46,14 +51,14 @@ def allCommands(device):
     return cset, term
 
 
-def defaultQueries(device):
+def defaultQueries(device, address=254):
     """
     First get the full command set for this particular device.
 
     These are stored by a key that represents the actual command,
     so I don't forget.
     """
-    allCmds, term = allCommands(device=device)
+    allCmds, term = allCommands(device=device, address=address)
 
     cset = None
 
@@ -65,7 +70,76 @@ def defaultQueries(device):
     return cset
 
 
-def brokerAPI(dvice, cmd):
+def busQueries(device, addresses):
+    """
+    The default queries for each of the gauges at the given addresses on
+    the same RS-485 bus, one after the other. The keys are
+    '<address>/<query key>' so demux() knows what was asked of who.
+    """
+    cset = {}
+    for addr in addresses:
+        queries = defaultQueries(device, address=addr)
+        for key in queries:
+            cset.update({"%03d/%s" % (addr, key): queries[key]})
+
+    return cset
+
+
+def demux(device, replies):
+    """
+    Sort the replies to busQueries() out by gauge, going by the address
+    each reply was echoed back with (or the one it was sent to, if there
+    wasn't a reply). Returns a dict of address: replies for that gauge
+    keyed by the usual query keys.
+    """
+    byAddress = {}
+    for key in replies:
+        addr, qkey = key.split("/", 1)
+        addr = int(addr)
+
+        if len(replies[key][0]) > 0:
+            try:
+                addr = int(parsers.parseMKS(replies[key][0], debug=False)[0])
+            except (UnboundLocalError, ValueError):
+                print("Garbled reply on the bus for %s: %s" %
+                      (key, replies[key][0]))
+
+        byAddress.setdefault(addr, {}).update({qkey: replies[key]})
+
+    return byAddress
+
+
+def replyFraming(device, cmd):
+    """
+    Replies are a single '@<addr><ACK|NAK><value>;FF' so they're done
+    as soon as we see the (same) terminator that the commands use.
+    """
+    _, term = allCommands(device)
+
+    return term, 1
+
+
+def parseReply(key, reply):
+    """
+    Only take the value if the gauge ACKed the command, and name it
+    after the query key it's the answer to
+    """
+    fields = {}
+    d, s, v = parsers.parseMKS(reply)
+    if s == 'ACK':
+        fields.update({key: float(v[0])})
+
+    return fields
+
+
+def replyParser(device):
+    """
+    Function taking (query key, reply bytes) and returning the parsed fields
+    """
+    return parseReply
+
+
+def brokerAPI(dvice, cmd, value=None):
     """
     These are simple, since they take no arguments/values
     """
@@ -15,6 +15,10 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+import functools
+
+from . import parsers
+
 
 def allCommands(device):
     """
@@ -72,6 +76,22 @@ def defaultQueries(device):
     return cset
 
 
+def replyFraming(device, cmd):
+    """
+    Replies are one CR terminated line.
+    """
+    _, term = allCommands(device)
+
+    return term, 1
+
+
+def replyParser(device):
+    """
+    Function taking (query key, reply bytes) and returning the parsed fields
+    """
+    return functools.partial(parsers.parseNewport, debug=True)
+
+
 def brokerAPI(dvice, cmd, value=None):
     """
     """
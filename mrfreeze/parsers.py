@@ -133,7 +133,9 @@ def parseSunpower(reply):
         # Split the response into its parts; skip the first line
         #   since it's just a command echo but keep it for parse routing.
         splits = dr.split(splitter)
-        cmd = splits[0]
+        # Commands that set something are echoed with the value they were
+        #   given, i.e. 'SET TTARGET=105.000', so strip that off
+        cmd = splits[0].split("=")[0].strip()
         # Last one is always '' because of the ending line termination
         rep = splits[1:-1]
 
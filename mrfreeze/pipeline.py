@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Decoupled publishing of the device replies.
+
+The jobs that talk to the devices just put the replies on a bounded queue
+in a publishStage, and its worker thread(s) do the parsing and publishing
+to the brokers, databases and instrument compatibility layer. A slow
+database commit or broker publish then only backs up the queue, rather
+than holding up the next device's poll.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import queue
+import threading
+import datetime as dt
+from collections import deque
+
+from . import actions
+from . import spool as spl
+
+
+def encodeReply(reply):
+    """
+    Turn a reply as given by serialcomm.serComm() into something that
+    can be written to a spool.diskSpool
+    """
+    enc = {}
+    for key in reply:
+        # Anything after the bytes and timestamp (like the flag on cached
+        #   replies from devices.lastKnownCache) just goes along as-is
+        byteReply, t = reply[key][0], reply[key][1]
+        enc.update({key: [byteReply.decode("latin-1"),
+                          t.strftime("%Y-%m-%dT%H:%M:%S.%f")] +
+                    reply[key][2:]})
+
+    return enc
+
+
+def decodeReply(enc):
+    """
+    The reverse of encodeReply()
+    """
+    reply = {}
+    for key in enc:
+        strReply, tstr = enc[key][0], enc[key][1]
+        reply.update({key: [strReply.encode("latin-1"),
+                            dt.datetime.strptime(tstr,
+                                                 "%Y-%m-%dT%H:%M:%S.%f")] +
+                      enc[key][2:]})
+
+    return reply
+
+
+class publishStage():
+    """
+    Bounded queue of device replies waiting to be published, and the
+    nworkers threads that publish them via actions.routeReply().
+
+    When the queue is full, 'policy' decides what happens to a new reply:
+        'block'      - the job waits until there's room (the default)
+        'dropoldest' - the oldest waiting reply is dropped to make room
+        'spool'      - the new reply goes to 'spool' (a spool.diskSpool)
+                       and is put back on the queue once it's drained
+    One worker keeps each device's replies in order; more than one can
+    publish faster, but then that's no longer guaranteed.
+
+    Spooled replies from a device that still hasn't been registered
+    routeGrace seconds after start() (say it's since been taken out of
+    the config) are skipped, so they don't hold up everything behind them.
+    """
+    def __init__(self, maxsize=1000, nworkers=1, policy='block', spool=None,
+                 replayRate=50., nwaits=500, routeGrace=120.):
+        if policy not in ['block', 'dropoldest', 'spool']:
+            raise ValueError("Unknown backpressure policy %s!" % (policy))
+        if policy == 'spool' and spool is None:
+            raise ValueError("The 'spool' policy needs a spool!")
+
+        self.maxsize = maxsize
+        self.nworkers = nworkers
+        self.policy = policy
+
+        self.queue = queue.Queue(maxsize=maxsize)
+
+        self.spool = spool
+        self.replayer = None
+        if spool is not None:
+            self.replayer = spl.spoolReplayer(spool, self._replay, batch=1,
+                                              rate=replayRate, retry=5.)
+
+        # device tag -> (dvice, dbObj, bkObj, compat, debug), so that
+        #   spooled replies can be routed once they're replayed; see
+        #   register()
+        self.routes = {}
+        self.routeGrace = routeGrace
+        self.started = None
+
+        self.lock = threading.Lock()
+        self.threads = []
+
+        self.stats = {"queued": 0,
+                      "published": 0,
+                      "dropped": 0,
+                      "spooled": 0,
+                      "replayed": 0,
+                      "unroutable": 0,
+                      "maxdepth": 0}
+        # Recent times from being queued to being published (seconds)
+        self.waits = deque(maxlen=nwaits)
+
+    def register(self, dvice, dbObj, bkObj, compat=None, debug=False):
+        """
+        Set up where the replies from dvice (and from the devices on its
+        bus, if it has any) are published, so the ones that were spooled
+        before a restart can go out before it's been polled again; same
+        arguments as actions.routeReply().
+        """
+        route = (dvice, dbObj, bkObj, compat, debug)
+        with self.lock:
+            self.routes.update({actions.deviceTag(dvice): route})
+
+        addresses = actions.busAddresses(dvice)
+        if addresses is not None:
+            for address in addresses:
+                member = actions.busMember(dvice, address)
+                with self.lock:
+                    self.routes.update({actions.deviceTag(member):
+                                        (member,) + route[1:]})
+
+    def put(self, dvice, reply, dbObj, bkObj, compat=None, debug=False):
+        """
+        Queue up a reply to be published; same arguments as
+        actions.routeReply(). Nothing is queued if the reply is None.
+        """
+        if reply is None:
+            return
+
+        tag = actions.deviceTag(dvice)
+        with self.lock:
+            self.routes.update({tag: (dvice, dbObj, bkObj, compat, debug)})
+
+        item = (tag, reply, time.monotonic())
+        if self.policy == 'block':
+            self.queue.put(item)
+        elif self.policy == 'dropoldest':
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        with self.lock:
+                            self.stats['dropped'] += 1
+                    except queue.Empty:
+                        pass
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.spool.append({"tag": tag,
+                                   "reply": encodeReply(reply)})
+                with self.lock:
+                    self.stats['spooled'] += 1
+                return
+
+        with self.lock:
+            self.stats['queued'] += 1
+            depth = self.queue.qsize()
+            if depth > self.stats['maxdepth']:
+                self.stats['maxdepth'] = depth
+
+    def _replay(self, records):
+        """
+        Sender for the spoolReplayer; only puts things back on the queue
+        when there's room and it's known where they go (see register()),
+        otherwise they wait in the spool a bit longer
+        """
+        for rec in records:
+            if rec['tag'] not in self.routes:
+                # Spooled before a restart, and the device hasn't been
+                #   scheduled this time around; give it a chance to be,
+                #   but it's probably not configured anymore after that
+                waited = time.monotonic() - self.started
+                if waited < self.routeGrace:
+                    raise LookupError("Nowhere to publish spooled replies "
+                                      "from %s yet; keeping them" %
+                                      (rec['tag']))
+
+                print("Nowhere to publish spooled replies from %s;"
+                      " skipping them" % (rec['tag']))
+                with self.lock:
+                    self.stats['unroutable'] += 1
+                continue
+
+            item = (rec['tag'], decodeReply(rec['reply']), time.monotonic())
+            self.queue.put_nowait(item)
+            with self.lock:
+                self.stats['replayed'] += 1
+
+    def _work(self):
+        """
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            tag, reply, tqueued = item
+            with self.lock:
+                dvice, dbObj, bkObj, compat, debug = self.routes[tag]
+                self.waits.append(time.monotonic() - tqueued)
+
+            try:
+                # routeReply catches its own, so this is just in case
+                actions.routeReply(dvice, reply, dbObj, bkObj,
+                                   compat=compat, debug=debug)
+            except Exception as err:
+                print("Publishing for %s failed! %s" % (tag, str(err)))
+            finally:
+                with self.lock:
+                    self.stats['published'] += 1
+                self.queue.task_done()
+
+    def start(self):
+        """
+        """
+        self.started = time.monotonic()
+        for i in range(self.nworkers):
+            thread = threading.Thread(target=self._work,
+                                      name="publisher-%d" % (i),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        if self.replayer is not None:
+            self.replayer.start()
+
+    def stop(self):
+        """
+        Publish everything that's still queued, then stop the workers.
+        Anything still in the spool stays there for next time.
+        """
+        if self.replayer is not None:
+            self.replayer.stop()
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def depth(self):
+        """
+        """
+        return self.queue.qsize()
+
+    def report(self):
+        """
+        Queue depth, counters, and the time (seconds) replies spend
+        waiting to be published
+        """
+        with self.lock:
+            rep = dict(self.stats)
+            rep.update({"depth": self.queue.qsize(),
+                        "maxsize": self.maxsize,
+                        "policy": self.policy})
+            waits = sorted(self.waits)
+
+        if len(waits) > 0:
+            rep.update({"waitmean": sum(waits)/len(waits),
+                        "waitp95": waits[int(0.95*(len(waits) - 1))],
+                        "waitmax": waits[-1]})
+
+        if self.spool is not None:
+            rep.update({"spool": self.spool.report()})
+
+        return rep
@@ -13,6 +13,8 @@
 
 from __future__ import division, print_function, absolute_import
 
+import re
+import logging
 import datetime as dt
 from collections import OrderedDict
 from uuid import uuid4
@@ -21,7 +23,21 @@ import xmltodict as xmld
 
 from ligmos.utils import packetizer
 
-from . import parsers
+from . import devices
+
+
+logger = logging.getLogger(__name__)
+
+# What xmltodict.unparse() always starts with
+xmlHeader = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+# Tag names that are safe to write directly; anything else (including
+#   xmltodict's special '@attribute' and '#text' keys) goes to xmltodict
+simpleTag = re.compile(r"^[A-Za-z_][A-Za-z0-9_.:-]*$")
+knownTags = set()
+
+# (rootTag, measurement) -> the fixed bits of the packet around the values
+packetTemplates = {}
 
 
 def constructCommand(inst, device, tag, cmd,
@@ -45,6 +61,38 @@ def constructCommand(inst, device, tag, cmd,
     return pak
 
 
+def constructCommandReply(request, status, result, latency, exectime,
+                          debug=False):
+    """
+    Reply to a command request (as taken off of the command queue), under
+    the same cmd_id so the sender can match it up.
+
+    status is a short string like "OK" or "Failed", result is a dict of
+    whatever was parsed from the device's reply, and latency and exectime
+    are the seconds from when the request was picked up until the device
+    answered, and that the device itself took.
+    """
+    mstr = "reply"
+    fields = {}
+
+    fields.update({"instrument": request['request_instrument']})
+    fields.update({"devicetype": request['request_devicetype']})
+    fields.update({"tag": request['request_tag']})
+    fields.update({"command": request['request_command']})
+    fields.update({"argument": request['request_argument']})
+    fields.update({"status": status})
+    fields.update({"latency": latency})
+    fields.update({"exectime": exectime})
+    fields.update({"result": result})
+
+    pak = constructXMLPacket(mstr, fields, cmd_id=request['cmd_id'],
+                             toq=request['timeonqueue'],
+                             rootTag="MrFreezeCommunique",
+                             debug=debug)
+
+    return pak
+
+
 def advertiseConfiged(config, cmdid, toq, debug=True):
     """
     Given a parsed configuration object, construct an advertisement
@@ -106,6 +154,30 @@ def constructXMLPacket(measurement, fields, cmd_id=None, toq=None,
         #   somewhere like a database, it'll complain so just keep it a float
         toq = -1.0
 
+    try:
+        xPacket = fastXMLPacket(measurement, fields, cmd_id, toq,
+                                rootTag=rootTag)
+    except ValueError:
+        # Something the fast way doesn't know how to write; let xmltodict
+        #   deal with it (or complain about it)
+        xPacket = xmld.unparse(xmlPacketDict(measurement, fields, cmd_id,
+                                             toq, rootTag=rootTag))
+
+    # Only bother making the pretty version if it's going somewhere
+    if debug is True and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(xmld.unparse(xmlPacketDict(measurement, fields,
+                                                cmd_id, toq,
+                                                rootTag=rootTag),
+                                  pretty=True))
+
+    return xPacket
+
+
+def xmlPacketDict(measurement, fields, cmd_id, toq,
+                  rootTag="MrFreezeCommunique"):
+    """
+    The packet as the dict that xmltodict.unparse() turns into XML
+    """
     dPacket = OrderedDict()
 
     # These should always be here
@@ -115,11 +187,98 @@ def constructXMLPacket(measurement, fields, cmd_id=None, toq=None,
 
     # Put everything under the given rootTag
     dPacket.update({rootTag: restOfStuff})
-    xPacket = xmld.unparse(dPacket)
-    if debug is True:
-        print(xmld.unparse(dPacket, pretty=True))
 
-    return xPacket
+    return dPacket
+
+
+def fastXMLPacket(measurement, fields, cmd_id, toq,
+                  rootTag="MrFreezeCommunique"):
+    """
+    Write the same XML that xmltodict.unparse(xmlPacketDict(...)) does,
+    but directly, with the parts that never change for a given rootTag
+    and measurement worked out just once.
+
+    Raises ValueError for anything it can't write exactly the same way.
+    """
+    template = packetTemplates.get((rootTag, measurement), None)
+    if template is None:
+        xmlTag(rootTag)
+        xmlTag(measurement)
+        template = ("%s<%s><cmd_id>" % (xmlHeader, rootTag),
+                    "</cmd_id><timeonqueue>",
+                    "</timeonqueue><%s>" % (measurement),
+                    "</%s></%s>" % (measurement, rootTag))
+        packetTemplates.update({(rootTag, measurement): template})
+
+    out = [template[0], xmlText(cmd_id), template[1], xmlText(toq),
+           template[2]]
+    xmlChildren(fields, out)
+    out.append(template[3])
+
+    return "".join(out)
+
+
+def xmlTag(tag):
+    """
+    Make sure that tag can be written as-is, and return it
+    """
+    if tag not in knownTags:
+        if not isinstance(tag, str) or simpleTag.match(tag) is None:
+            raise ValueError("Can't quickly write tag %s" % (tag))
+        knownTags.add(tag)
+
+    return tag
+
+
+def xmlText(value):
+    """
+    Element text for value, the way xmltodict would write it
+    """
+    if value is None:
+        return ""
+    elif value is True:
+        return "true"
+    elif value is False:
+        return "false"
+    elif isinstance(value, str):
+        text = value
+    elif isinstance(value, (int, float)):
+        # Nothing that needs escaping in a number
+        return str(value)
+    else:
+        raise ValueError("Can't quickly write a %s" % (type(value)))
+
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+
+    return text
+
+
+def xmlChildren(fields, out):
+    """
+    Append the elements for each of the things in the fields dict to out.
+    Like xmltodict, lists are written as repeated elements (and empty ones
+    not at all) and dicts as nested ones.
+    """
+    for key in fields:
+        tag = xmlTag(key)
+        value = fields[key]
+        if isinstance(value, list):
+            values = value
+        else:
+            values = [value]
+
+        for each in values:
+            if isinstance(each, dict):
+                out.append("<%s>" % (tag))
+                xmlChildren(each, out)
+                out.append("</%s>" % (tag))
+            else:
+                out.append("<%s>%s</%s>" % (tag, xmlText(each), tag))
 
 
 def makeAndPublishAMQ(measname, fields, ts, broker, topic, debug=False):
@@ -158,11 +317,15 @@ def makeAndPublishAMQ(measname, fields, ts, broker, topic, debug=False):
         broker.publish(topic, xmlpkt, debug=True)
 
 
-def makeAndPublishIDB(measname, fields, db, tags, table, debug=False):
+def makeAndPublishIDB(measname, fields, db, tags, table, ts=None,
+                      debug=False):
     """
     Same as above! Often repeated so now it's a function
+
+    ts should be the datetime the reading was taken, since it might be a
+      little while before it's actually published
     """
-    pkt = packetizer.makeInfluxPacket(measname, ts=None,
+    pkt = packetizer.makeInfluxPacket(measname, ts=ts,
                                       tags=tags, fields=fields,
                                       debug=debug)
 
@@ -170,6 +333,19 @@ def makeAndPublishIDB(measname, fields, db, tags, table, debug=False):
         db.singleCommit(pkt, table=table, close=True)
 
 
+def updateCompat(compat, dvice, fields, ts):
+    """
+    Put the fields from dvice into whichever section of the compatibility
+    upfile (compat) its template says they go, if there's one at all
+    """
+    if compat is None:
+        return
+
+    sect = compat.sectionFor(dvice)
+    if sect is not None:
+        compat.updateSection(sect, fields, ts=ts)
+
+
 def publish_LSThing(dvice, replies, db=None, broker=None, compat=None,
                     debug=False):
     """
@@ -179,39 +355,17 @@ def publish_LSThing(dvice, replies, db=None, broker=None, compat=None,
     replies[reply][0] is the bytes message
     replies[reply][1] is the timestamp
     """
-    # Check what kind of lakeshore thing we have here
-    lakeshorething = dvice.devtype.lower()
-    if lakeshorething == 'lakeshore218':
-        modelno = 218
-    elif lakeshorething == 'lakeshore325':
-        modelno = 325
-    else:
-        modelno = None
-
     measname = ["%s_%s" % (dvice.instrument, dvice.devtype)]
     tags = {"Device": dvice.devtype}
-    fields = {}
-    for reply in replies:
-        ans = parsers.parseLakeShore(reply, replies[reply][0],
-                                     modelnum=modelno)
-
-        if ans != {}:
-            fields.update(ans)
-            lastTS = replies[reply][1]
+    fields, lastTS = devices.devicePlan(dvice).parse(replies)
 
     if fields != {}:
         makeAndPublishAMQ(measname, fields, lastTS, broker, dvice.brokertopic,
                           debug=debug)
         makeAndPublishIDB(measname, fields, db, tags, dvice.tablename,
-                          debug=debug)
-
-        if compat is not None:
-            if modelno == 218:
-                sect = "NIHTS_Lakeshore218"
-            elif modelno == 325:
-                sect = "NIHTS_Lakeshore325"
+                          ts=lastTS, debug=debug)
 
-            compat.updateSection(sect, fields)
+        updateCompat(compat, dvice, fields, lastTS)
 
     return compat
 
@@ -235,30 +389,17 @@ def publish_Sunpower(dvice, replies, db=None, broker=None, compat=None,
 
     measname = [measname]
     tags = {"Device": dvice.devtype}
-    fields = {}
-
-    lastTS = None
-    for reply in replies:
-        ans = parsers.parseSunpower(replies[reply][0])
-        if ans != {}:
-            fields.update(ans)
-            lastTS = replies[reply][1]
+    fields, lastTS = devices.devicePlan(dvice).parse(replies)
 
     if fields != {}:
         makeAndPublishAMQ(measname, fields, lastTS, broker, dvice.brokertopic,
                           debug=debug)
         makeAndPublishIDB(measname, fields, db, tags, dvice.tablename,
-                          debug=debug)
+                          ts=lastTS, debug=debug)
 
-        if compat is not None:
-            # Since there are two coolers, we need to check which is which
-            #   based on the extratag we gave it
-            if dvice.extratag == "BenchCooler":
-                sect = "NIHTS2_cooler"
-            elif dvice.extratag == "DetectorCooler":
-                sect = "NIHTS1_cooler"
-
-            compat.updateSection(sect, fields)
+        # Since there can be two coolers, the upfile template tells
+        #   which is which based on the extratag we gave it
+        updateCompat(compat, dvice, fields, lastTS)
 
     return compat
 
@@ -275,23 +416,22 @@ def publish_MKS972b(dvice, replies, db=None, broker=None, compat=None,
     # Make an InfluxDB packet
     measname = ["%s_%s" % (dvice.instrument, dvice.devtype)]
     tags = {"Device": dvice.devtype}
-    fields = {}
-    for reply in replies:
-        d, s, v = parsers.parseMKS(replies[reply][0])
-        # Check the command status (ACK == good)
-        if s == 'ACK':
-            fieldname = reply
-            fields.update({fieldname: float(v[0])})
-            lastTS = replies[reply][1]
+    # One of several gauges on a bus (see actions.busMember)
+    address = getattr(dvice, "busaddress", None)
+    if address is not None:
+        measname = ["%s_%s_%03d" % (dvice.instrument, dvice.devtype,
+                                    address)]
+        tags.update({"Address": "%03d" % (address)})
+    # Only replies with an ACK status make it into the fields
+    fields, lastTS = devices.devicePlan(dvice).parse(replies)
 
     if fields != {}:
         makeAndPublishAMQ(measname, fields, lastTS, broker, dvice.brokertopic,
                           debug=debug)
         makeAndPublishIDB(measname, fields, db, tags, dvice.tablename,
-                          debug=debug)
+                          ts=lastTS, debug=debug)
 
-        if compat is not None:
-            compat.updateSection("NIHTS_vacgauge", fields)
+        updateCompat(compat, dvice, fields, lastTS)
 
     return compat
 
@@ -307,18 +447,37 @@ def publish_Newport(dvice, replies, db=None, broker=None, compat=None,
     """
     measname = ["%s_%s" % (dvice.instrument, dvice.devtype)]
     tags = {"Device": dvice.devtype}
-    fields = {}
-    for reply in replies:
-        ans = parsers.parseNewport(reply, replies[reply][0], debug=True)
-
-        if ans != {}:
-            fields.update(ans)
-            lastTS = replies[reply][1]
+    fields, lastTS = devices.devicePlan(dvice).parse(replies)
 
     if fields != {}:
         makeAndPublishAMQ(measname, fields, lastTS, broker, dvice.brokertopic,
                           debug=debug)
         makeAndPublishIDB(measname, fields, db, tags, dvice.tablename,
-                          debug=debug)
+                          ts=lastTS, debug=debug)
+
+        updateCompat(compat, dvice, fields, lastTS)
 
     return compat
+
+
+def publish_Breaker(dvice, endpoint, change, report, db=None, broker=None,
+                    debug=False):
+    """
+    Publish a state change of the circuit breaker (see breaker.py) for the
+    endpoint that dvice is on; change is the (old, new) state and report
+    is the breaker's report() from right after it.
+    """
+    measname = ["%s_%s_breaker" % (dvice.instrument, dvice.devtype)]
+    tags = {"Device": dvice.devtype}
+    fields = {"Endpoint": "%s:%s" % (endpoint[0], endpoint[1]),
+              "PreviousState": change[0],
+              "State": change[1],
+              "Failures": report['failures'],
+              "Trips": report['trips'],
+              "RetryIn": float(report.get('retryin', 0.))}
+    ts = dt.datetime.utcnow()
+
+    makeAndPublishAMQ(measname, fields, ts, broker, dvice.brokertopic,
+                      debug=debug)
+    makeAndPublishIDB(measname, fields, db, tags, dvice.tablename,
+                      ts=ts, debug=debug)
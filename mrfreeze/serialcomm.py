@@ -8,17 +8,26 @@
 #
 #  @author: rhamilton
 
-"""One line description of module.
+"""Serial and serial-over-socket communications with the devices.
 
-Further description.
+Sessions to the devices are kept open between polls by a keyed pool
+(serialPool) rather than being opened and torn down for each query.
 """
 
 from __future__ import division, print_function, absolute_import
 
+import time
+import select
+import socket
+import threading
 import datetime as dt
+from collections.abc import Mapping
+from contextlib import contextmanager
 
 import serial
 
+from . import latency
+
 
 def encoder(msg):
     """
@@ -49,6 +58,59 @@ def read_all(port, chunk_size=1024):
     return read_buffer
 
 
+def read_framed(port, term, count=1, idle=0.05):
+    """
+    Read a reply that's complete once 'term' has shown up 'count' times,
+    and return it as soon as that happens. The port's timeout is now only
+    the upper bound on how long the whole reply can take, rather than
+    something that always has to be waited out.
+
+    If count is None the length of the reply isn't known ahead of time, so
+    once at least one terminator is in hand the reply is considered done
+    as soon as nothing more arrives for 'idle' seconds.
+
+    If count is 0 there's no reply coming at all (like the set commands of
+    some devices), so there's nothing to wait for.
+    """
+    if not port.timeout:
+        raise TypeError('Port needs to have a timeout set!')
+
+    if count == 0:
+        return b''
+
+    term = encoder(term)
+    timeout = port.timeout
+    deadline = time.monotonic() + timeout
+
+    read_buffer = b''
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            quieting = count is None and term in read_buffer
+            if quieting is True:
+                port.timeout = min(idle, remaining)
+            else:
+                port.timeout = remaining
+
+            byte_chunk = port.read(size=max(1, port.in_waiting))
+            if byte_chunk == b'':
+                if quieting is True:
+                    break
+                continue
+
+            read_buffer += byte_chunk
+            if count is not None and read_buffer.count(term) >= count:
+                break
+    finally:
+        # Put it back the way we found it
+        port.timeout = timeout
+
+    return read_buffer
+
+
 def serWriter(ser, msg):
     """
     """
@@ -62,7 +124,247 @@ def serWriter(ser, msg):
         print(str(err))
 
 
-def serComm(host, port, cmds, timeout=1., debug=False):
+class serialPool():
+    """
+    Keyed pool of open serial sessions, one per (host, port) endpoint.
+
+    Sessions are kept open across polls and handed out under a per-endpoint
+    lock, so there is only ever one session (and one transaction in flight)
+    per endpoint. Before each reuse the session is checked for a half-open
+    socket (the MOXA or device went away underneath us), in which case
+    it's closed and a new one opened in its place.
+
+    Local serial ports use the same machinery with a port of -1, matching
+    the convention in the device configuration.
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.locks = {}
+        self.poolLock = threading.Lock()
+
+        # Counters for diagnostics/telemetry
+        self.stats = {"opened": 0,
+                      "reused": 0,
+                      "reconnects": 0,
+                      "failures": 0}
+
+    def _getLock(self, key):
+        """
+        Get the lock for the given endpoint, creating it if needed
+        """
+        with self.poolLock:
+            if key not in self.locks:
+                self.locks[key] = threading.RLock()
+            return self.locks[key]
+
+    def _count(self, stat):
+        """
+        """
+        with self.poolLock:
+            self.stats[stat] += 1
+
+    @contextmanager
+    def session(self, key, opener, timeout=1.):
+        """
+        Context manager yielding an open session for the endpoint 'key'.
+
+        'opener' must be a callable taking no arguments that returns a
+        freshly opened serial instance; it's only called if there isn't
+        already a healthy session for this endpoint.
+
+        If anything goes wrong while the session is in use, it's closed
+        and dropped from the pool so the next user gets a fresh one.
+        """
+        with self._getLock(key):
+            ser = self.sessions.get(key, None)
+            if ser is not None:
+                if sessionAlive(ser) is True:
+                    self._count("reused")
+                else:
+                    print("Session to %s is stale; reconnecting" % (str(key)))
+                    self._count("reconnects")
+                    closeQuietly(ser)
+                    ser = None
+
+            if ser is None:
+                try:
+                    ser = opener()
+                except Exception:
+                    self._count("failures")
+                    self.sessions.pop(key, None)
+                    raise
+                self._count("opened")
+                self.sessions[key] = ser
+
+            # Timeouts can differ between users of the same endpoint
+            ser.timeout = timeout
+            ser.write_timeout = timeout
+
+            try:
+                yield ser
+            except Exception:
+                self._count("failures")
+                self.drop(key)
+                raise
+
+    def drop(self, key):
+        """
+        Close and forget the session for the given endpoint, if any
+        """
+        with self._getLock(key):
+            ser = self.sessions.pop(key, None)
+            if ser is not None:
+                closeQuietly(ser)
+
+    def closeAll(self):
+        """
+        """
+        for key in list(self.sessions.keys()):
+            self.drop(key)
+
+    def report(self):
+        """
+        Return a copy of the counters, plus the number of open sessions
+        """
+        with self.poolLock:
+            rep = dict(self.stats)
+        rep.update({"sessions": len(self.sessions)})
+
+        return rep
+
+
+def closeQuietly(ser):
+    """
+    Close the serial instance, ignoring anything it complains about
+    """
+    try:
+        ser.close()
+    except Exception as err:
+        print("Error while closing session: %s" % (str(err)))
+
+
+def sessionAlive(ser):
+    """
+    Check whether an already-open session is still usable.
+
+    For socket:// sessions, a socket that's readable but returns nothing
+    when peeked means the remote end has closed it (half-open on our side).
+    Anything that *is* waiting is leftover junk from a previous exchange,
+    and is thrown away so it doesn't get mixed into the next reply.
+    """
+    if ser.is_open is False:
+        return False
+
+    sock = getattr(ser, '_socket', None)
+    if sock is None:
+        # Local serial ports can't be half-open in the same way
+        return True
+
+    try:
+        ready, _, _ = select.select([sock], [], [], 0)
+        while ready:
+            peeked = sock.recv(1, socket.MSG_PEEK)
+            if peeked == b'':
+                return False
+            # Check again after tossing it, since the close can be
+            #   sitting right behind the junk
+            ser.reset_input_buffer()
+            ready, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError, serial.SerialException):
+        return False
+
+    return True
+
+
+# Shared by everything in this process, unless told otherwise
+sessionPool = serialPool()
+
+
+def transact(ser, cmds, framing=None, debug=False, device=None,
+             tracker=None, cap=None):
+    """
+    Send each of the commands in turn on the already open session 'ser'
+    and collect the replies.
+
+    cmds should be a dict mapping a description to the actual command
+    string that is sent. The description is used to tag the reply for
+    later processing so make it good.
+
+    framing is an optional dict mapping the same descriptions to the
+    (terminator, count) that marks a full reply (see read_framed); any
+    command without one falls back to waiting out the timeout.
+
+    If device (the device tag) is given, the framed replies wait only as
+    long as the deadlines learned for them by tracker (a
+    latency.latencyTracker, defaulting to latency.tracker), never any
+    longer than cap if that's given, and their response times are
+    recorded there.
+    """
+    allreplies = {}
+    if framing is None:
+        framing = {}
+    if tracker is None:
+        tracker = latency.tracker
+
+    for each in cmds:
+        msg = encoder(cmds[each])
+        # Toss anything that trickled in late from a previous command so
+        #   it doesn't get mistaken for the reply to this one
+        ser.reset_input_buffer()
+        serWriter(ser, msg)
+        # Get the time right after we sent the message
+        t = dt.datetime.utcnow()
+        t0 = time.monotonic()
+        # print(t.strptime("%Y-%m-%dT%H:%M:%S.%f UTC"))
+
+        # Get the answer; if we know what the end of it looks like it'll
+        #   return as soon as it's here, otherwise it'll take timeout
+        #   seconds to return
+        if each in framing:
+            term, count = framing[each]
+            # (No reply at all is nothing to learn from)
+            if device is None or count == 0:
+                byteReply = read_framed(ser, term, count=count)
+            else:
+                timeout = ser.timeout
+                ser.timeout = tracker.deadline(device, each, timeout,
+                                               cap=cap)
+                try:
+                    byteReply = read_framed(ser, term, count=count)
+                finally:
+                    ser.timeout = timeout
+
+                if framedComplete(byteReply, term, count) is True:
+                    tracker.record(device, each, time.monotonic() - t0)
+                else:
+                    tracker.missed(device, each)
+        else:
+            byteReply = read_all(ser)
+        if debug is True:
+            print("%d bytes recieved in response" % (len(byteReply)))
+            print(byteReply)
+
+        # Store the stuff for returning
+        allreplies.update({each: [byteReply, t]})
+
+    return allreplies
+
+
+def framedComplete(reply, term, count):
+    """
+    True if reply is all there, going by its framing (see read_framed)
+    """
+    term = encoder(term)
+    if count is None:
+        return term in reply
+    elif count == 0:
+        return True
+
+    return reply.count(term) >= count
+
+
+def serComm(host, port, cmds, timeout=1., debug=False, pool=None,
+            framing=None, device=None, cap=None):
     """
     WARNING: By using just a plain old "socket://" URL below, the connection
     connection is NOT encrypted and NO authentication is supported!
@@ -70,43 +372,54 @@ def serComm(host, port, cmds, timeout=1., debug=False):
     the MOXA (or whatever serial <-> socket server) to use RFC2217 ports.
 
     timeout is treated symmetrically as a read AND write timeout.
+
+    The session is taken from (and left open in) 'pool', which defaults
+    to the module-level sessionPool.
+
+    framing, device and cap are passed along to transact(); with the
+    framing, each reply returns as soon as it's complete and timeout is
+    only the worst case (or the learned deadline for that command, with
+    device).
     """
     allreplies = {}
-    hosturl = "socket://%s:%s" % (host, port)
-    with serial.serial_for_url(hosturl,
-                               write_timeout=timeout, timeout=timeout) as ser:
-        if isinstance(cmds, dict):
-            # NOTE: cmds should be a dict mapping a description to the
-            #   actual command string that is sent. The description is
-            #   used to tag the reply for later processing so make it good.
-            for each in cmds:
-                msg = encoder(cmds[each])
-                serWriter(ser, msg)
-                # Get the time right after we sent the message
-                t = dt.datetime.utcnow()
-                # print(t.strptime("%Y-%m-%dT%H:%M:%S.%f UTC"))
-
-                # Get the answer; it'll take timeout seconds to return
-                byteReply = read_all(ser)
-                if debug is True:
-                    print("%d bytes recieved in response" % (len(byteReply)))
-                    print(byteReply)
-
-                # Store the stuff for returning
-                allreplies.update({each: [byteReply, t]})
-        else:
-            print("Commands need to be given as a dict! Ignoring %s" % (cmds))
 
+    if not isinstance(cmds, Mapping):
+        print("Commands need to be given as a dict! Ignoring %s" % (cmds))
         return allreplies
 
+    if pool is None:
+        pool = sessionPool
+
+    hosturl = "socket://%s:%s" % (host, port)
 
-def serLocalComm(devpath, cmds, sParams, timeout=1., debug=True):
+    def opener():
+        return serial.serial_for_url(hosturl,
+                                     write_timeout=timeout, timeout=timeout)
+
+    with pool.session((host, int(port)), opener, timeout=timeout) as ser:
+        allreplies = transact(ser, cmds, framing=framing, debug=debug,
+                              device=device, cap=cap)
+
+    return allreplies
+
+
+def serLocalComm(devpath, cmds, sParams, timeout=1., debug=True, pool=None,
+                 framing=None, device=None, cap=None):
     """
     Ideally I would just combine this with the above and pass in appropriate
     **args as needed for a bare Serial instance, but this works for now.
+
+    Like serComm, the port is kept open in 'pool' between calls.
     """
     allreplies = {}
 
+    if not isinstance(cmds, Mapping):
+        print("Commands need to be given as a dict! Ignoring %s" % (cmds))
+        return allreplies
+
+    if pool is None:
+        pool = sessionPool
+
     try:
         baud = sParams['baud']
         data = sParams['data']
@@ -119,29 +432,13 @@ def serLocalComm(devpath, cmds, sParams, timeout=1., debug=True):
         parity = serial.PARITY_NONE
         stop = serial.STOPBITS_ONE
 
-    with serial.Serial(devpath, baud,
-                       bytesize=data, parity=parity, stopbits=stop,
-                       write_timeout=timeout, timeout=timeout) as ser:
-        if isinstance(cmds, dict):
-            # NOTE: cmds should be a dict mapping a description to the
-            #   actual command string that is sent. The description is
-            #   used to tag the reply for later processing so make it good.
-            for each in cmds:
-                msg = encoder(cmds[each])
-                serWriter(ser, msg)
-                # Get the time right after we sent the message
-                t = dt.datetime.utcnow()
-                # print(t.strptime("%Y-%m-%dT%H:%M:%S.%f UTC"))
-
-                # Get the answer; it'll take timeout seconds to return
-                byteReply = read_all(ser)
-                if debug is True:
-                    print("%d bytes recieved in response" % (len(byteReply)))
-                    print(byteReply)
-
-                # Store the stuff for returning
-                allreplies.update({each: [byteReply, t]})
-        else:
-            print("Commands need to be given as a dict! Ignoring %s" % (cmds))
+    def opener():
+        return serial.Serial(devpath, baud,
+                             bytesize=data, parity=parity, stopbits=stop,
+                             write_timeout=timeout, timeout=timeout)
+
+    with pool.session((devpath, -1), opener, timeout=timeout) as ser:
+        allreplies = transact(ser, cmds, framing=framing, debug=debug,
+                              device=device, cap=cap)
 
     return allreplies
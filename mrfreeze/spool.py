@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""On-disk spool for data that couldn't be sent to a database or broker.
+
+Anything that fails to go out is appended to a diskSpool, and a
+spoolReplayer sends it along again, in order, once the other end is back.
+The spool is split into segment files so that what's already been
+replayed can be deleted a whole file at a time, and its total size is
+bounded so an extended outage can't fill up the disk.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import time
+import threading
+
+
+class diskSpool():
+    """
+    Append-only spool of JSON records, one per line, split across
+    segment files in 'path' of about segmentBytes each.
+
+    The position of the next record to replay is kept in a small cursor
+    file, so the spool picks up where it left off after a restart.
+    If the spool grows past maxBytes the oldest segments are deleted.
+    """
+    def __init__(self, path, segmentBytes=1024*1024, maxBytes=256*1024*1024):
+        self.path = path
+        self.segmentBytes = segmentBytes
+        self.maxBytes = maxBytes
+
+        self.lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+        self.cursorFile = os.path.join(self.path, "cursor")
+
+        self.segments = sorted([int(f.split(".")[0].split("-")[1])
+                                for f in os.listdir(self.path)
+                                if f.startswith("spool-") and
+                                f.endswith(".seg")])
+        if len(self.segments) == 0:
+            self.segments = [0]
+
+        # (segment number, byte offset) of the next record to replay
+        self.cursor = self._readCursor()
+
+        self.stats = {"spooled": 0,
+                      "replayed": 0,
+                      "droppedsegments": 0}
+
+    def _segFile(self, segnum):
+        """
+        """
+        return os.path.join(self.path, "spool-%012d.seg" % (segnum))
+
+    def _readCursor(self):
+        """
+        """
+        cursor = (self.segments[0], 0)
+        try:
+            with open(self.cursorFile, "r") as f:
+                segnum, offset = [int(v) for v in f.read().split()]
+            if segnum in self.segments:
+                cursor = (segnum, offset)
+        except (IOError, OSError, ValueError):
+            pass
+
+        return cursor
+
+    def _writeCursor(self):
+        """
+        Written to the side then renamed, so it's never half-written
+        """
+        tmpname = self.cursorFile + ".tmp"
+        with open(tmpname, "w") as f:
+            f.write("%d %d" % self.cursor)
+        os.replace(tmpname, self.cursorFile)
+
+    def _size(self):
+        """
+        """
+        total = 0
+        for segnum in self.segments:
+            try:
+                total += os.path.getsize(self._segFile(segnum))
+            except OSError:
+                pass
+
+        return total
+
+    def append(self, record):
+        """
+        Add a (JSON serializable) record to the end of the spool
+        """
+        line = json.dumps(record, default=str) + "\n"
+
+        with self.lock:
+            current = self._segFile(self.segments[-1])
+            if os.path.exists(current) and \
+                    os.path.getsize(current) >= self.segmentBytes:
+                self.segments.append(self.segments[-1] + 1)
+                current = self._segFile(self.segments[-1])
+
+            with open(current, "a") as f:
+                f.write(line)
+            self.stats['spooled'] += 1
+
+            # Keep it bounded by tossing the oldest stuff, but never the
+            #   segment we're currently writing to
+            while len(self.segments) > 1 and self._size() > self.maxBytes:
+                oldest = self.segments.pop(0)
+                os.remove(self._segFile(oldest))
+                self.stats['droppedsegments'] += 1
+                print("Spool %s is full! Dropped segment %d" %
+                      (self.path, oldest))
+                if self.cursor[0] == oldest:
+                    self.cursor = (self.segments[0], 0)
+                    self._writeCursor()
+
+    def peek(self, n):
+        """
+        Return up to n records starting at the cursor, without consuming
+        them, plus the cursor to commit() once they've been dealt with.
+        """
+        records = []
+        with self.lock:
+            segnum, offset = self.cursor
+            while len(records) < n:
+                try:
+                    with open(self._segFile(segnum), "r") as f:
+                        f.seek(offset)
+                        while len(records) < n:
+                            line = f.readline()
+                            if line == "" or not line.endswith("\n"):
+                                break
+                            offset = f.tell()
+                            try:
+                                records.append(json.loads(line))
+                            except ValueError:
+                                print("Skipping garbled spool line %s" %
+                                      (line))
+                except (IOError, OSError):
+                    pass
+
+                if len(records) >= n:
+                    break
+
+                # Move on to the next segment, if there is one
+                later = [s for s in self.segments if s > segnum]
+                if len(later) == 0:
+                    break
+                segnum, offset = later[0], 0
+
+        return records, (segnum, offset)
+
+    def commit(self, cursor, nrecords=0):
+        """
+        Move the cursor past records returned by peek(), and delete any
+        segments that have been completely replayed.
+        """
+        with self.lock:
+            self.cursor = cursor
+            self._writeCursor()
+            self.stats['replayed'] += nrecords
+
+            while len(self.segments) > 1 and self.segments[0] < cursor[0]:
+                oldest = self.segments.pop(0)
+                try:
+                    os.remove(self._segFile(oldest))
+                except OSError:
+                    pass
+
+    def pending(self):
+        """
+        True if there's anything left to replay
+        """
+        with self.lock:
+            segnum, offset = self.cursor
+            if segnum != self.segments[-1]:
+                return True
+            try:
+                return os.path.getsize(self._segFile(segnum)) > offset
+            except OSError:
+                return False
+
+    def report(self):
+        """
+        """
+        with self.lock:
+            rep = dict(self.stats)
+            rep.update({"bytes": self._size(),
+                        "segments": len(self.segments)})
+
+        return rep
+
+
+class spoolReplayer():
+    """
+    Background thread that replays a diskSpool through 'sender', which
+    must take a list of records and raise if it couldn't send them.
+
+    Records go out in batches of at most 'batch', and no faster than 'rate'
+    records per second so that catching up after an outage doesn't crowd
+    out the live data. After a failure it waits 'retry' seconds.
+    """
+    def __init__(self, spool, sender, batch=100, rate=200., retry=30.,
+                 idle=5.):
+        self.spool = spool
+        self.sender = sender
+        self.batch = batch
+        self.rate = rate
+        self.retry = retry
+        self.idle = idle
+
+        self.halt = threading.Event()
+        self.thread = None
+
+    def _run(self):
+        """
+        """
+        while self.halt.is_set() is False:
+            if self.spool.pending() is False:
+                self.halt.wait(self.idle)
+                continue
+
+            records, cursor = self.spool.peek(self.batch)
+            try:
+                if len(records) > 0:
+                    self.sender(records)
+            except Exception as err:
+                print("Spool replay from %s failed; retrying in %d s" %
+                      (self.spool.path, self.retry))
+                print(str(err))
+                self.halt.wait(self.retry)
+                continue
+
+            self.spool.commit(cursor, nrecords=len(records))
+            self.halt.wait(len(records)/self.rate)
+
+    def start(self):
+        """
+        """
+        self.halt.clear()
+        self.thread = threading.Thread(target=self._run,
+                                       name="replayer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        """
+        self.halt.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class spooledBroker():
+    """
+    Stands in for a ligmos broker connection; anything that can't be
+    published right now is spooled to disk and published later on.
+
+    Everything other than publish() is passed through to the actual
+    connection, which can be swapped out with rebind() if it's replaced
+    after a reconnect.
+    """
+    def __init__(self, broker, spool, rate=50.):
+        self.broker = broker
+        self.spool = spool
+        # One at a time, so a failure partway through a batch can't have
+        #   the ones that already went out sent all over again
+        self.replayer = spoolReplayer(spool, self._replay, batch=1,
+                                      rate=rate)
+
+    def publish(self, topic, message, debug=False):
+        """
+        """
+        try:
+            self.broker.publish(topic, message, debug=debug)
+        except Exception as err:
+            print("Publish to %s failed; spooling it" % (topic))
+            print(str(err))
+            self.spool.append({"topic": topic, "message": message,
+                               "spooledat": time.time()})
+
+    def _replay(self, records):
+        """
+        """
+        for rec in records:
+            self.broker.publish(rec['topic'], rec['message'])
+
+    def rebind(self, broker):
+        """
+        """
+        self.broker = broker
+
+    def start(self):
+        """
+        """
+        self.replayer.start()
+
+    def stop(self):
+        """
+        """
+        self.replayer.stop()
+
+    def __getattr__(self, attr):
+        return getattr(self.broker, attr)
@@ -15,6 +15,7 @@ Further description.
 
 from __future__ import division, print_function, absolute_import
 
+from . import parsers
 from .parsers import assignValueCmd
 
 
@@ -108,6 +109,65 @@ def defaultQueries(device):
     return cset
 
 
+def replyFraming(device, cmd):
+    """
+    The controllers echo the command, then give one or more lines of reply.
+    Those lines end with the CR command terminator plus a LF, and we need to
+    take the LF too or it'll be left sitting at the front of the next reply.
+
+    STATE is a dump whose length depends on the controller, so it's given
+    as None, meaning "at least one line, then until it goes quiet".
+    """
+    _, term = allCommands(device)
+
+    # Number of lines in the reply *including* the echo
+    replyLines = {"TC": 2,
+                  "P": 2,
+                  "E": 4,
+                  "SET TTARGET": 2,
+                  "SET PID": 2,
+                  "SET PWOUT": 2,
+                  "SET SSTOPM": 2,
+                  "SET SSTOP": 2,
+                  "SET MIN": 2,
+                  "SET MAX": 2,
+                  "STATE": None}
+
+    # Strip off the terminator and any value that's being set
+    base = cmd.strip().split("=")[0].upper()
+
+    return term + "\n", replyLines.get(base, None)
+
+
+def queryCadence(device, key):
+    """
+    The target temperature, PID mode and power target only change when
+    they're told to, so there's no need to ask for them on every poll.
+    """
+    slow = []
+    if device == "sunpowergen1":
+        slow = ["TargetTemp", "PIDMode", "PowerTarget"]
+
+    if key in slow:
+        return "slow"
+    else:
+        return "fast"
+
+
+def parseReply(key, reply):
+    """
+    The echoed command in the reply says what it is, so the key isn't needed
+    """
+    return parsers.parseSunpower(reply)
+
+
+def replyParser(device):
+    """
+    Function taking (query key, reply bytes) and returning the parsed fields
+    """
+    return parseReply
+
+
 def brokerAPI(dvice, cmd, value=None):
     """
     TBD
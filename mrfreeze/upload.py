@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Pushing the instrument compatibility upfiles to where they're read.
+
+Each destination gets an upfilePusher with its own thread and a single
+long-lived SFTP session (sftpSession), so the SSH handshake happens once
+rather than on every push, and the polling threads only ever hand off the
+latest upfile and move on. If a newer upfile comes along before the last
+one went out, only the newer one is sent.
+
+The upfile goes straight from memory to a temporary name next to where
+it belongs on the host, and is then renamed into place, so whatever's
+reading it never sees half of one; and if it's exactly the same as the
+last one that went out, it's not sent at all.
+
+In front of that, an upfileCoalescer collects the section updates of each
+compatibility object and only makes (and pushes) the upfile once per
+window, rather than after every single device's poll.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import io
+import time
+import functools
+import hashlib
+import tempfile
+import threading
+
+from ligmos.utils import ssh
+
+# (host, remote path) -> upfilePusher
+pushers = {}
+# id() of the compatibility object -> upfileCoalescer
+coalescers = {}
+pusherLock = threading.Lock()
+
+
+class sftpSession():
+    """
+    SFTP session to host that's opened the first time it's needed and
+    then kept open; if it's found dead, or a transfer fails, it's
+    reopened (once) and the transfer is tried again.
+    """
+    def __init__(self, host, username, password):
+        self.host = host
+        self.username = username
+        self.password = password
+
+        self.conn = None
+
+        self.stats = {"opened": 0,
+                      "puts": 0,
+                      "failures": 0}
+
+    def _open(self):
+        """
+        """
+        self.conn = ssh.SSHWrapper(host=self.host, username=self.username,
+                                   password=self.password)
+        self.conn.openSFTP()
+        self.stats['opened'] += 1
+
+    def alive(self):
+        """
+        True if the session is (as far as we can tell) still open
+        """
+        if self.conn is None:
+            return False
+
+        # The paramiko client underneath, if it's there to check
+        client = getattr(self.conn, "ssh", None)
+        if client is not None and hasattr(client, "get_transport"):
+            transport = client.get_transport()
+            return transport is not None and transport.is_active()
+
+        return True
+
+    def _putAtomic(self, data, rloc):
+        """
+        """
+        tmploc = "%s.tmp" % (rloc)
+
+        # The paramiko SFTP client underneath, if it's there to use
+        sftp = getattr(self.conn, "sftp", None)
+        if sftp is not None and hasattr(sftp, "putfo"):
+            sftp.putfo(io.BytesIO(data), tmploc)
+        else:
+            # Only the file based interface, so it has to go through a
+            #   (uniquely named) local file first
+            with tempfile.NamedTemporaryFile(suffix=".upf") as f:
+                f.write(data)
+                f.flush()
+                self.conn.putFile(f.name, tmploc)
+
+        self._rename(sftp, tmploc, rloc)
+
+    def _rename(self, sftp, tmploc, rloc):
+        """
+        Move tmploc into place as rloc in one go
+        """
+        # posix_rename replaces rloc in one go, where plain rename fails
+        #   if it's already there
+        if sftp is not None and hasattr(sftp, "posix_rename"):
+            sftp.posix_rename(tmploc, rloc)
+            return
+        elif sftp is not None and hasattr(sftp, "rename"):
+            sftp.rename(tmploc, rloc)
+            return
+
+        # No SFTP client to do it with, so have the host do it instead
+        client = getattr(self.conn, "ssh", None)
+        if client is None or hasattr(client, "exec_command") is False:
+            raise RuntimeError("No way to move %s into place on %s!" %
+                               (tmploc, self.host))
+
+        _, stdout, stderr = client.exec_command("mv -f '%s' '%s'" %
+                                                (tmploc, rloc))
+        if stdout.channel.recv_exit_status() != 0:
+            raise RuntimeError("Unable to move %s into place on %s! %s" %
+                               (tmploc, self.host,
+                                stderr.read().decode("utf-8", "replace")))
+
+    def put(self, data, rloc):
+        """
+        Put the bytes data into the file rloc on the host
+        """
+        for attempt in [1, 2]:
+            if self.alive() is False:
+                self.close()
+                self._open()
+
+            try:
+                self._putAtomic(data, rloc)
+                self.stats['puts'] += 1
+                return
+            except Exception as err:
+                self.stats['failures'] += 1
+                print("SFTP to %s failed! %s" % (self.host, str(err)))
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        """
+        """
+        if self.conn is not None:
+            try:
+                self.conn.closeSFTP()
+                self.conn.closeConnection()
+            except Exception as err:
+                print("Error while closing SFTP to %s: %s" %
+                      (self.host, str(err)))
+        self.conn = None
+
+
+class upfilePusher():
+    """
+    Background thread that puts the latest upfile given to submit()
+    into rloc over session (an sftpSession), unless it's the same as the
+    last one that went out. If that fails, it tries again after retry
+    seconds unless there's a newer one to send by then.
+
+    The onPushed callbacks given to submit() are called once the host
+    has that upfile (or a newer one that replaced it), and not before.
+    """
+    def __init__(self, session, rloc, retry=10.):
+        self.session = session
+        self.rloc = rloc
+        self.retry = retry
+
+        # Hash of the last upfile that made it to the host
+        self.lastHash = None
+
+        self.pending = None
+        # Called once the pending upfile makes it to the host
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.halt = False
+        self.thread = None
+
+        self.stats = {"submitted": 0,
+                      "pushed": 0,
+                      "superseded": 0,
+                      "unchanged": 0,
+                      "failures": 0,
+                      "lastpush": 0.,
+                      "maxpush": 0.}
+
+    def submit(self, upf, onPushed=None):
+        """
+        Queue up the upfile contents upf to be pushed, replacing anything
+        that's still waiting; never blocks on the push itself.
+
+        onPushed, if given, is called (with no arguments, from the pusher's
+        thread) once it's made it to the host.
+        """
+        with self.lock:
+            if self.pending is not None:
+                self.stats['superseded'] += 1
+            self.pending = upf
+            if onPushed is not None:
+                self.callbacks.append(onPushed)
+            self.stats['submitted'] += 1
+        self.wakeup.set()
+
+    def _push(self, upf):
+        """
+        """
+        data = upf.encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self.lastHash:
+            with self.lock:
+                self.stats['unchanged'] += 1
+            return
+
+        t0 = time.monotonic()
+        self.session.put(data, self.rloc)
+        self.lastHash = digest
+
+        elapsed = time.monotonic() - t0
+        with self.lock:
+            self.stats['pushed'] += 1
+            self.stats['lastpush'] = elapsed
+            self.stats['maxpush'] = max(self.stats['maxpush'], elapsed)
+
+    def _run(self):
+        """
+        """
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            with self.lock:
+                upf = self.pending
+                callbacks = self.callbacks
+                self.pending = None
+                self.callbacks = []
+
+            if upf is not None:
+                try:
+                    self._push(upf)
+                except Exception as err:
+                    print("Unable to push the upfile to %s! %s" %
+                          (self.session.host, str(err)))
+                    with self.lock:
+                        self.stats['failures'] += 1
+                        # Try it again, unless it's been replaced already;
+                        #   either way they're waiting on the next one
+                        if self.pending is None:
+                            self.pending = upf
+                        self.callbacks = callbacks + self.callbacks
+                    if self.halt is False:
+                        timer = threading.Timer(self.retry, self.wakeup.set)
+                        timer.daemon = True
+                        timer.start()
+                else:
+                    for onPushed in callbacks:
+                        onPushed()
+
+            if self.halt is True:
+                break
+
+    def start(self):
+        """
+        """
+        self.halt = False
+        self.thread = threading.Thread(target=self._run,
+                                       name="upfile-%s" % (self.session.host),
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Push whatever's waiting (one last try), then close the session
+        """
+        self.halt = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.session.close()
+
+    def report(self):
+        """
+        """
+        with self.lock:
+            rep = dict(self.stats)
+            rep.update({"waiting": self.pending is not None})
+        rep.update({"session": dict(self.session.stats)})
+
+        return rep
+
+
+class upfileCoalescer():
+    """
+    Makes the upfile for compat (a compatibility.upfileCompat, or anything
+    with the same makeUpfile() and 'dirty' set of updated sections) and
+    hands it to pusher, but only window seconds after the first section
+    update that hasn't gone out yet; everything else that's updated by
+    then goes out with it.
+
+    If a section's update comes more than maxStale seconds after the last
+    time that section went out (or since this started, if it never has),
+    it's not held up by the window at all and goes out right away. A
+    section only counts as having gone out once the pusher says the
+    upfile made it to the host.
+
+    lock is whatever's held while the sections are being updated.
+    """
+    def __init__(self, compat, pusher, lock, window=10., maxStale=30.):
+        self.compat = compat
+        self.pusher = pusher
+        self.compatLock = lock
+        self.window = window
+        self.maxStale = maxStale
+
+        # When the next upfile is due (monotonic), or None if nothing is
+        self.due = None
+        # Section -> when it last made it to the host (monotonic)
+        self.pushedAt = {}
+        self.started = time.monotonic()
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.halt = False
+        self.thread = None
+
+        self.stats = {"updates": 0,
+                      "made": 0,
+                      "immediate": 0}
+
+    def poke(self):
+        """
+        Some sections of compat were just updated; call with the compat
+        lock held, since it looks at which ones.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.stats['updates'] += 1
+
+            stale = False
+            for sect in self.compat.dirty:
+                last = self.pushedAt.get(sect, self.started)
+                if (now - last) > self.maxStale:
+                    stale = True
+
+            if stale is True:
+                self.due = now
+                self.stats['immediate'] += 1
+            elif self.due is None:
+                self.due = now + self.window
+
+        self.wakeup.set()
+
+    def _flush(self):
+        """
+        """
+        with self.compatLock:
+            upf = self.compat.makeUpfile()
+            sects = list(self.compat.dirty)
+            self.compat.dirty.clear()
+
+        print(upf)
+
+        with self.lock:
+            self.due = None
+            self.stats['made'] += 1
+
+        self.pusher.submit(upf, onPushed=functools.partial(self._pushed,
+                                                           sects))
+
+    def _pushed(self, sects):
+        """
+        The upfile with the updates to sects made it to the host
+        """
+        now = time.monotonic()
+        with self.lock:
+            for sect in sects:
+                self.pushedAt.update({sect: now})
+
+    def _run(self):
+        """
+        """
+        while self.halt is False:
+            with self.lock:
+                due = self.due
+            if due is None:
+                self.wakeup.wait()
+            else:
+                self.wakeup.wait(max(due - time.monotonic(), 0.))
+            self.wakeup.clear()
+
+            with self.lock:
+                due = self.due
+            if due is not None and \
+               (time.monotonic() >= due or self.halt is True):
+                try:
+                    self._flush()
+                except Exception as err:
+                    print("Unable to make the upfile! %s" % (str(err)))
+                    with self.lock:
+                        self.due = None
+
+    def start(self):
+        """
+        """
+        self.halt = False
+        self.thread = threading.Thread(target=self._run,
+                                       name="upfile-coalescer",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Make and hand off the upfile one last time if anything's waiting
+        """
+        self.halt = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def report(self):
+        """
+        """
+        with self.lock:
+            rep = dict(self.stats)
+            rep.update({"waiting": self.due is not None})
+
+        return rep
+
+
+def getCoalescer(compat, lock):
+    """
+    The (running) upfileCoalescer for compat, pushing to wherever its
+    params say (see getPusher()). They can also say how long the window
+    and maxStale are (pushwindow and maxstale, in seconds).
+    """
+    coalescer = coalescers.get(id(compat), None)
+    if coalescer is None:
+        pusher = getPusher(compat.params)
+        with pusherLock:
+            coalescer = coalescers.get(id(compat), None)
+            if coalescer is None:
+                window = float(compat.params.get('pushwindow', 10.))
+                maxStale = float(compat.params.get('maxstale', 30.))
+                coalescer = upfileCoalescer(compat, pusher, lock,
+                                            window=window, maxStale=maxStale)
+                coalescer.start()
+                coalescers.update({id(compat): coalescer})
+
+    return coalescer
+
+
+def getPusher(params):
+    """
+    The (running) upfilePusher for the compatibility parameters params,
+    which need host, user, pw, upfnme and upfloc like the NIHTS ones do
+    """
+    rloc = "%s/%s" % (params['upfloc'], params['upfnme'])
+    key = (params['host'], rloc)
+
+    pusher = pushers.get(key, None)
+    if pusher is None:
+        with pusherLock:
+            pusher = pushers.get(key, None)
+            if pusher is None:
+                session = sftpSession(params['host'], params['user'],
+                                      params['pw'])
+                pusher = upfilePusher(session, rloc)
+                pusher.start()
+                pushers.update({key: pusher})
+
+    return pusher
+
+
+def stopAll():
+    """
+    """
+    with pusherLock:
+        # Coalescers first, since they can still have an upfile to hand off
+        for key in coalescers:
+            coalescers[key].stop()
+        coalescers.clear()
+
+        for key in pushers:
+            pushers[key].stop()
+        pushers.clear()
+
+
+def report():
+    """
+    """
+    rep = {}
+    for key in list(pushers.keys()):
+        rep.update({"%s:%s" % key: pushers[key].report()})
+    for key in list(coalescers.keys()):
+        rep.update({"coalescer-%s" % (coalescers[key].compat.instrument):
+                    coalescers[key].report()})
+
+    return rep
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Tests for the endpoint circuit breakers in mrfreeze.breaker
+"""
+
+import time
+import datetime as dt
+
+from mrfreeze import breaker
+
+
+def tripped(brk):
+    """
+    Fail polls until brk opens
+    """
+    change = None
+    for i in range(brk.threshold):
+        assert brk.check() == ('closed', None)
+        change = brk.record(False)
+
+    return change
+
+
+def testReplied():
+    now = dt.datetime.utcnow()
+    assert breaker.replied(None) is False
+    assert breaker.replied({'a': [b'', now]}) is False
+    assert breaker.replied({'a': [b'', now], 'b': [b'1', now]}) is True
+
+
+def testProbeSplit():
+    msgs = {'a': 'A?', 'b': 'B?', 'c': 'C?'}
+    framing = {'a': ('\r\n', 1), 'c': ('\r\n', 2)}
+    probe, pframing, rest, rframing = breaker.probeSplit(msgs, framing)
+    assert probe == {'a': 'A?'}
+    assert pframing == {'a': ('\r\n', 1)}
+    assert rest == {'b': 'B?', 'c': 'C?'}
+    assert rframing == {'c': ('\r\n', 2)}
+
+
+def testOpensAfterThreshold():
+    brk = breaker.circuitBreaker(threshold=3, jitter=0.)
+    brk.record(False)
+    brk.record(False)
+    assert brk.state == 'closed'
+    assert brk.record(False) == ('closed', 'open')
+    assert brk.check() == ('open', None)
+
+
+def testSuccessResetsFailures():
+    brk = breaker.circuitBreaker(threshold=3, jitter=0.)
+    brk.record(False)
+    brk.record(False)
+    assert brk.record(True) is None
+    brk.record(False)
+    brk.record(False)
+    assert brk.state == 'closed'
+
+
+def testHalfOpenProbe():
+    brk = breaker.circuitBreaker(threshold=2, baseDelay=60., jitter=0.)
+    assert tripped(brk) == ('closed', 'open')
+
+    # Backoff's over, so one (and only one) probe goes through
+    brk.retryAt = time.monotonic()
+    assert brk.check() == ('halfopen', ('open', 'halfopen'))
+    assert brk.check() == ('open', None)
+
+    assert brk.record(True) == ('halfopen', 'closed')
+    assert brk.check() == ('closed', None)
+
+
+def testFailedProbeBacksOffMore():
+    brk = breaker.circuitBreaker(threshold=1, baseDelay=10., maxDelay=25.,
+                                 jitter=0.)
+    tripped(brk)
+    first = brk.retryAt - time.monotonic()
+    assert 9. < first <= 10.
+
+    brk.retryAt = time.monotonic()
+    brk.check()
+    assert brk.record(False) == ('halfopen', 'open')
+    second = brk.retryAt - time.monotonic()
+    assert 19. < second <= 20.
+
+    # Up to maxDelay, and no further
+    brk.retryAt = time.monotonic()
+    brk.check()
+    brk.record(False)
+    assert brk.retryAt - time.monotonic() <= 25.
+
+
+def testBoard():
+    board = breaker.breakerBoard()
+    brk = board.get(('host', 4001))
+    assert board.get(('host', 4001)) is brk
+
+    board.reset(('host', 4001))
+    assert board.get(('host', 4001)) is not brk
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Tests for the sensor calibration curves in mrfreeze.calibration
+"""
+
+import math
+
+import pytest
+
+from mrfreeze import calibration
+
+curve340 = """Sensor Model:   CX-1050
+Serial Number:  X1
+Data Format:    %d      (Ohms/Kelvin)
+SetPoint Limit: 325.0      (Kelvin)
+Temperature coefficient:  1 (Negative)
+Number of Breakpoints:   3
+
+No.   Units      Temperature (K)
+
+  1  %s      300.0
+  2  %s     50.0
+  3  %s    4.0
+"""
+
+
+@pytest.fixture(params=["numpy", "python"])
+def interp(request, monkeypatch):
+    """
+    Run each test with and without NumPy doing the interpolation
+    """
+    if request.param == "python":
+        monkeypatch.setattr(calibration, "np", None)
+    elif calibration.np is None:
+        pytest.skip("NumPy isn't installed")
+
+    return request.param
+
+
+def writeCurve(tmp_path, name="X1.340", logUnits=False):
+    """
+    """
+    if logUnits is True:
+        text = curve340 % (calibration.formatLogOhms, "2.0", "3.0", "4.0")
+    else:
+        text = curve340 % (calibration.formatOhms, "100.0", "1000.0",
+                           "10000.0")
+    path = tmp_path / name
+    path.write_text(text)
+
+    return str(path)
+
+
+class device():
+    """
+    Just enough of a device config to hang the calcurves setting on
+    """
+    instrument = "TEST"
+    devtype = "lakeshore218"
+    extratag = None
+
+    def __init__(self, calcurves):
+        self.calcurves = calcurves
+
+
+def testRead340(tmp_path):
+    header, units, temps = calibration.read340(writeCurve(tmp_path))
+    assert header['Serial Number'] == "X1"
+    assert units == [100., 1000., 10000.]
+    assert temps == [300., 50., 4.]
+
+
+def testToKelvin(tmp_path, interp):
+    curve = calibration.sensorCurve(writeCurve(tmp_path))
+    kelvin = curve.toKelvin([100., 550., 1000., 10000.])
+    assert kelvin == pytest.approx([300., 175., 50., 4.])
+
+
+def testOffTheCurve(tmp_path, interp):
+    curve = calibration.sensorCurve(writeCurve(tmp_path))
+    kelvin = curve.toKelvin([50., 20000.])
+    assert all([math.isnan(k) for k in kelvin])
+
+
+def testLogUnits(tmp_path, interp):
+    curve = calibration.sensorCurve(writeCurve(tmp_path, logUnits=True))
+    assert curve.logUnits is True
+    kelvin = curve.toKelvin([100., 10**2.5, 0.])
+    assert kelvin[:2] == pytest.approx([300., 175.])
+    assert math.isnan(kelvin[2])
+
+
+def testTooFewBreakpoints(tmp_path):
+    path = tmp_path / "short.340"
+    path.write_text("Serial Number: X2\n  1  100.0  300.0\n")
+    with pytest.raises(ValueError):
+        calibration.sensorCurve(str(path))
+
+
+def testCurveSet(tmp_path, interp):
+    path = writeCurve(tmp_path)
+    cset = calibration.deviceCurves(device("1:%s, 3:%s" % (path, path)))
+    assert sorted(cset.sensors()) == [1, 3]
+    # Sharing a file means sharing the curve
+    assert cset.curves[1] is cset.curves[3]
+
+    # Sensors without a curve, or off of it, are left out
+    kelvin = cset.convert({1: 1000., 2: 1000., 3: 1.})
+    assert kelvin == pytest.approx({1: 50.})
+
+    cset.validated(1, 0.25)
+    cset.validated(1, -0.5)
+    rep = cset.report()
+    assert rep[1]['checks'] == 2
+    assert rep[1]['max'] == -0.5
+    assert rep[3] == {"curve": "X1"}
+
+
+def testNoCurves(tmp_path):
+    assert calibration.deviceCurves(device(None)) is None
+    assert calibration.deviceCurves(device("none")) is None
+    missing = "1:%s" % (tmp_path / "missing.340")
+    assert calibration.deviceCurves(device(missing)) is None
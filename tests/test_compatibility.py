@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Tests for the compiled upfile templates in mrfreeze.compatibility
+
+The expected upfiles were made by the old string builder, which the
+templates have to match byte for byte since the instrument reads them.
+"""
+
+import os
+import datetime as dt
+
+from mrfreeze import compatibility
+
+templateFile = os.path.join(os.path.dirname(__file__), "..", "config",
+                            "upfile.conf-TEMPLATE")
+
+emptyUpfile = (
+    "{ { { NIHTS1_cooler } {20190107 02:10:00} { { TempK -9999.00 }"
+    " { Setpt -9999.00 } { Maxpow -9999.00 } { Minpow -9999.00 }"
+    " { Meanpow -9999.00 } } } { { NIHTS2_cooler } {20190107 02:10:00}"
+    " { { TempK -9999.00 } { Setpt -9999.00 } { Maxpow -9999.00 }"
+    " { Minpow -9999.00 } { Meanpow -9999.00 } } }"
+    " { { NIHTS_Lakeshore218 } {20190107 02:10:00} { { SINK1 -9999.00 }"
+    " { SINK2 -9999.00 } { DEWAR -9999.00 } { FLSHLD -9999.00 }"
+    " { DETBRK -9999.00 } { BENCH -9999.00 } { PRISM -9999.00 }"
+    " { INSTRAP -9999.00 } } } { { NIHTS_Lakeshore325 } {20190107 02:10:00}"
+    " { { GETTER -9999.000 } { DETECTOR -9999.000 } { GSETPT -9999.000 }"
+    " { DSETPT -9999.000 } { GHEAT -9999.000 } { DHEAT -9999.000 } } }"
+    " { { NIHTS_vacgauge } {20190107 02:10:00} { { Torr -9.9990e+03 } } } }")
+
+updatedUpfile = (
+    "{ { { NIHTS1_cooler } {20261018 12:35:01} { { TempK 65.43 }"
+    " { Setpt -9999.00 } { Maxpow -9999.00 } { Minpow -9999.00 }"
+    " { Meanpow -9999.00 } } } { { NIHTS2_cooler } {20190107 02:10:00}"
+    " { { TempK -9999.00 } { Setpt -9999.00 } { Maxpow -9999.00 }"
+    " { Minpow -9999.00 } { Meanpow -9999.00 } } }"
+    " { { NIHTS_Lakeshore218 } {20190107 02:10:00} { { SINK1 -9999.00 }"
+    " { SINK2 -9999.00 } { DEWAR -9999.00 } { FLSHLD -9999.00 }"
+    " { DETBRK -9999.00 } { BENCH -9999.00 } { PRISM -9999.00 }"
+    " { INSTRAP -9999.00 } } } { { NIHTS_Lakeshore325 } {20261018 12:34:56}"
+    " { { GETTER +77.123 } { DETECTOR -3.500 } { GSETPT -9999.000 }"
+    " { DSETPT -9999.000 } { GHEAT -9999.000 } { DHEAT -9999.000 } } }"
+    " { { NIHTS_vacgauge } {20261018 12:35:00} { { Torr 1.2300e-07 } } } }")
+
+
+def update(compat):
+    """
+    The same updates that were made to get updatedUpfile
+    """
+    compat.updateSection('NIHTS_Lakeshore325',
+                         {'SensorTempA': 77.1234, 'SensorTempB': -3.5,
+                          'TimestampUTC': '2026-10-18T12:34:56.789000'})
+    compat.updateSection('NIHTS_vacgauge',
+                         {'CMB4Digit': 1.23e-7,
+                          'TimestampUTC': '2026-10-18T12:35:00.000000'})
+    compat.updateSection('NIHTS1_cooler',
+                         {'ColdTipTemp': 65.432},
+                         ts=dt.datetime(2026, 10, 18, 12, 35, 1))
+
+
+def testEmpty():
+    compat = compatibility.upfileNIHTS({})
+    assert compat.makeNIHTSUpfile() == emptyUpfile
+
+
+def testUpdated():
+    compat = compatibility.upfileNIHTS({})
+    update(compat)
+    assert compat.makeNIHTSUpfile() == updatedUpfile
+
+
+def testOnlyChangedSectionsRerendered():
+    compat = compatibility.upfileNIHTS({})
+    compat.makeUpfile()
+    update(compat)
+    assert compat.stale == {'NIHTS_Lakeshore325', 'NIHTS_vacgauge',
+                            'NIHTS1_cooler'}
+    assert compat.makeUpfile() == updatedUpfile
+    assert compat.stale == set()
+
+    # Nothing new, same upfile
+    assert compat.makeUpfile() == updatedUpfile
+
+
+def testUnknownSectionAndField():
+    compat = compatibility.upfileNIHTS({})
+    compat.updateSection('Nope', {'TimestampUTC': '2026-10-18T00:00:00.0'})
+    compat.updateSection('NIHTS_vacgauge',
+                         {'Nope': 1., 'TimestampUTC': '2019-01-07T02:10:00.0'})
+    assert compat.makeUpfile() == emptyUpfile
+
+
+def testTemplateFile():
+    template = compatibility.parseTemplate(templateFile)
+    compat = compatibility.upfileNIHTS({}, template=template)
+    assert list(template.sections) == \
+        list(compatibility.nihtsTemplate().sections)
+
+    update(compat)
+    assert compat.makeUpfile() == updatedUpfile
+
+
+def testSectionFor():
+    class device():
+        devtype = "sunpowergen2"
+        extratag = "BenchCooler"
+
+    template = compatibility.nihtsTemplate()
+    assert template.sectionFor(device()) == "NIHTS2_cooler"
+
+    device.devtype = "lakeshore218"
+    device.extratag = None
+    assert template.sectionFor(device()) == "NIHTS_Lakeshore218"
+
+    # Coolers only go where their extratag says
+    device.devtype = "sunpowergen2"
+    device.extratag = "Nope"
+    assert template.sectionFor(device()) is None
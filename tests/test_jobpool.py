@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Tests for the per-key job serialization in mrfreeze.jobpool
+"""
+
+import time
+import threading
+
+from mrfreeze import jobpool
+
+
+def drained(pool, timeout=5.):
+    """
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with pool.lock:
+            if len(pool.active) == 0:
+                return True
+        time.sleep(0.01)
+
+    return False
+
+
+def testSameKeyInOrderOneAtATime():
+    pool = jobpool.jobPool(nworkers=4)
+    ran = []
+    running = []
+    overlaps = []
+
+    def job(n):
+        running.append(n)
+        if len(running) > 1:
+            overlaps.append(list(running))
+        time.sleep(0.01)
+        ran.append(n)
+        running.remove(n)
+
+    for n in range(10):
+        pool.submit(('host', 4001), None, job, n)
+
+    assert drained(pool) is True
+    assert ran == list(range(10))
+    assert overlaps == []
+    assert pool.report()['completed'] == 10
+
+
+def testDifferentKeysConcurrent():
+    pool = jobpool.jobPool(nworkers=2)
+    both = threading.Barrier(2, timeout=2.)
+    met = []
+
+    def job():
+        both.wait()
+        met.append(True)
+
+    pool.submit(('host', 4001), None, job)
+    pool.submit(('host', 4002), None, job)
+
+    assert drained(pool) is True
+    assert met == [True, True]
+
+
+def testCoalescedByTag():
+    pool = jobpool.jobPool(nworkers=1)
+    release = threading.Event()
+    ran = []
+
+    pool.submit('port', 'blocker', release.wait, 2.)
+    assert pool.submit('port', 'dev', ran.append, 1) is True
+    # Still waiting behind the blocker, so this one's dropped
+    assert pool.submit('port', 'dev', ran.append, 2) is False
+    release.set()
+
+    assert drained(pool) is True
+    assert ran == [1]
+    assert pool.report()['coalesced'] == 1
+
+
+def testExpeditedGoesFirst():
+    pool = jobpool.jobPool(nworkers=1)
+    release = threading.Event()
+    ran = []
+
+    pool.submit('port', None, release.wait, 2.)
+    pool.submit('port', None, ran.append, 'poll1')
+    pool.submit('port', None, ran.append, 'poll2')
+    pool.expedite('port', None, ran.append, 'cmd1')
+    pool.expedite('port', None, ran.append, 'cmd2')
+    release.set()
+
+    assert drained(pool) is True
+    assert ran == ['cmd1', 'cmd2', 'poll1', 'poll2']
+
+
+def testFailedJobDoesNotStallKey():
+    pool = jobpool.jobPool(nworkers=1)
+    ran = []
+
+    def bad():
+        raise RuntimeError("Oops")
+
+    pool.submit('port', None, bad)
+    pool.submit('port', None, ran.append, 1)
+
+    assert drained(pool) is True
+    assert ran == [1]
+
+
+def testWrapWithCallableKey():
+    pool = jobpool.jobPool(nworkers=1)
+    ran = []
+    keys = iter(['a', 'b'])
+    submitter = pool.wrap(ran.append, lambda: next(keys), tag='dev')
+
+    submitter(1)
+    assert drained(pool) is True
+    submitter(2)
+    assert drained(pool) is True
+    assert ran == [1, 2]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Tests for the learned read deadlines in mrfreeze.latency
+"""
+
+from mrfreeze import latency
+
+
+def learned(seconds, n=20, **kwargs):
+    """
+    A tracker that's seen n replies to ('dev', 'cmd') take seconds each
+    """
+    tracker = latency.latencyTracker(**kwargs)
+    for i in range(n):
+        tracker.record('dev', 'cmd', seconds)
+
+    return tracker
+
+
+def testPercentile():
+    ordered = list(range(101))
+    assert latency.percentile(ordered, 0.5) == 50
+    assert latency.percentile(ordered, 0.99) == 99
+    assert latency.percentile([], 0.5) is None
+
+
+def testDefaultUntilEnoughSamples():
+    tracker = learned(0.2, n=19, minSamples=20)
+    assert tracker.deadline('dev', 'cmd', 1.) == 1.
+
+    tracker.record('dev', 'cmd', 0.2)
+    assert tracker.deadline('dev', 'cmd', 1.) == 0.2*tracker.margin
+
+
+def testDefaultIsClamped():
+    tracker = latency.latencyTracker(floor=0.1, ceiling=5.)
+    assert tracker.deadline('dev', 'cmd', 0.01) == 0.1
+    assert tracker.deadline('dev', 'cmd', 60.) == 5.
+
+
+def testLearnedClampedToFloorAndCeiling():
+    assert learned(0.001, floor=0.1).deadline('dev', 'cmd', 1.) == 0.1
+    assert learned(10., ceiling=5.).deadline('dev', 'cmd', 1.) == 5.
+
+
+def testLearnedGrowsPastDefault():
+    # Slow commands (like the Sunpower STATE dump) need more than the
+    #   1 s that the callers ask for
+    tracker = learned(2., floor=0.1, ceiling=5.)
+    assert tracker.deadline('dev', 'cmd', 1.) == 3.
+
+
+def testCap():
+    tracker = learned(2., floor=0.1, ceiling=5.)
+    assert tracker.deadline('dev', 'cmd', 1., cap=0.5) == 0.5
+    assert tracker.deadline('dev', 'cmd', 1., cap=10.) == 3.
+
+
+def testMissesDoubleUpToCeiling():
+    tracker = learned(0.2, floor=0.1, ceiling=5.)
+    base = tracker.deadline('dev', 'cmd', 1.)
+
+    tracker.missed('dev', 'cmd')
+    assert tracker.deadline('dev', 'cmd', 1.) == 2*base
+    tracker.missed('dev', 'cmd')
+    assert tracker.deadline('dev', 'cmd', 1.) == 4*base
+
+    # Way more than it'd ever take to get to the ceiling, which used to
+    #   overflow 2**misses
+    for i in range(5000):
+        tracker.missed('dev', 'cmd')
+    assert tracker.misses[('dev', 'cmd')] == tracker.maxDoublings
+    assert tracker.deadline('dev', 'cmd', 1.) == 5.
+
+    # One that makes it resets them
+    tracker.record('dev', 'cmd', 0.2)
+    assert tracker.deadline('dev', 'cmd', 1.) == base
+
+
+def testSaveAndLoad(tmp_path):
+    path = str(tmp_path / "latency.json")
+    tracker = learned(0.3, path=path)
+    tracker.save()
+
+    again = latency.latencyTracker(path=path)
+    assert again.deadline('dev', 'cmd', 1.) == tracker.deadline('dev', 'cmd',
+                                                                1.)
+    assert again.report()['dev/cmd']['n'] == 20
+
+
+def testLoadGarbage(tmp_path):
+    path = tmp_path / "latency.json"
+    path.write_text("not json")
+
+    tracker = latency.latencyTracker(path=str(path))
+    assert tracker.samples == {}
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Tests for the framed reads and session pool in mrfreeze.serialcomm
+"""
+
+import time
+
+import pytest
+
+from mrfreeze import latency
+from mrfreeze import serialcomm as scomm
+
+
+class fakePort():
+    """
+    Stands in for a pyserial instance; each read() hands back the next of
+    the chunks, and after they're gone just waits out its timeout
+    """
+    def __init__(self, chunks=(), timeout=0.2):
+        self.chunks = list(chunks)
+        self.timeout = timeout
+        self.write_timeout = timeout
+        self.is_open = True
+        self.written = []
+        self.resets = 0
+
+    @property
+    def in_waiting(self):
+        if len(self.chunks) > 0:
+            return len(self.chunks[0])
+        return 0
+
+    def read(self, size=1):
+        if len(self.chunks) > 0:
+            return self.chunks.pop(0)
+        time.sleep(self.timeout)
+        return b''
+
+    def write(self, msg):
+        self.written.append(msg)
+        return len(msg)
+
+    def reset_input_buffer(self):
+        self.resets += 1
+
+    def close(self):
+        self.is_open = False
+
+
+def testFramedCount():
+    port = fakePort([b'1.0\r\n', b'2.0\r\n', b'3.0\r\n'])
+    t0 = time.monotonic()
+    assert scomm.read_framed(port, '\r\n', count=2) == b'1.0\r\n2.0\r\n'
+    # Back as soon as it's all there, not after the timeout
+    assert time.monotonic() - t0 < 0.1
+    assert port.timeout == 0.2
+
+
+def testFramedTimeout():
+    port = fakePort([b'1.0\r\n'], timeout=0.1)
+    assert scomm.read_framed(port, '\r\n', count=2) == b'1.0\r\n'
+    assert port.timeout == 0.1
+
+
+def testFramedNoReply():
+    port = fakePort([b'junk'])
+    t0 = time.monotonic()
+    assert scomm.read_framed(port, '\r\n', count=0) == b''
+    assert time.monotonic() - t0 < 0.1
+
+
+def testFramedUnknownLength():
+    port = fakePort([b'a\r\n', b'b\r\n'], timeout=1.)
+    t0 = time.monotonic()
+    reply = scomm.read_framed(port, '\r\n', count=None, idle=0.05)
+    assert reply == b'a\r\nb\r\n'
+    assert time.monotonic() - t0 < 0.5
+
+
+def testFramedComplete():
+    assert scomm.framedComplete(b'1\r\n2\r\n', '\r\n', 2) is True
+    assert scomm.framedComplete(b'1\r\n2', '\r\n', 2) is False
+    assert scomm.framedComplete(b'1\r\n', '\r\n', None) is True
+    assert scomm.framedComplete(b'', '\r\n', 0) is True
+
+
+def testTransactLearns():
+    tracker = latency.latencyTracker(minSamples=1)
+    port = fakePort([b'1.0\r\n'], timeout=0.1)
+    reply = scomm.transact(port, {'temp': 'KRDG? 1'},
+                           framing={'temp': ('\r\n', 1),
+                                    'set': ('\r\n', 0)},
+                           device='dev', tracker=tracker)
+    assert reply['temp'][0] == b'1.0\r\n'
+    assert port.resets == 1
+    assert tracker.deadlines[('dev', 'temp')] is not None
+
+    # Missed this time
+    scomm.transact(port, {'temp': 'KRDG? 1'}, framing={'temp': ('\r\n', 1)},
+                   device='dev', tracker=tracker)
+    assert tracker.misses[('dev', 'temp')] == 1
+
+
+def testPoolReusesSessions():
+    pool = scomm.serialPool()
+    opened = []
+
+    def opener():
+        opened.append(fakePort())
+        return opened[-1]
+
+    with pool.session(('host', 4001), opener) as ser:
+        first = ser
+    with pool.session(('host', 4001), opener) as ser:
+        assert ser is first
+    assert pool.report()['opened'] == 1
+    assert pool.report()['reused'] == 1
+
+    # A closed one is replaced
+    first.close()
+    with pool.session(('host', 4001), opener) as ser:
+        assert ser is not first
+    assert pool.report()['reconnects'] == 1
+
+
+def testPoolDropsOnFailure():
+    pool = scomm.serialPool()
+
+    with pytest.raises(IOError):
+        with pool.session(('host', 4001), fakePort) as ser:
+            raise IOError("Port went away")
+
+    assert ser.is_open is False
+    assert pool.report()['sessions'] == 0
+    assert pool.report()['failures'] == 1
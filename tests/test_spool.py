@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Tests for the on-disk spool in mrfreeze.spool
+"""
+
+import os
+import time
+
+from mrfreeze import spool
+
+
+def segFiles(sp):
+    """
+    """
+    return sorted([f for f in os.listdir(sp.path) if f.endswith(".seg")])
+
+
+def waitFor(check, timeout=5.):
+    """
+    """
+    deadline = time.monotonic() + timeout
+    while check() is False and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return check()
+
+
+def testPeekAndCommit(tmp_path):
+    sp = spool.diskSpool(str(tmp_path))
+    assert sp.pending() is False
+
+    for i in range(5):
+        sp.append({"n": i})
+    assert sp.pending() is True
+
+    records, cursor = sp.peek(3)
+    assert [r['n'] for r in records] == [0, 1, 2]
+    # Peeking doesn't consume anything
+    assert sp.peek(3)[0] == records
+
+    sp.commit(cursor, nrecords=len(records))
+    records, cursor = sp.peek(10)
+    assert [r['n'] for r in records] == [3, 4]
+
+    sp.commit(cursor, nrecords=len(records))
+    assert sp.pending() is False
+    assert sp.report()['replayed'] == 5
+
+
+def testCursorSurvivesRestart(tmp_path):
+    sp = spool.diskSpool(str(tmp_path))
+    for i in range(4):
+        sp.append({"n": i})
+    records, cursor = sp.peek(2)
+    sp.commit(cursor)
+
+    again = spool.diskSpool(str(tmp_path))
+    records, cursor = again.peek(10)
+    assert [r['n'] for r in records] == [2, 3]
+
+
+def testSegmentRollover(tmp_path):
+    sp = spool.diskSpool(str(tmp_path), segmentBytes=50)
+    for i in range(20):
+        sp.append({"n": i, "pad": "x"*10})
+    assert len(segFiles(sp)) > 1
+
+    # Reads straight across the segments, in order
+    records, cursor = sp.peek(100)
+    assert [r['n'] for r in records] == list(range(20))
+
+    # And the ones that were completely replayed are deleted
+    sp.commit(cursor)
+    assert len(segFiles(sp)) == 1
+    assert sp.pending() is False
+
+    sp.append({"n": 20})
+    records, cursor = sp.peek(100)
+    assert [r['n'] for r in records] == [20]
+
+
+def testBounded(tmp_path):
+    sp = spool.diskSpool(str(tmp_path), segmentBytes=100, maxBytes=300)
+    for i in range(100):
+        sp.append({"n": i, "pad": "x"*20})
+
+    assert sp.report()['bytes'] <= 300 + 100
+    assert sp.report()['droppedsegments'] > 0
+
+    # What's left is the newest stuff, still in order
+    records, cursor = sp.peek(1000)
+    numbers = [r['n'] for r in records]
+    assert numbers == sorted(numbers)
+    assert numbers[-1] == 99
+
+
+def testGarbledLineSkipped(tmp_path):
+    sp = spool.diskSpool(str(tmp_path))
+    sp.append({"n": 0})
+    with open(sp._segFile(sp.segments[-1]), "a") as f:
+        f.write("{not json\n")
+    sp.append({"n": 1})
+
+    records, cursor = sp.peek(10)
+    assert [r['n'] for r in records] == [0, 1]
+
+
+class flakyBroker():
+    """
+    Publishes, except for the ones it's told to fail
+    """
+    def __init__(self, failOn=()):
+        self.failOn = set(failOn)
+        self.sent = []
+
+    def publish(self, topic, message, debug=False):
+        if message in self.failOn:
+            self.failOn.discard(message)
+            raise ConnectionError("Broker's gone")
+        self.sent.append(message)
+
+
+def testSpooledBrokerNoDuplicates(tmp_path):
+    sp = spool.diskSpool(str(tmp_path))
+    down = flakyBroker(failOn=["m%d" % (i) for i in range(5)])
+    bk = spool.spooledBroker(down, sp, rate=1000.)
+    for i in range(5):
+        bk.publish("topic", "m%d" % (i))
+    assert down.sent == []
+
+    # It comes back, but fails again partway through the replay
+    up = flakyBroker(failOn=["m2"])
+    bk.rebind(up)
+    bk.replayer.retry = 0.05
+    bk.start()
+    try:
+        assert waitFor(lambda: sp.pending() is False) is True
+    finally:
+        bk.stop()
+
+    assert up.sent == ["m0", "m1", "m2", "m3", "m4"]
+
+
+def testReplayerKeepsFailedRecords(tmp_path):
+    sp = spool.diskSpool(str(tmp_path))
+    sp.append({"n": 0})
+    calls = []
+
+    def sender(records):
+        calls.append(records)
+        if len(calls) == 1:
+            raise IOError("Not yet")
+
+    rep = spool.spoolReplayer(sp, sender, batch=1, retry=0.05)
+    rep.start()
+    try:
+        assert waitFor(lambda: sp.pending() is False) is True
+    finally:
+        rep.stop()
+
+    assert calls == [[{"n": 0}], [{"n": 0}]]
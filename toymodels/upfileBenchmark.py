@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Benchmark of the compiled upfile templates against the old builder.
+
+legacyUpfile() is the string builder that upfileNIHTS.makeNIHTSUpfile()
+used to be, one += at a time; the compiled templates are timed making the
+whole upfile from scratch and making it again after one section changes,
+which is what they do most of the time. Also checks that they all agree.
+
+Run it from the top of the repository:
+
+    python toymodels/upfileBenchmark.py
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import sys
+import random
+import timeit
+import datetime as dt
+
+sys.path.append(".")
+from mrfreeze import compatibility
+
+
+def legacyUpfile(compat):
+    """
+    """
+    tsFormat = "{%Y%m%d %H:%M:%S}"
+    sectBegin = "{ "
+    sectEnd = " }"
+
+    finalForm = ""
+    finalForm += sectBegin
+
+    for sect in compat.template.sections:
+        sectOutput = sectBegin + sect + sectEnd
+        keys = compat.template.sections[sect].keys
+        vals = compat.values[sect]
+        if sect == "NIHTS_Lakeshore325":
+            numFormat = "%+0.3f"
+        elif sect in ["NIHTS1_cooler", "NIHTS2_cooler"]:
+            numFormat = "%0.2f"
+        elif sect == "NIHTS_vacgauge":
+            numFormat = "%.4e"
+        else:
+            numFormat = "%+0.2f"
+
+        sectOutput += " " + compat.stamps[sect].strftime(tsFormat)
+        sectOutput += " " + sectBegin
+        for i, subkey in enumerate(keys):
+            printedVal = numFormat % (vals[i])
+
+            sectOutput += sectBegin + subkey + " "
+            sectOutput += printedVal
+            sectOutput += sectEnd
+
+            if i != len(keys) - 1:
+                sectOutput += " "
+
+        sectOutput += sectEnd
+        finalForm += sectBegin + sectOutput + sectEnd + " "
+
+    finalForm += sectEnd.strip()
+
+    return finalForm
+
+
+def randomUpdate(compat):
+    """
+    """
+    sect = random.choice(list(compat.template.sections))
+    fields = {}
+    for field in compat.template.sections[sect].index:
+        fields.update({field: random.uniform(-300., 300.)})
+    compat.updateSection(sect, fields, ts=dt.datetime.utcnow())
+
+
+def fullRender(compat):
+    """
+    """
+    compat.stale.update(compat.template.sections)
+    return compat.makeUpfile()
+
+
+def oneChanged(compat, sect):
+    """
+    """
+    compat.stale.add(sect)
+    return compat.makeUpfile()
+
+
+if __name__ == "__main__":
+    nloops = 20000
+    ninsts = 5
+
+    # The updates print what they're doing, which we don't care about here
+    stdout = sys.stdout
+    sys.stdout = None
+    try:
+        nihts = compatibility.upfileNIHTS({})
+        fromFile = compatibility.upfileNIHTS(
+            {}, template=compatibility.parseTemplate(
+                "./config/upfile.conf-TEMPLATE"))
+        for i in range(100):
+            random.seed(i)
+            randomUpdate(nihts)
+            random.seed(i)
+            randomUpdate(fromFile)
+    finally:
+        sys.stdout = stdout
+
+    legacy = legacyUpfile(nihts)
+    assert legacy == nihts.makeUpfile()
+    assert legacy == fullRender(nihts)
+    assert legacy == fromFile.makeUpfile()
+    print("Compiled templates match the legacy builder.")
+
+    sect = "NIHTS_Lakeshore218"
+    tests = [("legacy builder", lambda: legacyUpfile(nihts)),
+             ("compiled, all sections", lambda: fullRender(nihts)),
+             ("compiled, one section", lambda: oneChanged(nihts, sect)),
+             ("compiled, nothing new", nihts.makeUpfile)]
+    for name, func in tests:
+        elapsed = min(timeit.repeat(func, number=nloops, repeat=3))
+        print("%24s: %7.2f usec/upfile" % (name, 1e6*elapsed/nloops))
+
+    # Several instruments side by side, each with one section changing
+    insts = [compatibility.upfileNIHTS({}) for i in range(ninsts)]
+
+    def everyInst():
+        for each in insts:
+            oneChanged(each, sect)
+
+    elapsed = min(timeit.repeat(everyInst, number=nloops//ninsts, repeat=3))
+    print("%24s: %7.2f usec/upfile" % ("compiled, %d side by side" % ninsts,
+                                       1e6*elapsed/nloops))
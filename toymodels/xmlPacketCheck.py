@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public
+#  License, v. 2.0. If a copy of the MPL was not distributed with this
+#  file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+#  Created on 18 Oct 2026
+#
+#  @author: rhamilton
+
+"""Check that publishers.fastXMLPacket gives byte-for-byte the same XML
+as the xmltodict.unparse path that it replaced, and time the two.
+
+Run it from the top directory so the import doesn't barf.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import sys
+import random
+import timeit
+import datetime as dt
+from uuid import uuid4
+
+import xmltodict as xmld
+
+sys.path.append(".")
+
+from mrfreeze import publishers as pubs
+
+
+def randomValue(depth=0):
+    """
+    """
+    choice = random.randint(0, 9 if depth < 2 else 6)
+    if choice == 0:
+        return None
+    elif choice == 1:
+        return random.choice([True, False])
+    elif choice == 2:
+        return random.randint(-100000, 100000)
+    elif choice == 3:
+        return random.uniform(-1e6, 1e6)
+    elif choice == 4:
+        return random.choice([1e-12, 3.5e20, float('nan'), float('inf')])
+    elif choice == 5:
+        return "".join(random.choice("ab <>&'\"\t°Kz0") for
+                       _ in range(random.randint(0, 12)))
+    elif choice == 6:
+        return dt.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
+    elif choice == 7:
+        return [randomValue(depth + 1) for _ in range(random.randint(0, 3))]
+    else:
+        return randomFields(depth + 1)
+
+
+def randomFields(depth=0):
+    """
+    """
+    fields = {}
+    for i in range(random.randint(0, 8)):
+        key = random.choice(["Temp", "Pressure", "CoolerPower", "tag",
+                             "device", "A_B", "x.y", "Sensor%d" % (i)])
+        fields.update({key: randomValue(depth)})
+
+    return fields
+
+
+def checkOne(measurement, fields, cmd_id, toq, rootTag):
+    """
+    """
+    expected = xmld.unparse(pubs.xmlPacketDict(measurement, fields, cmd_id,
+                                               toq, rootTag=rootTag))
+    actual = pubs.constructXMLPacket(measurement, fields, cmd_id=cmd_id,
+                                     toq=toq, rootTag=rootTag)
+    if actual.encode("utf-8") != expected.encode("utf-8"):
+        print("MISMATCH!")
+        print(fields)
+        print(expected)
+        print(actual)
+        return False
+
+    return True
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    ntries = 20000
+
+    # A typical telemetry packet, as sent by makeAndPublishAMQ
+    telem = {"SetPoint": 105.0, "ColdTipTemp": 104.97, "RejectTemp": 31.2,
+             "CommandedPower": 81.5, "MaxPower": 240.0, "MinPower": 70.0,
+             "PowerMeasured": 81.49, "CoolerState": 1,
+             "TimestampUTC": "2026-10-18T12:00:00.123456"}
+
+    nbad = 0
+    for i in range(ntries):
+        nbad += not checkOne(random.choice(["NIHTS_sunpowergen2",
+                                            "request", "advertisement"]),
+                             randomFields(),
+                             random.choice([str(uuid4()), "a<b&c"]),
+                             random.choice([-1.0, 12.5, 3, "x>y"]),
+                             random.choice(["MrFreezeCommunique", "Root"]))
+    nbad += not checkOne("NIHTS_sunpowergen2", telem, str(uuid4()), -1.0,
+                         "MrFreezeCommunique")
+    print("%d of %d packets differed" % (nbad, ntries + 1))
+
+    # Now time them on the typical telemetry packet
+    cmd_id = str(uuid4())
+    nloops = 20000
+    old = timeit.timeit(lambda: xmld.unparse(
+                        pubs.xmlPacketDict("NIHTS_sunpowergen2", telem,
+                                           cmd_id, -1.0)), number=nloops)
+    oldpretty = timeit.timeit(lambda: (xmld.unparse(
+        pubs.xmlPacketDict("NIHTS_sunpowergen2", telem, cmd_id, -1.0)),
+        xmld.unparse(pubs.xmlPacketDict("NIHTS_sunpowergen2", telem,
+                                        cmd_id, -1.0), pretty=True)),
+                              number=nloops)
+    new = timeit.timeit(lambda: pubs.constructXMLPacket(
+                        "NIHTS_sunpowergen2", telem, cmd_id=cmd_id,
+                        toq=-1.0, debug=True), number=nloops)
+
+    print("xmltodict:                 %8.2f us/packet" % (1e6*old/nloops))
+    print("xmltodict (+pretty debug): %8.2f us/packet" %
+          (1e6*oldpretty/nloops))
+    print("fastXMLPacket (debug):     %8.2f us/packet" % (1e6*new/nloops))